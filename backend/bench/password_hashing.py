@@ -0,0 +1,60 @@
+#Password hashing benchmark
+#Runs password checks (what /login does) through PasswordHasher for each
+#hashing method and pool size, and reports logins per second overall and per
+#core used. Use it to pick PASSWORD_HASH_METHOD and PASSWORD_HASH_WORKERS for a
+#node size: the cost should stay high enough to slow down offline attacks while
+#a core still handles the login rate you expect.
+#eg : cd backend/main && python ../bench/password_hashing.py --methods scrypt pbkdf2:sha256:600000 --workers 1 2 4
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from passwords import PasswordHasher
+
+PASSWORD = 'correct horse battery staple'
+
+
+def bench(method, workers, logins):
+    # Enough concurrent callers to keep every process busy, as a burst of logins would
+    hasher = PasswordHasher(method=method, workers=workers, max_pending=logins)
+    stored = generate_password_hash(PASSWORD, method)
+    hasher.verify(stored, PASSWORD)  # start the pool outside the timing
+    latencies = []
+
+    def login(_):
+        start = time.perf_counter()
+        assert hasher.verify(stored, PASSWORD)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1) * 2) as pool:
+        list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'throughput': logins / elapsed,
+        'per_core': logins / elapsed / max(workers, 1),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Password hashing throughput benchmark')
+    parser.add_argument('--methods', nargs='+', default=['scrypt', 'pbkdf2:sha256'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument('--logins', type=int, default=200)
+    args = parser.parse_args()
+
+    for method in args.methods:
+        for workers in args.workers:
+            result = bench(method, workers, args.logins)
+            print(f"{method:<24} {workers:>3} workers  {result['throughput']:.1f} logins/s  "
+                  f"{result['per_core']:.1f} logins/s per core  "
+                  f"p50 {result['p50_ms']:.1f} ms  p99 {result['p99_ms']:.1f} ms")
@@ -0,0 +1,100 @@
+#Contention benchmark for stock reservations
+#Hundreds of concurrent buyers race for one SKU. Compares the Redis Lua
+#reservation used by /cart/add with a conditional SQL decrement
+#(UPDATE ... WHERE stock >= n, which row-locks the product) and checks that
+#neither oversells.
+#eg : cd backend/main && REDIS_URL=redis://localhost:6379/0 DATABASE_URI=postgresql://... \
+#     python ../bench/stock_contention.py --buyers 500 --stock 100
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from inventory import Inventory, stock_key, HOLDS_KEY, HELD_KEY, EXPIRY_KEY
+
+BENCH_PRODUCT_ID = 999999999
+
+
+def run(buyers, concurrency, attempt):
+    latencies = []
+
+    def buy(user_id):
+        start = time.perf_counter()
+        ok = attempt(user_id)
+        latencies.append(time.perf_counter() - start)
+        return ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        sold = sum(pool.map(buy, range(buyers)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'sold': sold,
+        'throughput': buyers / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000
+    }
+
+
+def bench_redis(redis_conn, args):
+    inventory = Inventory(redis_conn, hold_ttl=60)
+    redis_conn.delete(stock_key(BENCH_PRODUCT_ID))
+    redis_conn.set(stock_key(BENCH_PRODUCT_ID), args.stock)
+    try:
+        return run(args.buyers, args.concurrency, lambda user_id: inventory.reserve(user_id, BENCH_PRODUCT_ID, 1))
+    finally:
+        members = [f'{user_id}:{BENCH_PRODUCT_ID}' for user_id in range(args.buyers)]
+        redis_conn.delete(stock_key(BENCH_PRODUCT_ID))
+        redis_conn.hdel(HOLDS_KEY, *members)
+        redis_conn.hdel(HELD_KEY, BENCH_PRODUCT_ID)
+        redis_conn.zrem(EXPIRY_KEY, *members)
+
+
+def bench_sql(engine, args):
+    # A scratch table, so the real catalog is never touched
+    metadata = sa.MetaData()
+    stock = sa.Table('bench_stock', metadata,
+                     sa.Column('product_id', sa.Integer, primary_key=True),
+                     sa.Column('stock_quantity', sa.Integer, nullable=False))
+    metadata.create_all(engine)
+    try:
+        with engine.begin() as connection:
+            connection.execute(stock.insert().values(product_id=1, stock_quantity=args.stock))
+
+        def attempt(user_id):
+            with engine.begin() as connection:
+                result = connection.execute(
+                    stock.update()
+                    .where(stock.c.product_id == 1, stock.c.stock_quantity >= 1)
+                    .values(stock_quantity=stock.c.stock_quantity - 1))
+                return result.rowcount == 1
+
+        return run(args.buyers, args.concurrency, attempt)
+    finally:
+        metadata.drop_all(engine)
+
+
+def report(name, result, stock):
+    oversold = ' OVERSOLD' if result['sold'] > stock else ''
+    print(f"{name:<6} sold {result['sold']}/{stock}{oversold}  {result['throughput']:.0f} buyers/s  "
+          f"p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stock reservation contention benchmark')
+    parser.add_argument('--buyers', type=int, default=500)
+    parser.add_argument('--stock', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=200)
+    args = parser.parse_args()
+
+    report('redis', bench_redis(redis.Redis.from_url(os.getenv('REDIS_URL')), args), args.stock)
+    if os.getenv('DATABASE_URI'):
+        engine = sa.create_engine(os.getenv('DATABASE_URI'), pool_size=args.concurrency, max_overflow=0)
+        report('sql', bench_sql(engine, args), args.stock)
@@ -1,16 +1,36 @@
 from flask import Flask, render_template, request, redirect, url_for, session
 #from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import joinedload
 from flask_mail import Mail, Message
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import jsonify
-from model import User, Product, Subscription, ChatMessage, Recommendation, Cart, CartItem, BestSeller, db
+from flask import jsonify, stream_with_context
+from model import User, Product, Subscription, ChatMessage, Recommendation, Cart, CartItem, BestSeller, db, slugify, unique_slug
+from cache import CatalogCache, LocalCache
+from catalog import list_products, list_products_page, stream_products, product_detail, product_by_slug, products_by_ids, SEARCH_COLUMNS
+from suggest import SuggestIndex
+from recommend import Recommender, RecommendationCache, ViewHistory
+from views import ViewStream
+from identity import Identities
+from profiles import ProfileCache
+from passwords import PasswordHasher, HasherBusy
+from facets import FacetIndex, FacetIndexUnavailable, price_buckets
+from inventory import Inventory
+from carts import DatabaseCartStore, RedisCartStore, cart_changes
+from categories import CategoryEngine, SORTS as CATEGORY_SORTS
+from migrations import upgrade, pending_migrations
+from catalog_io import import_products, export_products, FORMATS as CATALOG_FORMATS
+from search import normalize_query, search_products as search_catalog, search_products_page, stream_search_results
+import io
 import json
 import redis
 import os
+import socket
+import time
 from flask_redis import FlaskRedis
 from redis import Redis 
 from itsdangerous import URLSafeTimedSerializer
+from flask.cli import AppGroup
+import click
 #This is for Unit Testing
 # from backend.main.model import User, Product, Subscription, ChatMessage, Recommendation, Cart, CartItem, BestSeller, db
 # from backend.main.config import SQLALCHEMY_DATABASE_URI , SQLALCHEMY_TRACK_MODIFICATIONS, REDIS_URL, MAIL_USERNAME, MAIL_PASSWORD, SECRET_KEY
@@ -37,6 +57,28 @@ redis_conn = redis.Redis.from_url(os.getenv('REDIS_URL'))
 # For Unit Testing
 #redis_conn = Redis(host='localhost', port=6379, db=0)  
 
+# Catalog cache: responses are keyed by catalog version, so entries can live much longer than an hour
+app.config['CATALOG_CACHE_TTL'] = int(os.getenv('CATALOG_CACHE_TTL', 86400))
+# Per-worker L1 cache in front of Redis for hot catalog reads, invalidated through Redis pub/sub
+app.config['L1_CACHE_ENABLED'] = os.getenv('L1_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['L1_CACHE_MAX_ENTRIES'] = int(os.getenv('L1_CACHE_MAX_ENTRIES', 1024))
+app.config['L1_CACHE_MAX_BYTES'] = int(os.getenv('L1_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['L1_CACHE_TTL'] = int(os.getenv('L1_CACHE_TTL', 60))
+local_cache = None
+if app.config['L1_CACHE_ENABLED']:
+    local_cache = LocalCache(max_entries=app.config['L1_CACHE_MAX_ENTRIES'],
+                             max_bytes=app.config['L1_CACHE_MAX_BYTES'],
+                             ttl=app.config['L1_CACHE_TTL'])
+# Store gzip/brotli variants next to each cached JSON body
+app.config['CATALOG_CACHE_COMPRESS'] = os.getenv('CATALOG_CACHE_COMPRESS', 'true').lower() == 'true'
+# Stampede protection: serve stale entries this long past expiry while one worker refreshes
+app.config['CATALOG_CACHE_STALE_TTL'] = int(os.getenv('CATALOG_CACHE_STALE_TTL', 300))
+app.config['CATALOG_CACHE_LOCK_TIMEOUT'] = int(os.getenv('CATALOG_CACHE_LOCK_TIMEOUT', 10))
+catalog_cache = CatalogCache(redis_conn, ttl=app.config['CATALOG_CACHE_TTL'], local=local_cache,
+                             compress=app.config['CATALOG_CACHE_COMPRESS'],
+                             stale_ttl=app.config['CATALOG_CACHE_STALE_TTL'],
+                             lock_timeout=app.config['CATALOG_CACHE_LOCK_TIMEOUT'])
+
 
 # Mail Configuration
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
@@ -48,6 +90,59 @@ app.config['MAIL_USE_SSL'] = True
 mail = Mail(app)
 
 
+# How long adding to the cart holds stock before it is released again
+app.config['STOCK_HOLD_TTL'] = int(os.getenv('STOCK_HOLD_TTL', 900))
+
+
+# Where live carts are kept: 'database' (every change commits to Cart/CartItem) or 'redis'
+# (a hash per user, written back in batches by flask cart worker). Run flask cart flush
+# before switching from redis back to database.
+app.config['CART_STORAGE'] = os.getenv('CART_STORAGE', 'database')
+app.config['CART_REDIS_TTL'] = int(os.getenv('CART_REDIS_TTL', 7 * 86400))
+
+
+# Per-user recommendation lists are cached this long; users who viewed a product within
+# RECOMMEND_ACTIVE_WINDOW seconds have theirs recomputed by flask recommend worker
+app.config['RECOMMEND_CACHE_TTL'] = int(os.getenv('RECOMMEND_CACHE_TTL', 3600))
+app.config['RECOMMEND_ACTIVE_WINDOW'] = int(os.getenv('RECOMMEND_ACTIVE_WINDOW', 86400))
+# Each user's view history keeps the latest RECENT_VIEWS_LIMIT products and expires RECENT_VIEWS_TTL
+# seconds after the last view; a view's weight in their recommendations halves every RECENT_VIEWS_HALF_LIFE
+app.config['RECENT_VIEWS_LIMIT'] = int(os.getenv('RECENT_VIEWS_LIMIT', 50))
+app.config['RECENT_VIEWS_TTL'] = int(os.getenv('RECENT_VIEWS_TTL', 30 * 86400))
+app.config['RECENT_VIEWS_HALF_LIFE'] = int(os.getenv('RECENT_VIEWS_HALF_LIFE', 7 * 86400))
+
+
+# How /view-product records views: 'sync' (look the user up and record the view in the request) or
+# 'stream' (append an event for flask views worker and return 202). In stream mode the endpoint answers
+# 503 once VIEW_STREAM_MAX_PENDING events are waiting.
+app.config['VIEW_INGESTION'] = os.getenv('VIEW_INGESTION', 'sync')
+app.config['VIEW_STREAM_MAX_PENDING'] = int(os.getenv('VIEW_STREAM_MAX_PENDING', 100000))
+
+
+# Email -> user id (and name) lookups are cached this long; unknown emails for IDENTITY_NEGATIVE_TTL
+app.config['IDENTITY_CACHE_TTL'] = int(os.getenv('IDENTITY_CACHE_TTL', 3600))
+app.config['IDENTITY_NEGATIVE_TTL'] = int(os.getenv('IDENTITY_NEGATIVE_TTL', 60))
+
+
+# Cached profiles are written through on every change, so they can live long
+app.config['PROFILE_CACHE_TTL'] = int(os.getenv('PROFILE_CACHE_TTL', 7 * 86400))
+
+
+# Password hashing runs in PASSWORD_HASH_WORKERS processes (default: one per CPU, 0 = inline) with at most
+# PASSWORD_HASH_MAX_PENDING operations queued per web worker before logins get a 503. PASSWORD_HASH_METHOD
+# takes werkzeug's method strings with optional cost parameters, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000.
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.getenv('PASSWORD_HASH_MAX_PENDING',
+                                                     4 * max(app.config['PASSWORD_HASH_WORKERS'], 1)))
+# A hash taking longer than this (seconds) is answered with a 503
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+
+
+# Largest page a client can ask for with ?limit=
+app.config['MAX_PAGE_SIZE'] = int(os.getenv('MAX_PAGE_SIZE', 200))
+
+
 # Secret Key
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 # Only for Unit Testing
@@ -61,13 +156,98 @@ db.init_app(app)
 # Initialize Redis instance
 redis = FlaskRedis(app)
 
+# Cached email -> user lookups for the email-keyed endpoints
+identities = Identities(redis_conn, ttl=app.config['IDENTITY_CACHE_TTL'],
+                        negative_ttl=app.config['IDENTITY_NEGATIVE_TTL'])
+
+# GET /profile responses, kept current by PUT /profile
+profile_cache = ProfileCache(redis_conn, ttl=app.config['PROFILE_CACHE_TTL'])
+
+# Password hashing off the request thread, see PASSWORD_HASH_*
+password_hasher = PasswordHasher(method=app.config['PASSWORD_HASH_METHOD'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+                                 timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+
+# Category listings served from per-version partitions of the catalog
+category_engine = CategoryEngine(catalog_cache)
+
+# Prefix index for search suggestions, kept up to date by the product write endpoints
+suggest_index = SuggestIndex(redis_conn)
+
+# Facet sets for /products/filter, kept up to date by the product write endpoints
+facet_index = FacetIndex(redis_conn)
+
+# Precomputed item-to-item recommendations, rebuilt by flask recommend build
+recommender = Recommender(redis_conn, half_life=app.config['RECENT_VIEWS_HALF_LIFE'])
+view_history = ViewHistory(redis_conn, limit=app.config['RECENT_VIEWS_LIMIT'], ttl=app.config['RECENT_VIEWS_TTL'])
+view_stream = ViewStream(redis_conn, max_pending=app.config['VIEW_STREAM_MAX_PENDING'])
+recommendation_cache = RecommendationCache(redis_conn, ttl=app.config['RECOMMEND_CACHE_TTL'],
+                                           active_window=app.config['RECOMMEND_ACTIVE_WINDOW'])
+
+# Stock reservations for carts and checkout
+inventory = Inventory(redis_conn, hold_ttl=app.config['STOCK_HOLD_TTL'])
+
+# Live cart storage, see CART_STORAGE
+if app.config['CART_STORAGE'] == 'redis':
+    cart_store = RedisCartStore(redis_conn, ttl=app.config['CART_REDIS_TTL'])
+else:
+    cart_store = DatabaseCartStore()
+
+# Serve a cached catalog entry as-is: no json.loads/jsonify round trip,
+# 304 when the client already has it, precompressed body when accepted
+def cached_response(entry):
+    body, encoding = entry.body, None
+    if entry.br_body is not None and request.accept_encodings['br']:
+        body, encoding = entry.br_body, 'br'
+    elif entry.gzip_body is not None and request.accept_encodings['gzip']:
+        body, encoding = entry.gzip_body, 'gzip'
+    # A strong ETag must differ between the encoded representations of the same body
+    etag = f'{entry.etag}-{encoding}' if encoding else entry.etag
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=200, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Keyset pagination arguments: ?limit=N&after=<last product_id seen>
+# Returns None when the client wants the whole listing
+def page_args():
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return None
+    return request.args.get('after', 0, type=int), max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+# Stream a JSON body generated chunk by chunk (?stream=true)
+def stream_response(chunks):
+    return app.response_class(stream_with_context(chunks), status=200, mimetype='application/json')
+
 #API Routes
 
 
+# Too many password hashes queued in this worker: shed the request rather than queue it
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    response = jsonify({'message': 'Server busy, please try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/health', methods=['GET'])
 def get_health():
     return "working", 200
 
+#Cache statistics for this worker
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({
+        'catalog_l1': local_cache.stats() if local_cache else None,
+        'recommendations': recommendation_cache.stats()
+    }), 200
+
 # User Management APIs
 
 #User registration API
@@ -81,12 +261,13 @@ def register():
     if User.query.filter_by(email=email).first():
         return jsonify({'message': 'Email already exists'}), 400
 
-    hashed_password = generate_password_hash(password)
+    hashed_password = password_hasher.hash(password)
     phone_number = data.get('phone_number')
     shipping_address = data.get('shipping_address')
     new_user = User(name=name, email=email, password_hash=hashed_password, phone_number=phone_number, shipping_address=shipping_address)
     db.session.add(new_user)
     db.session.commit()
+    identities.store(email, new_user.user_id, new_user.name)
     return jsonify({'message': 'User registered successfully'}), 201
 
 #User login API
@@ -97,9 +278,17 @@ def login():
     password = data.get('password')
     user = User.query.filter_by(email=email).first()
 
-    if not user or not check_password_hash(user.password_hash, password):
+    if not user or not password_hasher.verify(user.password_hash, password):
         return jsonify({'message': 'Invalid credentials'}), 400
 
+    # Upgrade hashes made with an older method or cost now that we know the password
+    if password_hasher.needs_rehash(user.password_hash):
+        try:
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+        except HasherBusy:
+            pass  # next login
+
     return jsonify({'message': 'Login successful', 'user_id': user.user_id, 'name': user.name}), 200
 
 @app.route('/forgot-password', methods=['POST'])
@@ -108,7 +297,7 @@ def forgot_password():
     email = data.get('email')
     
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
     
@@ -163,17 +352,21 @@ def reset_password():
         if not token_status or token_status.decode() != "valid":
             return jsonify({'message': 'The reset link is invalid or expired'}), 400
 
+        # Hash before using up the token, so a busy hasher leaves the link valid for a retry
+        password_hash = password_hasher.hash(new_password)
         redis_conn.delete(f"reset_token:{token}")
 
         user = User.query.filter_by(email=email).first()
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
-        user.password_hash = generate_password_hash(new_password)
+        user.password_hash = password_hash
         db.session.commit()
 
         return jsonify({'message': 'Password successfully reset'}), 200
-    
+
+    except HasherBusy:
+        raise
     except Exception as e:
         return jsonify({'message': 'The reset link is invalid or expired', 'error': str(e)}), 400
 
@@ -184,28 +377,10 @@ def profile():
     if request.method == 'GET':
         data = request.get_json()
         email = data.get('email')
-        cached_user = redis_conn.get(f'user_profile:{email}')
-        if cached_user:
-            return jsonify(json.loads(cached_user)), 200
-        user = User.query.filter_by(email=email).first()
-
-        if not user:
+        body = profile_cache.get(email) or profile_cache.load(email)
+        if not body:
             return jsonify({'message': 'User not found'}), 404
-        
-        # Cache the user profile with expiry time of 1 hour
-        redis_conn.setex(f'user_profile:{email}', 3600, json.dumps({
-            'name': user.name,
-            'email': user.email,
-            'phone_number': user.phone_number,
-            'shipping_address': user.shipping_address
-        }))
-
-        return jsonify({
-            'name': user.name,
-            'email': user.email,
-            'phone_number': user.phone_number,
-            'shipping_address': user.shipping_address
-        }), 200
+        return app.response_class(body, status=200, mimetype='application/json')
         
     elif request.method == 'PUT':
         data = request.get_json()
@@ -215,11 +390,19 @@ def profile():
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
-        user.name = data.get('name')
-        user.phone_number = data.get('phone_number')
-        user.shipping_address = data.get('shipping_address')
+        changes = {field: data.get(field) for field in ('name', 'phone_number', 'shipping_address')}
+        # Saving an unchanged form costs no write at all
+        if all(getattr(user, field) == value for field, value in changes.items()):
+            return jsonify({'message': 'Profile updated successfully'}), 200
 
+        for field, value in changes.items():
+            setattr(user, field, value)
+        # Incremented in SQL, so concurrent updates each get their own version
+        user.profile_version = User.profile_version + 1
         db.session.commit()
+        # Reloads the committed row, then writes it through to the caches
+        profile_cache.updated(user)
+        identities.store(email, user.user_id, user.name)
         return jsonify({'message': 'Profile updated successfully'}), 200
        
 
@@ -228,57 +411,74 @@ def profile():
 #Get all products
 @app.route('/products', methods=['GET'])
 def get_products():
-    cached_projets = redis_conn.get('products')
-    if cached_projets:
-        print("Cached Products")
-        return jsonify(json.loads(cached_projets)), 200
-    products = Product.query.all()
-    products_data = [{
-        'product_id': product.product_id,
-        'name': product.name,
-        'price': product.price,
-        'category': product.category,
-        'image_url': product.image_url
-    } for product in products]
-    #Cache the products with expiry time of 1 hour
-    redis_conn.setex('products', 3600, json.dumps(products_data))
-    return jsonify(products_data), 200
+    if request.args.get('stream') == 'true':
+        return stream_response(stream_products())
+    page = page_args()
+    if page:
+        # Each page is cached on its own: {"items": [...], "next_after": <cursor or null>}
+        after, limit = page
+        entry = catalog_cache.fetch(f'products:after={after}:limit={limit}',
+                                    lambda: list_products_page(after=after, limit=limit))
+        return cached_response(entry)
+    return cached_response(catalog_cache.fetch('products', list_products))
+
+#Filter products by category, price bucket and stock, with facet counts
+#e.g. /products/filter?category=tea,snack&price=0-10,10-20&in_stock=true&limit=20
+@app.route('/products/filter', methods=['GET'])
+def filter_products():
+    categories = sorted({slugify(c) for c in request.args.get('category', '').split(',') if c.strip()})
+    buckets = sorted({b.strip() for b in request.args.get('price', '').split(',') if b.strip()})
+    if not set(buckets) <= set(price_buckets()):
+        return jsonify({'message': f"price must be one of: {', '.join(price_buckets())}"}), 400
+    in_stock = request.args.get('in_stock') == 'true'
+    after, limit = page_args() or (request.args.get('after', 0, type=int), 50)
+
+    key = (f"products_filter:category={','.join(categories)}:price={','.join(buckets)}"
+           f":in_stock={int(in_stock)}:after={after}:limit={limit}")
+    # Nothing is cached while the index is still being built
+    try:
+        entry = catalog_cache.fetch(key, lambda: facet_index.filter_page(categories, buckets, in_stock, after, limit),
+                                    local=False)
+    except FacetIndexUnavailable:
+        response = jsonify({'message': 'Filters are being prepared, try again shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return cached_response(entry)
 
 #Get a product by id
 @app.route('/products/<int:product_id>', methods=['GET'])
 def get_one_product(product_id):
-    cached_product = redis_conn.get(f'product:{product_id}')
-    if cached_product:
-        print("Cached Product")
-        return jsonify(json.loads(cached_product)), 200
-    product = Product.query.get(product_id)
-    if not product:
+    entry = catalog_cache.fetch(f'product:{product_id}', lambda: product_detail(product_id))
+    if not entry:
         return jsonify({'message': 'Product not found'}), 404
-    product_data = {
-        'product_id': product.product_id,
-        'name': product.name,
-        'description': product.description,
-        'price': product.price,
-        'category': product.category,
-        'image_url': product.image_url,
-        'stock_quantity': product.stock_quantity
-    }
-    # Cache the product with expiry time of 1 hour
-    redis_conn.setex(f'product:{product_id}', 3600, json.dumps(product_data))
-    return jsonify(product_data), 200
+    # The cached page leaves stock out; what is available right now comes from the inventory
+    product = json.loads(entry.body)
+    product['stock_quantity'] = inventory.available(product_id)
+    return jsonify(product), 200
 
 
 @app.route('/view-product/<int:product_id>', methods=['POST'])
 def view_product(product_id):
     email = request.get_json().get('email')
+
+    # Stream mode: the worker resolves the user and records the view
+    if app.config['VIEW_INGESTION'] == 'stream':
+        # Same answer as sync mode for a request that cannot name a user
+        if not isinstance(email, str) or not email:
+            return jsonify({'message': 'User not found'}), 404
+        if not view_stream.append(email, product_id, time.time()):
+            response = jsonify({'message': 'Too many views waiting to be processed, try again shortly'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        return jsonify({'message': f'Product {product_id} view queued'}), 202
     
-    # Get the user from the database
-    user = User.query.filter_by(email=email).first()
+    # Get the user (cached email -> user id lookup)
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
     
-    # Track the viewed product in Redis
-    redis_conn.sadd(f"user:{user.user_id}:viewed_products", product_id)
+    # Track the viewed product in Redis (and refresh the user's cached recommendations if it is new to them)
+    view_history.record(user.user_id, product_id)
     
     # Return a success message
     return jsonify({'message': f'Product {product_id} viewed successfully'}), 200
@@ -299,8 +499,44 @@ def add_product():
     new_product = Product(name=name, description=description, price=price, category=category, image_url=image_url, stock_quantity=stock_quantity)
     db.session.add(new_product)
     db.session.commit()
+    suggest_index.index_product(new_product.product_id, new_product.name, new_product.category)
+    facet_index.index_product(new_product.product_id, new_product.category, new_product.price, new_product.stock_quantity)
+    inventory.restock(new_product.product_id, new_product.stock_quantity)
+    # invalidate every cached catalog response, once the indexes it is built from are current
+    catalog_cache.invalidate()
     return jsonify({'message': 'Product added successfully'}), 201
 
+# After a bulk change: rebuild the derived indexes, then drop cached catalog responses once.
+# In the other order a miss in between caches the old index under the new catalog version.
+def catalog_bulk_changed():
+    suggest_index.rebuild()
+    facet_index.rebuild()
+    catalog_cache.invalidate()
+
+#Bulk import: the body is a CSV (with a header row) or JSONL stream of products
+#eg : curl -X POST --data-binary @products.csv '/admin/products/import?format=csv'
+@app.route('/admin/products/import', methods=['POST'])
+def import_catalog():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in CATALOG_FORMATS:
+        return jsonify({'message': f"format must be one of: {', '.join(CATALOG_FORMATS)}"}), 400
+    report = import_products(io.BufferedReader(request.stream), fmt,
+                             chunk_size=request.args.get('chunk_size', 1000, type=int))
+    if report['imported']:
+        catalog_bulk_changed()
+    return jsonify(report), 200
+
+#Bulk export, streamed: /admin/products/export?format=csv|jsonl
+@app.route('/admin/products/export', methods=['GET'])
+def export_catalog():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in CATALOG_FORMATS:
+        return jsonify({'message': f"format must be one of: {', '.join(CATALOG_FORMATS)}"}), 400
+    response = app.response_class(stream_with_context(export_products(fmt)), status=200,
+                                  mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename=products.{fmt}'
+    return response
+
 #Update product
 @app.route('/products/<int:product_id>', methods=['PUT'])
 def update_product(product_id):
@@ -318,8 +554,11 @@ def update_product(product_id):
     product.stock_quantity = data.get('stock_quantity')
 
     db.session.commit()
-    # delete the cached product
-    redis_conn.delete(f'product:{product_id}')
+    suggest_index.index_product(product_id, product.name, product.category)
+    facet_index.index_product(product_id, product.category, product.price, product.stock_quantity)
+    inventory.restock(product_id, product.stock_quantity)
+    # invalidate every cached catalog response, once the indexes it is built from are current
+    catalog_cache.invalidate()
     return jsonify({'message': 'Product updated successfully'}), 200
 
 #Delete product
@@ -329,10 +568,16 @@ def delete_product(product_id):
     if not product:
         return jsonify({'message': 'Product not found'}), 404
 
+    # Precomputed recommendations reference the product from both sides
+    Recommendation.query.filter(db.or_(Recommendation.product_id == product_id,
+                                       Recommendation.recommended_product_id == product_id)).delete()
     db.session.delete(product)
     db.session.commit()
-    # delete the cached product
-    redis_conn.delete(f'product:{product_id}')
+    suggest_index.remove_product(product_id)
+    facet_index.remove_product(product_id)
+    inventory.forget(product_id)
+    # invalidate every cached catalog response, once the indexes it is built from are current
+    catalog_cache.invalidate()
     return jsonify({'message': 'Product deleted successfully'}), 200
 
 
@@ -340,31 +585,39 @@ def delete_product(product_id):
 @app.route('/recommendations', methods=['GET'])
 def get_recommendations():
     email = request.args.get('email')
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
-    viewed_product_ids = redis_conn.smembers(f"user:{user.user_id}:viewed_products")
-    
-    if not viewed_product_ids:
-        return jsonify({'message': 'No viewed products found'}), 200
-    
-    viewed_product_ids = [int(product_id) for product_id in viewed_product_ids]
-    viewed_products = Product.query.filter(Product.product_id.in_(viewed_product_ids)).all()
-    viewed_categories = set(product.category for product in viewed_products)
-    recommended_products = Product.query.filter(Product.category.in_(viewed_categories)).filter(Product.product_id.notin_(viewed_product_ids)).limit(5).all()
-    recommendations = [{
-        'product_id': product.product_id,
-        'name': product.name,
-        'price': product.price,
-        'category': product.category,
-        'image_url': product.image_url
-    } for product in recommended_products]
-    
-    # Cache the recommendations in Redis for 1 hour (3600 seconds)
-    redis_conn.setex(f"user:{email}:recommendations", 3600, str(recommendations))
-    
-    return jsonify(recommendations), 200
+    # Normally precomputed by flask recommend worker; computed here on a miss
+    body = recommendation_cache.get(user.user_id)
+    if body is None:
+        if not view_history.exists(user.user_id):
+            return jsonify({'message': 'No viewed products found'}), 200
+        body = recommendation_cache.store(recommendations_for([user.user_id]))[user.user_id]
+
+    return app.response_class(body, status=200, mimetype='application/json')
+
+# Records a batch of view events from the stream: one query for the users, one pipeline for the views.
+# Events for unknown emails are dropped.
+def record_view_events(events):
+    users = dict(db.session.query(User.email, User.user_id).filter(User.email.in_({email for email, _, _ in events})))
+    view_history.record_many([(users[email], product_id, viewed_at)
+                              for email, product_id, viewed_at in events if email in users])
+
+# {user_id: [product, ...]}: neighbours of everything each user viewed, from the
+# precomputed store, topped up from the viewed categories when there are too few,
+# then one product lookup for the whole batch
+def recommendations_for(user_ids, limit=5):
+    ids = recommender.for_users(user_ids, limit=limit)
+    short = [user_id for user_id, found in ids.items() if len(found) < limit]
+    if short:
+        for user_id, extra in recommender.same_category(short, limit=limit).items():
+            ids[user_id] += [product_id for product_id in extra if product_id not in ids[user_id]][:limit - len(ids[user_id])]
+    products = {product['product_id']: product
+                for product in products_by_ids(sorted({product_id for found in ids.values() for product_id in found}))}
+    return {user_id: [products[product_id] for product_id in found if product_id in products]
+            for user_id, found in ids.items()}
 
 
 
@@ -380,7 +633,7 @@ def subscribe():
     quantity = data.get('quantity')
     status = 'active'
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -398,7 +651,7 @@ def subscribe():
 def get_subscriptions():
     email = request.args.get('email')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -418,7 +671,7 @@ def unsubscribe():
     email = data.get('email')
     product_id = data.get('product_id')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -440,7 +693,7 @@ def update_subscriptions():
     frequency = data.get('frequency')
     quantity = data.get('quantity')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -461,7 +714,7 @@ def get_subscription_status():
     email = data.get('email')
     product_id = data.get('product_id')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -477,7 +730,7 @@ def get_subscription_history():
     data = request.get_json()
     email = data.get('email')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -509,7 +762,7 @@ def send_message():
     email = data.get('email')
     message = data.get('message')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -524,7 +777,7 @@ def get_messages():
     data = request.get_json()
     email = data.get('email')
 
-    user = User.query.filter_by(email=email).first()
+    user = identities.get(email)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
@@ -543,33 +796,39 @@ def search_products():
     if not query:
         return jsonify({'message': 'No query provided'}), 400
 
-    # Check if the search results are cached in Redis
-    cached_results = redis_conn.get(f"search_results:{query}")
-    if cached_results:
-        print("Returning cached search results")
-        return jsonify(json.loads(cached_results)), 200
-
-    # Perform search in the database (case-insensitive)
-    results = Product.query.filter(
-        Product.name.ilike(f'%{query}%') | 
-        Product.description.ilike(f'%{query}%') | 
-        Product.category.ilike(f'%{query}%')
-    ).all()
-
-    # Prepare the results to return
-    search_results = [{
-        'product_id': product.product_id,
-        'name': product.name,
-        'description': product.description,
-        'price': product.price,
-        'category': product.category,
-        'image_url': product.image_url
-    } for product in results]
-
-    # Cache the search results with an expiration time of 1 hour (3600 seconds)
-    redis_conn.setex(f"search_results:{query}", 3600, json.dumps(search_results))
-
-    return jsonify(search_results), 200
+    # Normalized so that "Chai", "chai " and "CHAI" share one cache entry
+    query = normalize_query(query)
+    if not query:
+        return jsonify([]), 200
+
+    if request.args.get('stream') == 'true':
+        return stream_response(stream_search_results(query, catalog_cache.version(), SEARCH_COLUMNS))
+    page = page_args()
+    # Serve the search results from the cache, querying the search index only on a miss.
+    # Search results bypass L1 so one-off queries don't evict the hot catalog pages
+    if page:
+        after, limit = page
+        entry = catalog_cache.fetch(
+            f"search_results:{query}:after={after}:limit={limit}",
+            lambda: search_products_page(query, catalog_cache.version(), SEARCH_COLUMNS, after=after, limit=limit),
+            local=False)
+        return cached_response(entry)
+    entry = catalog_cache.fetch(
+        f"search_results:{query}",
+        lambda: search_catalog(query, catalog_cache.version(), SEARCH_COLUMNS),
+        local=False)
+    return cached_response(entry)
+
+
+# Search suggestions while typing, most popular first
+#eg : http://127.0.0.1:5000/search/suggest?prefix=mas
+@app.route('/search/suggest', methods=['GET'])
+def suggest_products():
+    prefix = request.args.get('prefix')
+    if not prefix:
+        return jsonify({'message': 'No prefix provided'}), 400
+    limit = max(1, min(request.args.get('limit', 10, type=int), 20))
+    return jsonify(suggest_index.suggest(prefix, limit)), 200
 
 
 #cart apis
@@ -579,66 +838,131 @@ def add_to_cart():
     user_id = data.get('user_id')
     product_id = data.get('product_id')
     quantity = data.get('quantity', 1)
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+        return jsonify({'message': 'quantity must be a positive integer'}), 400
 
-    # Check if the user has a cart, create if not
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart:
-        cart = Cart(user_id=user_id)
-        db.session.add(cart)
-        db.session.commit()
-
-    # Check if the item is already in the cart
-    cart_item = CartItem.query.filter_by(cart_id=cart.cart_id, product_id=product_id).first()
-    if cart_item:
-        cart_item.quantity += quantity
-    else:
-        new_item = CartItem(cart_id=cart.cart_id, product_id=product_id, quantity=quantity)
-        db.session.add(new_item)
+    # Hold the stock first so two buyers can never both get the last item
+    if not inventory.reserve(user_id, product_id, quantity):
+        return jsonify({'message': 'Insufficient stock'}), 409
 
-    db.session.commit()
+    try:
+        cart_store.add(user_id, product_id, quantity)
+    except Exception:
+        db.session.rollback()
+        inventory.release(user_id, product_id, quantity)
+        raise
     return jsonify({'message': 'Item added to cart successfully'}), 201
 
+# Apply add/set/remove operations to a cart with one stock reservation call and one cart write
+def apply_cart_operations(user_id, operations):
+    if not user_id or not isinstance(operations, list):
+        return jsonify({'message': 'user_id and a list of operations are required'}), 400
+    try:
+        deltas, quantities = cart_changes(operations)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if not deltas and not quantities:
+        return jsonify({'message': 'Cart unchanged'}), 200
+
+    # Holds follow the cart as read here; set lines are still written outright, and checkout
+    # takes anything a racing change left unheld
+    current = cart_store.items(user_id) if quantities else {}
+    changes = dict(deltas)
+    changes.update({product_id: quantity - current.get(product_id, 0) for product_id, quantity in quantities.items()})
+    added = {product_id: change for product_id, change in changes.items() if change > 0}
+    short = inventory.reserve_many(user_id, added)
+    if short:
+        return jsonify({'message': 'Insufficient stock', 'product_id': short}), 409
+    try:
+        cart_store.apply(user_id, deltas, quantities)
+    except Exception:
+        db.session.rollback()
+        inventory.release_many(user_id, added)
+        raise
+    inventory.release_many(user_id, {product_id: -change for product_id, change in changes.items() if change < 0})
+    return jsonify({'message': 'Cart updated successfully'}), 200
+
+#Several cart changes in one request, all or nothing:
+#{"user_id": 1, "operations": [{"op": "add", "product_id": 2, "quantity": 3},
+#                              {"op": "set", "product_id": 5, "quantity": 1},
+#                              {"op": "remove", "product_id": 7}]}
+@app.route('/cart/bulk', methods=['POST'])
+def bulk_cart():
+    data = request.get_json()
+    return apply_cart_operations(data.get('user_id'), data.get('operations'))
+
+#Merge a guest cart into the user's cart on login: {"user_id": 1, "items": [{"product_id": 2, "quantity": 3}]}
+@app.route('/cart/merge', methods=['POST'])
+def merge_cart():
+    data = request.get_json()
+    items = data.get('items')
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'message': 'items must be a list of objects'}), 400
+    operations = [{'op': 'add', 'product_id': item.get('product_id'), 'quantity': item.get('quantity', 1)}
+                  for item in items]
+    return apply_cart_operations(data.get('user_id'), operations)
+
 @app.route('/cart/<int:user_id>', methods=['GET'])
 def view_cart(user_id):
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart or not cart.items:
+    cart_id, items = cart_store.view(user_id)
+    if not items:
         return jsonify({'message': 'Cart is empty'}), 200
+    return jsonify({'cart_id': cart_id, 'items': items}), 200
 
-    cart_items = []
-    for item in cart.items:
-        cart_items.append({
-            'cart_item_id': item.cart_item_id,
-            'product_id': item.product_id,
-            'product_name': item.product.name,
-            'quantity': item.quantity,
-            'price': item.product.price,
-            'total_price': item.quantity * item.product.price
-        })
-
-    return jsonify({'cart_id': cart.cart_id, 'items': cart_items}), 200
-
+#Remove a product from the cart: {"cart_item_id": ...} or {"user_id": ..., "product_id": ...}
 @app.route('/cart/remove', methods=['DELETE'])
 def remove_from_cart():
     data = request.get_json()
     cart_item_id = data.get('cart_item_id')
+    user_id, product_id = data.get('user_id'), data.get('product_id')
 
-    cart_item = CartItem.query.get(cart_item_id)
-    if not cart_item:
-        return jsonify({'message': 'Cart item not found'}), 404
+    if cart_item_id is not None:
+        cart_item = CartItem.query.get(cart_item_id)
+        if not cart_item:
+            return jsonify({'message': 'Cart item not found'}), 404
+        user_id = db.session.query(Cart.user_id).filter_by(cart_id=cart_item.cart_id).scalar()
+        product_id = cart_item.product_id
 
-    db.session.delete(cart_item)
-    db.session.commit()
+    quantity = cart_store.remove(user_id, product_id)
+    if not quantity:
+        return jsonify({'message': 'Cart item not found'}), 404
+    inventory.release(user_id, product_id, quantity)
     return jsonify({'message': 'Item removed from cart successfully'}), 200
 
+#Buy everything in the cart: held stock becomes sold, anything not held is taken if still available
+@app.route('/checkout', methods=['POST'])
+def checkout():
+    user_id = request.get_json().get('user_id')
+    # Reading, selling and clearing the cart must not interleave with another checkout of it
+    token = inventory.lock_checkout(user_id)
+    if not token:
+        return jsonify({'message': 'Checkout already in progress'}), 409
+    try:
+        items = cart_store.items(user_id)
+        if not items:
+            return jsonify({'message': 'Cart is empty'}), 400
+
+        short = inventory.checkout(user_id, items)
+        if short:
+            return jsonify({'message': 'Insufficient stock', 'product_id': short}), 409
+
+        cart_store.clear(user_id)
+    finally:
+        inventory.unlock_checkout(user_id, token)
+    return jsonify({
+        'message': 'Checkout completed',
+        'items': [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in items.items()]
+    }), 200
+
 
 @app.route('/best-sellers', methods=['GET'])
 def get_best_sellers():
-    cached_best_sellers = redis_conn.get('best_sellers')
-    if cached_best_sellers:
-        print("Cached Best Sellers")
-        return jsonify(json.loads(cached_best_sellers)), 200
-    best_sellers = BestSeller.query.all()
-    best_sellers_data = [{
+    return cached_response(catalog_cache.fetch('best_sellers', load_best_sellers))
+
+def load_best_sellers():
+    # Load the products in the same query instead of one lazy load per row
+    best_sellers = BestSeller.query.options(joinedload(BestSeller.product)).all()
+    return [{
         'product_id': best_seller.product_id,
         'name': best_seller.product.name,
         'price': best_seller.product.price,
@@ -646,9 +970,6 @@ def get_best_sellers():
         'image_url': best_seller.product.image_url,
         'quantity_sold': best_seller.quantity_sold
     } for best_seller in best_sellers]
-    # Cache the best sellers with expiry time of 1 hour
-    redis_conn.setex('best_sellers', 3600, json.dumps(best_sellers_data))
-    return jsonify(best_sellers_data), 200
 
 @app.route('/best-sellers', methods=['POST'])
 def add_best_seller():
@@ -663,12 +984,16 @@ def add_best_seller():
     new_best_seller = BestSeller(product_id=product_id, quantity_sold=quantity_sold)
     db.session.add(new_best_seller)
     db.session.commit()
+    suggest_index.add_popularity(product_id, product.category, quantity_sold or 0)
+    # best sellers are cached with the catalog
+    catalog_cache.invalidate()
     return jsonify({'message': 'Best seller added successfully'}), 201
 
 #get top 4 best sellers
 @app.route('/best-sellers/top', methods=['GET'])
 def get_top_best_sellers():
-    best_sellers = BestSeller.query.order_by(BestSeller.quantity_sold.desc()).limit(4).all()
+    best_sellers = BestSeller.query.options(joinedload(BestSeller.product)) \
+        .order_by(BestSeller.quantity_sold.desc()).limit(4).all()
     best_sellers_data = [{
         'product_id': best_seller.product_id,
         'name': best_seller.product.name,
@@ -681,79 +1006,258 @@ def get_top_best_sellers():
     
 
 
+#Category listings
+#eg : http://127.0.0.1:5000/collection/category/tea-leaves?sort=price_asc&min_price=5&max_price=20&limit=12
+@app.route('/collection/category/<slug>', methods=['GET'])
+def get_category(slug):
+    slug = slugify(slug)
+    sort = request.args.get('sort', 'default')
+    if sort not in CATEGORY_SORTS:
+        return jsonify({'message': f"Unknown sort, expected one of {', '.join(CATEGORY_SORTS)}"}), 400
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+    page = page_args()
+
+    # Each combination of parameters is cached with the catalog
+    key = f'category:{slug}:sort={sort}:min={min_price}:max={max_price}:page={page}'
+    entry = catalog_cache.fetch(key, lambda: category_engine.listing(slug, sort, min_price, max_price, page))
+    return cached_response(entry)
+
+#The old per-category routes are aliases with the same query parameters
 #Get all Teas
 @app.route('/collection/teas', methods=['GET'])
 def get_teas():
-    teas = Product.query.filter_by(category='Tea').all()
-    teas_data = [{
-        'product_id': tea.product_id,
-        'name': tea.name,
-        'price': tea.price,
-        'category': tea.category,
-        'image_url': tea.image_url
-    } for tea in teas]
-    return jsonify(teas_data), 200
+    return get_category('tea')
 
 #Get all snacks
 @app.route('/collection/snacks', methods=['GET'])
 def get_snacks():
-    snacks = Product.query.filter_by(category='Snack').all()
-    snacks_data = [{
-        'product_id': snack.product_id,
-        'name': snack.name,
-        'price': snack.price,
-        'category': snack.category,
-        'image_url': snack.image_url
-    } for snack in snacks]
-    return jsonify(snacks_data), 200
+    return get_category('snack')
 
 #Get all Teaware
 @app.route('/collection/teaware', methods=['GET'])
 def get_teaware():
-    teaware = Product.query.filter_by(category='Teaware').all()
-    teaware_data = [{
-        'product_id': teaware.product_id,
-        'name': teaware.name,
-        'price': teaware.price,
-        'category': teaware.category,
-        'image_url': teaware.image_url
-    } for teaware in teaware]
-    return jsonify(teaware_data), 200
+    return get_category('teaware')
 
 #Get all Tealeaves
 @app.route('/collection/tealeaves', methods=['GET'])
 def get_tealeaves():
-    tealeaves = Product.query.filter_by(category='Tea Leaves').all()
-    tealeaves_data = [{
-        'product_id': tealeaves.product_id,
-        'name': tealeaves.name,
-        'price': tealeaves.price,
-        'category': tealeaves.category,
-        'image_url': tealeaves.image_url
-    } for tealeaves in tealeaves]
-    return jsonify(tealeaves_data), 200
+    return get_category('tea-leaves')
 
 #Get the product details based on name
 @app.route('/collection/<name>', methods=['GET'])
 def get_product(name):
-    #regex to remove hyphen if present in the name and replace it with space
-    name = name.replace('-', ' ')
-    #search the product based on the name and like operator
-    product = Product.query.filter(Product.name.ilike(f'%{name}%')).first()
-    if not product:
+    # The frontend links products as lower-cased, hyphenated names; normalize to our slug form.
+    # Responses are cached per slug with the catalog, so a repeat visit never reaches Postgres.
+    slug = slugify(name)
+    entry = catalog_cache.fetch(f'collection:{slug}', lambda: product_by_slug(slug, name.replace('-', ' ')))
+    if not entry:
         return jsonify({'message': 'Product not found'}), 404
-    return jsonify({
-        'product_id': product.product_id,
-        'name': product.name,
-        'price': product.price,
-        'category': product.category,
-        'image_url': product.image_url
-    }), 200
-
-with app.app_context():
-        db.create_all()
+    return cached_response(entry)
+
+
+#CLI commands
+catalog_cli = AppGroup('catalog', help='Catalog maintenance commands.')
+app.cli.add_command(catalog_cli)
+
+schema_cli = AppGroup('schema', help='Database schema commands.')
+app.cli.add_command(schema_cli)
+
+inventory_cli = AppGroup('inventory', help='Stock reservation commands.')
+app.cli.add_command(inventory_cli)
+
+cart_cli = AppGroup('cart', help='Cart storage commands.')
+app.cli.add_command(cart_cli)
+
+recommend_cli = AppGroup('recommend', help='Recommendation commands.')
+app.cli.add_command(recommend_cli)
+
+views_cli = AppGroup('views', help='View event ingestion commands.')
+app.cli.add_command(views_cli)
+
+#Bulk-load products from a CSV or JSONL file (format taken from the extension unless given)
+#eg : flask catalog import seasonal.csv
+@catalog_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=1000, help='Rows per COPY/insert and commit.')
+def catalog_import(path, fmt, chunk_size):
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, 'rb') as stream:
+        report = import_products(stream, fmt, chunk_size=chunk_size)
+    if report['imported']:
+        catalog_bulk_changed()
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {report['imported']} of {report['read']} rows ({report['rejected']} rejected) "
+               f"in {report['seconds']}s, {report['rows_per_second']} rows/s")
+
+#Stream the catalog to a CSV or JSONL file (or stdout)
+#eg : flask catalog export --format jsonl --output products.jsonl
+@catalog_cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), default='csv')
+@click.option('--output', type=click.File('wb'), default='-')
+def catalog_export(fmt, output):
+    for chunk in export_products(fmt):
+        output.write(chunk)
+
+#Create missing tables and apply pending migrations (columns, indexes, constraints)
+#eg : flask schema upgrade
+@schema_cli.command('upgrade')
+def schema_upgrade():
+    upgrade(echo=click.echo)
+    click.echo('Schema is up to date')
+
+#eg : flask schema status
+@schema_cli.command('status')
+def schema_status():
+    pending = pending_migrations()
+    click.echo('\n'.join(pending) if pending else 'No pending migrations')
+
+#Fill in slugs for products created before the slug column existed (run after flask schema upgrade)
+#eg : flask catalog backfill-slugs
+@catalog_cli.command('backfill-slugs')
+@click.option('--batch-size', default=500, help='Products per commit.')
+def backfill_slugs(batch_size):
+    filled = 0
+    while True:
+        products = Product.query.filter(Product.slug.is_(None)).order_by(Product.product_id).limit(batch_size).all()
+        if not products:
+            break
+        for product in products:
+            # Flush each one so the next slug sees it as taken
+            product.slug = unique_slug(db.session.connection(), product.name, product.product_id)
+            db.session.flush()
+        db.session.commit()
+        filled += len(products)
+
+    catalog_cache.invalidate()
+    click.echo(f'Backfilled {filled} product slugs')
+
+# Write checkout sales back to Product.stock_quantity and refresh what depends on it
+def reconcile_inventory():
+    sold = inventory.reconcile()
+    if not sold:
+        return sold
+    products = db.session.query(Product.product_id, Product.category, Product.price, Product.stock_quantity) \
+        .filter(Product.product_id.in_(sold)).all()
+    for product in products:
+        facet_index.index_product(*product)
+    # Detail pages read stock from the inventory; cached filter results only change on selling out
+    if any((product.stock_quantity or 0) <= 0 for product in products):
+        catalog_cache.invalidate()
+    return sold
+
+#Release expired stock holds once
+#eg : flask inventory release-expired
+@inventory_cli.command('release-expired')
+def inventory_release_expired():
+    click.echo(f'Released {inventory.release_expired()} expired holds')
+
+#Write pending sales back to the database once
+#eg : flask inventory reconcile
+@inventory_cli.command('reconcile')
+def inventory_reconcile():
+    click.echo(f'Reconciled {len(reconcile_inventory())} products')
+
+#Background worker: releases expired holds and reconciles sales every few seconds
+#eg : flask inventory worker --interval 5
+@inventory_cli.command('worker')
+@click.option('--interval', default=5.0, help='Seconds between runs.')
+def inventory_worker(interval):
+    while True:
+        try:
+            inventory.release_expired()
+            reconcile_inventory()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Inventory worker run failed")
+        db.session.remove()
+        time.sleep(interval)
+
+#Write Redis-resident carts back to the database once (CART_STORAGE=redis)
+#eg : flask cart flush
+@cart_cli.command('flush')
+@click.option('--batch-size', default=500, help='Carts per commit.')
+def cart_flush(batch_size):
+    # Works whatever CART_STORAGE is set to, so carts can be drained after switching back to database
+    store = RedisCartStore(redis_conn, ttl=app.config['CART_REDIS_TTL'])
+    click.echo(f'Flushed {store.flush(batch_size)} carts')
+
+#Write-behind worker for Redis-resident carts
+#eg : flask cart worker --interval 2
+@cart_cli.command('worker')
+@click.option('--interval', default=2.0, help='Seconds between flushes.')
+@click.option('--batch-size', default=500, help='Carts per commit.')
+def cart_worker(interval, batch_size):
+    store = RedisCartStore(redis_conn, ttl=app.config['CART_REDIS_TTL'])
+    while True:
+        try:
+            store.flush(batch_size)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Cart flush failed")
+        db.session.remove()
+        time.sleep(interval)
+
+#Recompute item-to-item recommendations from views and carts (run periodically, e.g. a CronJob)
+#eg : flask recommend build --top-k 20
+@recommend_cli.command('build')
+@click.option('--top-k', default=20, help='Neighbours kept per product.')
+def recommend_build(top_k):
+    start = time.monotonic()
+    products = recommender.build(top_k)
+    click.echo(f'Built recommendations for {products} products in {time.monotonic() - start:.1f}s')
+    # Cached lists were computed from the previous build
+    users = recommendation_cache.refresh_active(recommendations_for)
+    click.echo(f'Precomputed recommendations for {users} active users')
+
+#One-off after upgrading: converts the old unbounded viewed_products sets into capped view histories
+#eg : flask recommend migrate-views
+@recommend_cli.command('migrate-views')
+def recommend_migrate_views():
+    click.echo(f'Migrated {view_history.migrate_sets()} view sets')
+
+#Keeps the per-user recommendation cache warm: recomputes users who viewed something new
+#eg : flask recommend worker --interval 5
+@recommend_cli.command('worker')
+@click.option('--interval', default=5.0, help='Seconds between runs.')
+@click.option('--batch-size', default=200, help='Users per batch.')
+def recommend_worker(interval, batch_size):
+    while True:
+        try:
+            recommendation_cache.refresh_stale(recommendations_for, batch_size)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Recommendation refresh failed")
+        db.session.remove()
+        time.sleep(interval)
+
+#Consumer-group worker for VIEW_INGESTION=stream; run as many as needed, each with its own name
+#eg : flask views worker --batch-size 500
+@views_cli.command('worker')
+@click.option('--consumer', default=lambda: f'{socket.gethostname()}-{os.getpid()}', help='Consumer name.')
+@click.option('--batch-size', default=500, help='Events per batch.')
+@click.option('--min-idle', default=60.0, help='Seconds before another worker\'s unacknowledged events are taken over.')
+def views_worker(consumer, batch_size, min_idle):
+    view_stream.create_group()
+    while True:
+        try:
+            view_stream.consume(consumer, record_view_events, count=batch_size, min_idle_ms=int(min_idle * 1000))
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("View ingestion failed")
+            time.sleep(1)
+        db.session.remove()
+
+#eg : flask views backlog
+@views_cli.command('backlog')
+def views_backlog():
+    click.echo(f'{view_stream.backlog()} view events waiting')
 
 if __name__ == "__main__":    
+    with app.app_context():
+        upgrade()
     # app.run(debug=True)
     app.run(host="0.0.0.0", port=5000, debug=True)
     
\ No newline at end of file
@@ -0,0 +1,301 @@
+import gzip
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+#Catalog cache
+#Every cached catalog response lives under a key namespaced by the current
+#catalog version, e.g. catalog:v12:products. A product write bumps the version
+#once with INCR, so all older entries stop being read straight away and simply
+#age out through their TTL. No KEYS/SCAN sweeps are needed to invalidate.
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_INVALIDATE_CHANNEL = 'catalog:invalidate'
+
+# Reads the current catalog version and the entry stored under it in a single round trip
+_VERSIONED_GET = """
+local version = redis.call('GET', KEYS[1]) or '0'
+return {version, redis.call('HGETALL', 'catalog:v' .. version .. ':' .. ARGV[1])}
+"""
+
+# Payloads smaller than this are not worth storing precompressed
+COMPRESS_MIN_BYTES = 1024
+
+# Deletes a single-flight lock only if we still own it
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+#A cached response: the serialized JSON body, its ETag and optional
+#precompressed variants, stored together as one Redis hash. expires_at is the
+#logical expiry (the Redis key outlives it so stale entries can still be
+#served) and delta is how long the response took to compute.
+class CachedEntry:
+    def __init__(self, body, etag, gzip_body=None, br_body=None, expires_at=0.0, delta=0.0):
+        self.body = body
+        self.etag = etag
+        self.gzip_body = gzip_body
+        self.br_body = br_body
+        self.expires_at = expires_at
+        self.delta = delta
+
+    @classmethod
+    def from_data(cls, data, compress=True, expires_at=0.0, delta=0.0):
+        body = json.dumps(data, separators=(',', ':')).encode()
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        gzip_body = br_body = None
+        if compress and len(body) >= COMPRESS_MIN_BYTES:
+            gzip_body = gzip.compress(body, compresslevel=6)
+            if brotli is not None:
+                br_body = brotli.compress(body)
+        return cls(body, etag, gzip_body, br_body, expires_at, delta)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls(mapping[b'body'], mapping[b'etag'].decode(), mapping.get(b'gzip'), mapping.get(b'br'),
+                   float(mapping.get(b'expires_at', 0)), float(mapping.get(b'delta', 0)))
+
+    def to_mapping(self):
+        mapping = {'body': self.body, 'etag': self.etag, 'expires_at': self.expires_at, 'delta': self.delta}
+        if self.gzip_body is not None:
+            mapping['gzip'] = self.gzip_body
+        if self.br_body is not None:
+            mapping['br'] = self.br_body
+        return mapping
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzip_body or b'') + len(self.br_body or b'')
+
+
+#In-process L1 cache
+#A bounded LRU of serialized payloads kept per worker, capped both by entry
+#count and by total bytes. Entries also expire after a short TTL, which bounds
+#staleness if an invalidation message is ever missed.
+class LocalCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+
+#Cache-aside with stampede protection
+#fetch() is the entry point for cached handlers. An entry is recomputed by a
+#single worker holding a Redis lock (single-flight); it may be refreshed a
+#little before it expires, with a probability that grows as expiry nears and
+#with the cost of the computation (XFetch); and while one worker refreshes,
+#everyone else keeps serving the stale entry for up to stale_ttl seconds.
+class CatalogCache:
+    def __init__(self, redis_conn, ttl=86400, local=None, compress=True,
+                 stale_ttl=300, lock_timeout=10, beta=1.0):
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.local = local
+        self.compress = compress
+        self.stale_ttl = stale_ttl
+        self.lock_timeout = lock_timeout
+        self.beta = beta
+        self._versioned_get = redis_conn.register_script(_VERSIONED_GET)
+        self._release_lock = redis_conn.register_script(_RELEASE_LOCK)
+        # Highest catalog version announced on the invalidation channel
+        self._local_version = 0
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def key(self, name, version):
+        return f'catalog:v{version}:{name}'
+
+    def version(self):
+        version = self.redis_conn.get(CATALOG_VERSION_KEY)
+        return int(version) if version else 0
+
+    def get(self, name, local=True):
+        # Returns (version, CachedEntry or None). The version must be handed back to set()
+        # so that data loaded before a concurrent write is never stored under the new version.
+        if local and self._local_enabled():
+            cached = self.local.get(name)
+            if cached is not None:
+                return cached
+        version, fields = self._versioned_get(keys=[CATALOG_VERSION_KEY], args=[name])
+        version = int(version)
+        if not fields:
+            return version, None
+        entry = CachedEntry.from_mapping(dict(zip(fields[::2], fields[1::2])))
+        if local:
+            self._set_local(name, entry, version)
+        return version, entry
+
+    def set(self, name, data, version, local=True, delta=0.0):
+        # Serializes the data once and stores the response bytes; returns the CachedEntry
+        entry = CachedEntry.from_data(data, compress=self.compress,
+                                      expires_at=time.time() + self.ttl, delta=delta)
+        key = self.key(name, version)
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(key, mapping=entry.to_mapping())
+        pipe.expire(key, self.ttl + self.stale_ttl)
+        pipe.execute()
+        if local:
+            self._set_local(name, entry, version)
+        return entry
+
+    def fetch(self, name, loader, local=True):
+        # Returns the CachedEntry for name, calling loader() to build the data when it
+        # must be (re)computed. A loader returning None (e.g. not found) is not cached.
+        version, entry = self.get(name, local)
+        if entry is not None and not self._should_refresh(entry):
+            return entry
+
+        lock_key = self.key(name, version) + ':lock'
+        token = uuid.uuid4().hex
+        if self.redis_conn.set(lock_key, token, nx=True, ex=self.lock_timeout):
+            try:
+                return self._load(name, loader, version, local)
+            finally:
+                self._release_lock(keys=[lock_key], args=[token])
+
+        # Someone else is refreshing: serve what we have
+        if entry is not None:
+            return entry
+
+        # Nothing to serve yet: wait for the lock holder to fill the cache
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            _, entry = self.get(name, local=False)
+            if entry is not None:
+                return entry
+            if not self.redis_conn.exists(lock_key):
+                break
+        return self._load(name, loader, version, local)
+
+    def _load(self, name, loader, version, local):
+        start = time.monotonic()
+        data = loader()
+        if data is None:
+            return None
+        return self.set(name, data, version, local, delta=time.monotonic() - start)
+
+    def _should_refresh(self, entry):
+        # XFetch: -log(u) is exponentially distributed, so recomputation starts early with a
+        # probability that rises as expiry approaches and with how slow the loader is
+        early = -entry.delta * self.beta * math.log(1.0 - random.random())
+        return time.time() + early >= entry.expires_at
+
+    def invalidate(self):
+        # Bump the catalog version: one write drops every cached catalog response,
+        # and every worker drops its L1 copies when the new version is announced
+        version = self.redis_conn.incr(CATALOG_VERSION_KEY)
+        self.redis_conn.publish(CATALOG_INVALIDATE_CHANNEL, version)
+        if self.local is not None:
+            self._announce(version)
+        return version
+
+    def _set_local(self, name, entry, version):
+        # Never let a response loaded before the latest write back into L1
+        if self._local_enabled() and version >= self._local_version:
+            self.local.set(name, (version, entry), entry.size)
+
+    def _local_enabled(self):
+        # L1 is only trusted while this worker is subscribed to invalidations
+        if self.local is None:
+            return False
+        if self._listener is None:
+            self._start_listener()
+        return self._listener is not None
+
+    def _start_listener(self):
+        with self._listener_lock:
+            if self._listener is not None:
+                return
+            try:
+                pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{CATALOG_INVALIDATE_CHANNEL: self._on_invalidate})
+                self.local.clear()
+                self._listener = pubsub.run_in_thread(
+                    sleep_time=1.0, daemon=True, exception_handler=self._on_listener_error)
+            except Exception:
+                logger.exception("L1 cache disabled, cannot subscribe to invalidations")
+
+    def _on_invalidate(self, message):
+        self._announce(int(message['data']))
+
+    def _announce(self, version):
+        if version > self._local_version:
+            self._local_version = version
+            self.local.clear()
+
+    def _on_listener_error(self, error, pubsub, thread):
+        # Messages may have been missed: stop using L1 until we resubscribe on the next read
+        logger.warning("L1 cache invalidation listener failed: %s", error, exc_info=error)
+        thread.stop()
+        pubsub.close()
+        self.local.clear()
+        self._listener = None
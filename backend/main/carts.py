@@ -0,0 +1,351 @@
+import logging
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from model import Cart, CartItem, Product, db
+
+logger = logging.getLogger(__name__)
+
+#Cart writes
+#Every write is an INSERT ... ON CONFLICT DO UPDATE, so concurrent adds for the
+#same user or product can neither lose an update nor trip the unique
+#constraints, and nothing is read back into Python first.
+
+
+def upsert(table, connection):
+    # INSERT that supports on_conflict_do_update on both Postgres and SQLite
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def cart_id_for(connection, user_id):
+    # Creates the user's cart if needed; DO UPDATE (not DO NOTHING) so RETURNING always yields the row
+    stmt = upsert(Cart.__table__, connection).values(user_id=user_id)
+    stmt = stmt.on_conflict_do_update(index_elements=['user_id'], set_={'updated_at': db.func.now()})
+    return connection.execute(stmt.returning(Cart.__table__.c.cart_id)).scalar_one()
+
+
+def apply_changes(connection, user_id, deltas, quantities=None):
+    # deltas: {product_id: change in quantity}, added to whatever is already in the cart.
+    # quantities: {product_id: quantity}, written outright, so a change that landed since the
+    # caller last read the cart is overwritten instead of being folded into a stale difference.
+    # One multi-row upsert for each; lines that drop to zero are deleted. The caller commits.
+    quantities = quantities or {}
+    cart_id = cart_id_for(connection, user_id)
+    table = CartItem.__table__
+    for changes, outright in ((deltas, False), (quantities, True)):
+        if not changes:
+            continue
+        stmt = upsert(table, connection).values([
+            {'cart_id': cart_id, 'product_id': product_id, 'quantity': quantity} for product_id, quantity in changes.items()
+        ])
+        quantity = stmt.excluded.quantity if outright else table.c.quantity + stmt.excluded.quantity
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['cart_id', 'product_id'],
+            set_={'quantity': quantity, 'updated_at': db.func.now()}
+        )
+        connection.execute(stmt)
+    if any(quantity <= 0 for quantity in [*deltas.values(), *quantities.values()]):
+        connection.execute(table.delete().where(table.c.cart_id == cart_id, table.c.quantity <= 0))
+
+
+def add_item(connection, user_id, product_id, quantity):
+    apply_changes(connection, user_id, {product_id: quantity})
+
+
+def cart_changes(operations):
+    # Folds add/set/remove operations into ({product_id: change}, {product_id: quantity}): lines only
+    # ever added to, and lines set outright (a remove sets 0, an add after a set adds to it).
+    # Raises ValueError for a malformed operation.
+    deltas, quantities = {}, {}
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError('Each operation must be an object')
+        op, product_id, quantity = operation.get('op'), operation.get('product_id'), operation.get('quantity', 1)
+        if not isinstance(product_id, int) or not isinstance(quantity, int) or quantity < 0:
+            raise ValueError('Each operation needs an integer product_id and a non-negative quantity')
+        if op == 'add':
+            if product_id in quantities:
+                quantities[product_id] += quantity
+            else:
+                deltas[product_id] = deltas.get(product_id, 0) + quantity
+        elif op == 'set':
+            deltas.pop(product_id, None)
+            quantities[product_id] = quantity
+        elif op == 'remove':
+            deltas.pop(product_id, None)
+            quantities[product_id] = 0
+        else:
+            raise ValueError(f'Unknown operation: {op}')
+    return {product_id: delta for product_id, delta in deltas.items() if delta}, quantities
+
+
+def cart_items(user_id):
+    # {product_id: quantity} as stored in the database
+    return dict(db.session.query(CartItem.product_id, CartItem.quantity)
+                .join(Cart, Cart.cart_id == CartItem.cart_id)
+                .filter(Cart.user_id == user_id))
+
+
+#Cart storage
+#CART_STORAGE picks where the live cart is kept. Both stores have the same
+#interface: add, apply, remove, clear, items and view.
+
+
+class DatabaseCartStore:
+    # Every mutation commits to the database straight away
+
+    def add(self, user_id, product_id, quantity):
+        self.apply(user_id, {product_id: quantity})
+
+    def apply(self, user_id, deltas, quantities=None):
+        apply_changes(db.session.connection(), user_id, deltas, quantities)
+        db.session.commit()
+
+    def remove(self, user_id, product_id):
+        # Returns the quantity removed, or None when the product was not in the cart
+        cart_item = CartItem.query.join(Cart, Cart.cart_id == CartItem.cart_id) \
+            .filter(Cart.user_id == user_id, CartItem.product_id == product_id).first()
+        if not cart_item:
+            return None
+        quantity = cart_item.quantity
+        db.session.delete(cart_item)
+        db.session.commit()
+        return quantity
+
+    def clear(self, user_id):
+        cart_id = db.session.query(Cart.cart_id).filter_by(user_id=user_id).scalar()
+        CartItem.query.filter_by(cart_id=cart_id).delete()
+        db.session.commit()
+
+    def items(self, user_id):
+        return cart_items(user_id)
+
+    def view(self, user_id):
+        # One joined query for the cart, its items and their product name/price. Returns (cart_id, items).
+        rows = db.session.query(
+            Cart.cart_id, CartItem.cart_item_id, CartItem.product_id, CartItem.quantity, Product.name, Product.price
+        ).join(CartItem, CartItem.cart_id == Cart.cart_id) \
+         .join(Product, Product.product_id == CartItem.product_id) \
+         .filter(Cart.user_id == user_id) \
+         .order_by(CartItem.cart_item_id).all()
+        return (rows[0].cart_id if rows else None), [{
+            'cart_item_id': row.cart_item_id,
+            'product_id': row.product_id,
+            'product_name': row.name,
+            'quantity': row.quantity,
+            'price': row.price,
+            'total_price': row.quantity * row.price
+        } for row in rows]
+
+
+#Redis-resident carts
+#The live cart is a Redis hash per user, cart:<user_id> = {product_id: quantity},
+#so every mutation is a single O(1) script call and nothing touches the
+#database on the request path. Changed user ids are collected in cart:dirty;
+#flush() writes those carts back to Cart/CartItem in batches (write-behind).
+#A batch is first moved to cart:flushing, and only removed from it once the
+#database commit succeeded, so a crashed flusher leaves it to be written on
+#the next run. Flushes write whole snapshots, so replaying one is harmless.
+#
+#A cart hash always carries a '_' marker field, so an emptied cart is still
+#told apart from one that was never loaded from the database.
+
+DIRTY_KEY = 'cart:dirty'
+FLUSHING_KEY = 'cart:flushing'
+LOADED_FIELD = '_'
+
+
+def cart_key(user_id):
+    return f'cart:{user_id}'
+
+
+# Seeds a cart from the database rows in ARGV[2..], unless it is already loaded
+_LOAD = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], '_', 1)
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Applies each (product_id, quantity, mode) triple in ARGV[3..]: mode 'set' writes the quantity
+# outright, anything else adds it. Returns 1, or -1 when the cart is not loaded yet
+_APPLY = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+for i = 3, #ARGV, 3 do
+    local quantity
+    if ARGV[i + 2] == 'set' then
+        quantity = tonumber(ARGV[i + 1])
+        redis.call('HSET', KEYS[1], ARGV[i], quantity)
+    else
+        quantity = redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    if quantity <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Returns the quantity removed (0 when the product was not in the cart), or -1 when the cart is not loaded yet
+_REMOVE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local quantity = redis.call('HGET', KEYS[1], ARGV[1])
+if not quantity then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[3])
+return tonumber(quantity)
+"""
+
+# Next batch of carts to write back: an unfinished batch first, otherwise everything dirty
+_TAKE_DIRTY = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return redis.call('SMEMBERS', KEYS[2])
+"""
+
+
+class RedisCartStore:
+    def __init__(self, redis_conn, ttl=7 * 86400):
+        self.redis_conn = redis_conn
+        # Idle carts leave Redis after this long; the flusher must run far more often
+        self.ttl = ttl
+        self._load = redis_conn.register_script(_LOAD)
+        self._apply = redis_conn.register_script(_APPLY)
+        self._remove = redis_conn.register_script(_REMOVE)
+        self._take_dirty = redis_conn.register_script(_TAKE_DIRTY)
+
+    def add(self, user_id, product_id, quantity):
+        self.apply(user_id, {product_id: quantity})
+
+    def apply(self, user_id, deltas, quantities=None):
+        args = [self.ttl, user_id]
+        for product_id, quantity in deltas.items():
+            args += [product_id, quantity, 'add']
+        for product_id, quantity in (quantities or {}).items():
+            args += [product_id, quantity, 'set']
+        self._loaded(user_id, lambda: self._apply(keys=[cart_key(user_id), DIRTY_KEY], args=args))
+
+    def remove(self, user_id, product_id):
+        quantity = self._loaded(user_id, lambda: self._remove(
+            keys=[cart_key(user_id), DIRTY_KEY], args=[product_id, self.ttl, user_id]))
+        return quantity or None
+
+    def clear(self, user_id):
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.delete(cart_key(user_id))
+        pipe.hset(cart_key(user_id), LOADED_FIELD, 1)
+        pipe.expire(cart_key(user_id), self.ttl)
+        pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+
+    def items(self, user_id):
+        fields = self.redis_conn.hgetall(cart_key(user_id))
+        if not fields:
+            self.load(user_id)
+            fields = self.redis_conn.hgetall(cart_key(user_id))
+        return {int(product_id): int(quantity) for product_id, quantity in fields.items()
+                if product_id != LOADED_FIELD.encode()}
+
+    def view(self, user_id):
+        # The items may not be in the database yet, so there are no cart or cart item ids
+        items = self.items(user_id)
+        rows = db.session.query(Product.product_id, Product.name, Product.price) \
+            .filter(Product.product_id.in_(items)).order_by(Product.product_id).all()
+        return None, [{
+            'product_id': row.product_id,
+            'product_name': row.name,
+            'quantity': items[row.product_id],
+            'price': row.price,
+            'total_price': items[row.product_id] * row.price
+        } for row in rows]
+
+    def load(self, user_id):
+        # First touch since the cart left Redis: seed it from the database
+        args = [self.ttl]
+        for product_id, quantity in cart_items(user_id).items():
+            args += [product_id, quantity]
+        self._load(keys=[cart_key(user_id)], args=args)
+
+    def flush(self, batch_size=500):
+        # Writes dirty carts back to the database; returns how many carts were written
+        flushed = 0
+        while True:
+            user_ids = [int(user_id) for user_id in self._take_dirty(keys=[DIRTY_KEY, FLUSHING_KEY])]
+            if not user_ids:
+                return flushed
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                try:
+                    self._write(batch)
+                except IntegrityError:
+                    # One bad cart (e.g. an unknown user) must not block the rest: retry them one by one.
+                    # Anything else (database down, crash) leaves the batch in cart:flushing for the next run.
+                    db.session.rollback()
+                    logger.warning("Cart flush batch failed, retrying carts one by one", exc_info=True)
+                    for user_id in batch:
+                        try:
+                            self._write([user_id])
+                        except IntegrityError:
+                            db.session.rollback()
+                            logger.exception("Dropping cart of user %s from write-behind", user_id)
+                self.redis_conn.srem(FLUSHING_KEY, *batch)
+                flushed += len(batch)
+
+    def _write(self, user_ids):
+        # Whole-cart snapshots for user_ids: one multi-row statement per step, one commit
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(cart_key(user_id))
+        carts = {}
+        for user_id, fields in zip(user_ids, pipe.execute()):
+            # An expired cart was written back long before it went idle
+            if fields:
+                carts[user_id] = {int(product_id): int(quantity) for product_id, quantity in fields.items()
+                                  if product_id != LOADED_FIELD.encode()}
+        if not carts:
+            return
+
+        connection = db.session.connection()
+        cart_table, item_table = Cart.__table__, CartItem.__table__
+        stmt = upsert(cart_table, connection).values([{'user_id': user_id} for user_id in carts])
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id'], set_={'updated_at': db.func.now()})
+        cart_ids = dict(connection.execute(stmt.returning(cart_table.c.user_id, cart_table.c.cart_id)).all())
+
+        rows = [{'cart_id': cart_ids[user_id], 'product_id': product_id, 'quantity': quantity}
+                for user_id, items in carts.items() for product_id, quantity in items.items()]
+        delete = item_table.delete().where(item_table.c.cart_id.in_(list(cart_ids.values())))
+        if rows:
+            delete = delete.where(db.tuple_(item_table.c.cart_id, item_table.c.product_id)
+                                  .not_in([(row['cart_id'], row['product_id']) for row in rows]))
+        connection.execute(delete)
+        if rows:
+            stmt = upsert(item_table, connection).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['cart_id', 'product_id'],
+                set_={'quantity': stmt.excluded.quantity, 'updated_at': db.func.now()}
+            )
+            connection.execute(stmt)
+        db.session.commit()
+
+    def _loaded(self, user_id, mutate):
+        result = mutate()
+        if result == -1:
+            self.load(user_id)
+            result = mutate()
+        return result
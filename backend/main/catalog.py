@@ -0,0 +1,85 @@
+import json
+from model import Product, db
+
+#Catalog read layer
+#Listing endpoints only need a handful of Product columns, so they select just
+#those columns as Row tuples instead of materializing full Product instances
+#(no identity map bookkeeping, no 500-char descriptions pulled for nothing).
+
+# Columns returned by the product listing endpoints
+LISTING_COLUMNS = (Product.product_id, Product.name, Product.price, Product.category, Product.image_url)
+# Search results also show the description
+SEARCH_COLUMNS = LISTING_COLUMNS + (Product.description,)
+# Product detail page. Stock changes with every sale, so it is not cached with the rest
+# of the page but read from the inventory when the page is served
+DETAIL_COLUMNS = SEARCH_COLUMNS
+
+
+def list_products(*criteria, columns=LISTING_COLUMNS):
+    # Rows go straight into plain dicts ready for the JSON serializer
+    query = db.session.query(*columns).filter(*criteria).order_by(Product.product_id)
+    return [row._asdict() for row in query]
+
+
+def product_detail(product_id, columns=DETAIL_COLUMNS):
+    row = db.session.query(*columns).filter(Product.product_id == product_id).first()
+    return row._asdict() if row else None
+
+
+def product_by_slug(slug, fallback_name, columns=LISTING_COLUMNS):
+    # Unique index lookup on the slug
+    row = db.session.query(*columns).filter(Product.slug == slug).first()
+    if row is None:
+        # Fall back to the old fuzzy name match for links that don't carry a known slug
+        row = db.session.query(*columns).filter(Product.name.ilike(f'%{fallback_name}%')) \
+            .order_by(Product.product_id).first()
+    return row._asdict() if row else None
+
+
+def list_products_page(*criteria, columns=LISTING_COLUMNS, after=0, limit=50):
+    # Keyset pagination on product_id: each page is an index range scan that
+    # costs the same however deep into the catalog it is
+    query = db.session.query(*columns).filter(Product.product_id > after, *criteria) \
+        .order_by(Product.product_id).limit(limit + 1)
+    items = [row._asdict() for row in query]
+    next_after = items[limit - 1]['product_id'] if len(items) > limit else None
+    return {'items': items[:limit], 'next_after': next_after}
+
+
+def products_by_ids(ids, columns=LISTING_COLUMNS, batch_size=500):
+    # Rows for the given ids, in the order of ids
+    products = []
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        rows = {row.product_id: row._asdict()
+                for row in db.session.query(*columns).filter(Product.product_id.in_(batch))}
+        products.extend(rows[product_id] for product_id in batch if product_id in rows)
+    return products
+
+
+def stream_products(*criteria, columns=LISTING_COLUMNS, batch_size=500):
+    # Yields a JSON array incrementally from a server-side cursor, so memory stays
+    # flat regardless of catalog size
+    query = db.session.query(*columns).filter(*criteria).order_by(Product.product_id).yield_per(batch_size)
+    return json_array(query, batch_size)
+
+
+def stream_products_by_ids(ids, columns=LISTING_COLUMNS, batch_size=500):
+    def rows():
+        for start in range(0, len(ids), batch_size):
+            yield from products_by_ids(ids[start:start + batch_size], columns, batch_size)
+    return json_array(rows(), batch_size)
+
+
+def json_array(rows, batch_size=500):
+    # Serializes rows (Row objects or dicts) into a JSON array, one chunk per batch
+    chunk = [b'[']
+    for i, row in enumerate(rows):
+        if i:
+            chunk.append(b',')
+        chunk.append(json.dumps(row if isinstance(row, dict) else row._asdict(), separators=(',', ':')).encode())
+        if len(chunk) >= 2 * batch_size:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(b']')
+    yield b''.join(chunk)
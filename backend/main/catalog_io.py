@@ -0,0 +1,158 @@
+import csv
+import io
+import json
+import math
+import time
+from datetime import datetime, timezone
+from model import Product, db, slugify
+
+#Bulk catalog import/export
+#Imports read CSV or JSONL as a stream, validate it in chunks and load each
+#valid chunk with one statement: COPY on Postgres, a multi-row executemany
+#elsewhere. Slugs are assigned here because the ORM slug events do not fire for
+#bulk inserts. Nothing is cached or indexed per row: the caller invalidates the
+#catalog once at the end. Exports stream rows from a server-side cursor, so
+#neither direction ever holds the whole catalog in memory.
+
+EXPORT_COLUMNS = (Product.product_id, Product.name, Product.description, Product.price, Product.category,
+                  Product.image_url, Product.stock_quantity, Product.slug)
+FORMATS = ('csv', 'jsonl')
+# Rejected rows are counted; only this many are reported back
+MAX_REPORTED_ERRORS = 50
+
+
+def parse_rows(stream, fmt):
+    # Yields (line number, dict) from a binary stream
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(text, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+
+
+def validate_row(row):
+    # Returns (values, None) or (None, error message)
+    if not isinstance(row, dict):
+        return None, 'not a JSON object'
+    values = {}
+    for field, limit in (('name', 100), ('description', 500), ('category', 100), ('image_url', 200)):
+        value = row.get(field)
+        value = str(value).strip() if value not in (None, '') else None
+        if value and len(value) > limit:
+            return None, f'{field} is longer than {limit} characters'
+        values[field] = value
+    if not values['name']:
+        return None, 'name is required'
+    try:
+        values['price'] = float(row.get('price'))
+    except (TypeError, ValueError):
+        return None, 'price must be a number'
+    # float() accepts 'nan' and 'inf', which no comparison below would catch
+    if not math.isfinite(values['price']):
+        return None, 'price must be a finite number'
+    try:
+        values['stock_quantity'] = int(row.get('stock_quantity') or 0)
+    except (TypeError, ValueError):
+        return None, 'stock_quantity must be an integer'
+    if values['price'] < 0 or values['stock_quantity'] < 0:
+        return None, 'price and stock_quantity must not be negative'
+    return values, None
+
+
+class SlugAllocator:
+    # Unique slugs for a whole import, checked against the existing catalog in one streamed pass
+    def __init__(self, connection):
+        self.taken = set(connection.execute(
+            db.select(Product.slug).where(Product.slug.is_not(None)).execution_options(yield_per=5000)
+        ).scalars())
+
+    def allocate(self, name):
+        base = slugify(name)
+        slug, suffix = base, 2
+        while slug in self.taken:
+            slug, suffix = f'{base}-{suffix}', suffix + 1
+        self.taken.add(slug)
+        return slug
+
+
+def copy_rows(connection, rows):
+    # Postgres COPY ... FROM STDIN, fed from an in-memory CSV of one chunk
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([r'\N' if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY product ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(connection, rows):
+    if connection.dialect.name == 'postgresql':
+        copy_rows(connection, rows)
+    else:
+        connection.execute(Product.__table__.insert(), rows)
+
+
+def import_products(stream, fmt, chunk_size=1000):
+    # Loads products from a CSV/JSONL stream, committing each chunk.
+    # Returns a report: rows read, imported, rejected (with the first errors), seconds and rows per second.
+    start = time.monotonic()
+    report = {'read': 0, 'imported': 0, 'rejected': 0, 'errors': []}
+    slugs = SlugAllocator(db.session.connection())
+    chunk = []
+
+    def flush():
+        if chunk:
+            insert_rows(db.session.connection(), chunk)
+            db.session.commit()
+            report['imported'] += len(chunk)
+            chunk.clear()
+
+    for line_number, row in parse_rows(stream, fmt):
+        report['read'] += 1
+        values, error = validate_row(row)
+        if error:
+            report['rejected'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': line_number, 'error': error})
+            continue
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        values.update(slug=slugs.allocate(values['name']), created_at=now, updated_at=now)
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+
+    report['seconds'] = round(time.monotonic() - start, 3)
+    report['rows_per_second'] = round(report['imported'] / report['seconds']) if report['seconds'] else report['imported']
+    return report
+
+
+def export_products(fmt, batch_size=1000):
+    # Yields the catalog as CSV or JSONL, one chunk per batch of rows
+    rows = db.session.query(*EXPORT_COLUMNS).order_by(Product.product_id).yield_per(batch_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow([column.key for column in EXPORT_COLUMNS])
+    for i, row in enumerate(rows, 1):
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row._asdict(), separators=(',', ':')) + '\n')
+        if i % batch_size == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
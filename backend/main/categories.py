@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+from model import Product, db, slugify
+from catalog import LISTING_COLUMNS
+from cache import CATALOG_VERSION_KEY
+
+#Category listings
+#All category partitions are built from one query over the catalog, ordered by
+#category, and cached per catalog version: in Redis as one hash field per
+#category (catalog:v<version>:category_partitions:by_slug), and as decoded lists
+#in this process for the categories it has served. A listing only ever reads
+#and decodes its own category. Sorting, price filters and pagination then run
+#over the in-memory partition instead of going back to Postgres.
+
+PARTITIONS_NAME = 'category_partitions:by_slug'
+BUILT_FIELD = '_'    # set once every partition of the version is written
+
+# Reads the catalog version and one category of that version's partitions in a single round trip
+_GET_PARTITION = """
+local version = redis.call('GET', KEYS[1]) or '0'
+local key = 'catalog:v' .. version .. ':' .. ARGV[1]
+return {version, redis.call('HGET', key, '_'), redis.call('HGET', key, ARGV[2])}
+"""
+
+# Supported ?sort= values
+SORTS = {
+    'default': (lambda product: product['product_id'], False),
+    'price_asc': (lambda product: (product['price'], product['product_id']), False),
+    'price_desc': (lambda product: (product['price'], product['product_id']), True),
+    'name': (lambda product: (product['name'].lower(), product['product_id']), False),
+    'newest': (lambda product: product['product_id'], True),
+}
+
+
+def load_partitions():
+    partitions = {}
+    for row in db.session.query(*LISTING_COLUMNS).order_by(Product.category, Product.product_id):
+        if row.category:
+            partitions.setdefault(slugify(row.category), []).append(row._asdict())
+    return partitions
+
+
+class CategoryEngine:
+    def __init__(self, catalog_cache):
+        self.catalog_cache = catalog_cache
+        self.redis_conn = catalog_cache.redis_conn
+        self._get_partition = self.redis_conn.register_script(_GET_PARTITION)
+        # (catalog version, {slug: products}) for the categories served in this process
+        self._partitions = (None, {})
+        self._lock = threading.Lock()
+
+    def partition(self, slug):
+        # The products of one category, in product id order
+        version = self.catalog_cache.version()
+        with self._lock:
+            if self._partitions[0] == version and slug in self._partitions[1]:
+                return self._partitions[1][slug]
+        version, built, body = self._get_partition(keys=[CATALOG_VERSION_KEY], args=[PARTITIONS_NAME, slug])
+        version = int(version)
+        products = (json.loads(body) if body else []) if built else self._build(version, slug)
+        with self._lock:
+            if self._partitions[0] is None or version > self._partitions[0]:
+                self._partitions = (version, {})
+            if version == self._partitions[0]:
+                self._partitions[1][slug] = products
+        return products
+
+    def clear(self):
+        # Drops the partitions kept in this process, e.g. after Redis was flushed
+        with self._lock:
+            self._partitions = (None, {})
+
+    def _build(self, version, slug):
+        # Writes every partition of the version from one query. Only one worker builds a
+        # version; the others wait for its hash instead of repeating the query.
+        key = self.catalog_cache.key(PARTITIONS_NAME, version)
+        lock_key = key + ':lock'
+        lock_timeout = self.catalog_cache.lock_timeout
+        if not self.redis_conn.set(lock_key, 1, nx=True, ex=lock_timeout):
+            deadline = time.monotonic() + lock_timeout
+            while time.monotonic() < deadline and self.redis_conn.exists(lock_key):
+                time.sleep(0.05)
+                built, body = self.redis_conn.hmget(key, BUILT_FIELD, slug)
+                if built:
+                    return json.loads(body) if body else []
+
+        partitions = load_partitions()
+        mapping = {category: json.dumps(products, separators=(',', ':')) for category, products in partitions.items()}
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(key, mapping={**mapping, BUILT_FIELD: 1})
+        pipe.expire(key, self.catalog_cache.ttl + self.catalog_cache.stale_ttl)
+        pipe.delete(lock_key)
+        pipe.execute()
+        return partitions.get(slug, [])
+
+    def listing(self, slug, sort='default', min_price=None, max_price=None, page=None):
+        # page is None for the whole listing, or (after, limit) for keyset pagination
+        products = self.partition(slug)
+        if min_price is not None:
+            products = [product for product in products if product['price'] >= min_price]
+        if max_price is not None:
+            products = [product for product in products if product['price'] <= max_price]
+        key, reverse = SORTS[sort]
+        if sort != 'default':
+            products = sorted(products, key=key, reverse=reverse)
+        if page is None:
+            return products
+
+        # The cursor is the id of the last product seen, in the requested order
+        after, limit = page
+        ids = [product['product_id'] for product in products]
+        if not after:
+            start = 0
+        elif after in ids:
+            start = ids.index(after) + 1
+        else:
+            # The cursor's product left the listing (deleted, recategorised or filtered out): end the
+            # listing rather than start over, so clients never loop over the same pages
+            return {'items': [], 'next_after': None}
+        items = products[start:start + limit]
+        next_after = items[-1]['product_id'] if start + limit < len(products) else None
+        return {'items': items, 'next_after': next_after}
@@ -0,0 +1,177 @@
+import bisect
+import time
+import uuid
+from model import Product, db, slugify
+from catalog import products_by_ids
+
+#Faceted filtering
+#Redis keeps one set of product ids per facet value (category, price bucket,
+#in stock), maintained incrementally by the product write endpoints. A filter
+#request intersects the selected sets server-side, and every facet count is one
+#more SINTERSTORE in the same pipeline, so no GROUP BY runs per request.
+#Counts follow the usual disjunctive rule: the count for a category applies
+#every filter except the category filter itself, and likewise for price.
+
+ALL_KEY = 'catalog:facet:all'
+IN_STOCK_KEY = 'catalog:facet:in_stock'
+CATEGORIES_KEY = 'catalog:facet:categories'
+CATEGORY_LABELS_KEY = 'catalog:facet:category_labels'
+BUILT_KEY = 'catalog:facet:built'
+BUILD_LOCK_KEY = 'catalog:facet:lock'
+
+# Upper bounds of the price buckets; the last bucket is open-ended
+PRICE_BOUNDARIES = (10, 20, 50, 100)
+
+
+def category_key(slug):
+    return f'catalog:facet:category:{slug}'
+
+
+def price_key(bucket):
+    return f'catalog:facet:price:{bucket}'
+
+
+def product_key(product_id):
+    # Which facet values a product is currently filed under, so updates can remove them
+    return f'catalog:facet:product:{product_id}'
+
+
+def price_buckets():
+    lower = 0
+    buckets = []
+    for upper in PRICE_BOUNDARIES:
+        buckets.append(f'{lower}-{upper}')
+        lower = upper
+    buckets.append(f'{lower}+')
+    return buckets
+
+
+def price_bucket(price):
+    lower = 0
+    for upper in PRICE_BOUNDARIES:
+        if price < upper:
+            return f'{lower}-{upper}'
+        lower = upper
+    return f'{lower}+'
+
+
+class FacetIndexUnavailable(Exception):
+    # The index has not been built yet and another worker is still building it
+    pass
+
+
+class FacetIndex:
+    def __init__(self, redis_conn, build_wait=5.0):
+        self.redis_conn = redis_conn
+        self.build_wait = build_wait
+
+    def index_product(self, product_id, category, price, stock_quantity):
+        old = self.redis_conn.hgetall(product_key(product_id))
+        pipe = self.redis_conn.pipeline(transaction=True)
+        self._unfile(pipe, product_id, old)
+        self._file(pipe, product_id, category, price, stock_quantity)
+        pipe.execute()
+
+    def remove_product(self, product_id):
+        old = self.redis_conn.hgetall(product_key(product_id))
+        pipe = self.redis_conn.pipeline(transaction=True)
+        self._unfile(pipe, product_id, old)
+        pipe.srem(ALL_KEY, product_id)
+        pipe.delete(product_key(product_id))
+        pipe.execute()
+
+    def rebuild(self):
+        # Full rebuild from one catalog query, applied atomically. Only one worker builds at a time:
+        # returns False without building when another one holds the lock.
+        if not self.redis_conn.set(BUILD_LOCK_KEY, 1, nx=True, ex=60):
+            return False
+        try:
+            old_categories = self.redis_conn.smembers(CATEGORIES_KEY)
+            pipe = self.redis_conn.pipeline(transaction=True)
+            pipe.delete(ALL_KEY, IN_STOCK_KEY, CATEGORIES_KEY, CATEGORY_LABELS_KEY,
+                        *[category_key(slug.decode()) for slug in old_categories],
+                        *[price_key(bucket) for bucket in price_buckets()])
+            rows = db.session.query(Product.product_id, Product.category, Product.price, Product.stock_quantity)
+            for product_id, category, price, stock_quantity in rows:
+                self._file(pipe, product_id, category, price, stock_quantity)
+            pipe.set(BUILT_KEY, 1)
+            pipe.execute()
+        finally:
+            self.redis_conn.delete(BUILD_LOCK_KEY)
+        return True
+
+    def ensure_built(self):
+        # Builds the index or waits up to build_wait seconds for the worker building it. Raises
+        # FacetIndexUnavailable rather than let a filter run against empty sets.
+        deadline = time.monotonic() + self.build_wait
+        while not self.redis_conn.exists(BUILT_KEY):
+            if self.rebuild():
+                return
+            if time.monotonic() >= deadline:
+                raise FacetIndexUnavailable()
+            time.sleep(0.05)
+
+    def filter(self, categories=(), buckets=(), in_stock=False):
+        # Returns (sorted matching product ids, facet counts)
+        self.ensure_built()
+        all_categories = sorted(slug.decode() for slug in self.redis_conn.smembers(CATEGORIES_KEY))
+        all_buckets = price_buckets()
+
+        tmp = f'catalog:facet:tmp:{uuid.uuid4().hex}'
+        category_filter, price_filter, stock_filter = f'{tmp}:category', f'{tmp}:price', f'{tmp}:stock'
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.sunionstore(category_filter, [category_key(slug) for slug in categories] if categories else [ALL_KEY])
+        pipe.sunionstore(price_filter, [price_key(bucket) for bucket in buckets] if buckets else [ALL_KEY])
+        pipe.sunionstore(stock_filter, [IN_STOCK_KEY] if in_stock else [ALL_KEY])
+        pipe.sinterstore(f'{tmp}:result', [category_filter, price_filter, stock_filter])
+        pipe.smembers(f'{tmp}:result')
+        for slug in all_categories:
+            pipe.sinterstore(f'{tmp}:count', [category_key(slug), price_filter, stock_filter])
+        for bucket in all_buckets:
+            pipe.sinterstore(f'{tmp}:count', [price_key(bucket), category_filter, stock_filter])
+        pipe.sinterstore(f'{tmp}:count', [IN_STOCK_KEY, category_filter, price_filter])
+        pipe.hgetall(CATEGORY_LABELS_KEY)
+        pipe.delete(category_filter, price_filter, stock_filter, f'{tmp}:result', f'{tmp}:count')
+        results = pipe.execute()
+
+        ids = sorted(int(product_id) for product_id in results[4])
+        category_counts = results[5:5 + len(all_categories)]
+        bucket_counts = results[5 + len(all_categories):5 + len(all_categories) + len(all_buckets)]
+        in_stock_count = results[-3]
+        labels = {slug.decode(): label.decode() for slug, label in results[-2].items()}
+        facets = {
+            'category': [{'slug': slug, 'name': labels.get(slug, slug), 'count': count}
+                         for slug, count in zip(all_categories, category_counts) if count],
+            'price': [{'bucket': bucket, 'count': count} for bucket, count in zip(all_buckets, bucket_counts)],
+            'in_stock': in_stock_count
+        }
+        return ids, facets
+
+    def filter_page(self, categories=(), buckets=(), in_stock=False, after=0, limit=50):
+        # Matching ids are sorted, so the keyset cursor is the last product_id seen
+        ids, facets = self.filter(categories, buckets, in_stock)
+        start = bisect.bisect_right(ids, after)
+        page = ids[start:start + limit]
+        next_after = page[-1] if start + limit < len(ids) else None
+        return {'items': products_by_ids(page), 'next_after': next_after, 'total': len(ids), 'facets': facets}
+
+    def _file(self, pipe, product_id, category, price, stock_quantity):
+        mapping = {'bucket': price_bucket(price or 0), 'in_stock': int((stock_quantity or 0) > 0)}
+        pipe.sadd(ALL_KEY, product_id)
+        pipe.sadd(price_key(mapping['bucket']), product_id)
+        if mapping['in_stock']:
+            pipe.sadd(IN_STOCK_KEY, product_id)
+        if category:
+            mapping['category'] = slugify(category)
+            pipe.sadd(category_key(mapping['category']), product_id)
+            pipe.sadd(CATEGORIES_KEY, mapping['category'])
+            pipe.hset(CATEGORY_LABELS_KEY, mapping['category'], category)
+        pipe.delete(product_key(product_id))
+        pipe.hset(product_key(product_id), mapping=mapping)
+
+    def _unfile(self, pipe, product_id, old):
+        if b'bucket' in old:
+            pipe.srem(price_key(old[b'bucket'].decode()), product_id)
+        if b'category' in old:
+            pipe.srem(category_key(old[b'category'].decode()), product_id)
+        pipe.srem(IN_STOCK_KEY, product_id)
@@ -0,0 +1,50 @@
+import json
+from collections import namedtuple
+from model import User, db
+
+#Identity resolution
+#Most endpoints are keyed by email but only need the user's id (and, for
+#emails, their name). Identities caches exactly that under identity:<email>,
+#so those endpoints skip the users table entirely on a hit; unknown emails are
+#cached too, for a shorter time, so that repeated lookups of a missing user do
+#not reach Postgres either. Entries filled by a read are written with NX, so a
+#read that raced with a registration or profile change cannot overwrite what
+#that write stored.
+
+Identity = namedtuple('Identity', ['user_id', 'name'])
+
+# Stored for emails that have no user
+_MISSING = b'{}'
+
+
+def identity_key(email):
+    return f'identity:{email}'
+
+
+class Identities:
+    def __init__(self, redis_conn, ttl=3600, negative_ttl=60):
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, email):
+        # The user's Identity, or None if there is no such user
+        if not email:
+            return None
+        cached = self.redis_conn.get(identity_key(email))
+        if cached is not None:
+            return Identity(**json.loads(cached)) if cached != _MISSING else None
+        row = db.session.query(User.user_id, User.name).filter_by(email=email).first()
+        if row is None:
+            self.redis_conn.set(identity_key(email), _MISSING, ex=self.negative_ttl, nx=True)
+            return None
+        identity = Identity(row.user_id, row.name)
+        self.redis_conn.set(identity_key(email), self._dump(identity), ex=self.ttl, nx=True)
+        return identity
+
+    def store(self, email, user_id, name):
+        # After a registration or profile change; replaces whatever is cached, including a miss
+        self.redis_conn.set(identity_key(email), self._dump(Identity(user_id, name)), ex=self.ttl)
+
+    def _dump(self, identity):
+        return json.dumps(identity._asdict(), separators=(',', ':'))
@@ -0,0 +1,330 @@
+import time
+import uuid
+from model import Product, StockReconciliation, db
+
+#Stock reservations
+#Available stock for each product lives in Redis (inventory:stock:<id>) and is
+#only ever changed by Lua scripts, so a reservation is one atomic
+#check-and-decrement no matter how many buyers race for the same SKU. Adding
+#to the cart holds stock for hold_ttl seconds; holds that run out are handed
+#back by release_expired(). Checkout turns holds into sales, which are
+#collected in inventory:sold and written back to Product.stock_quantity in
+#batches by reconcile(), so Postgres sees one UPDATE per product per batch
+#instead of one locked row update per buyer. Each batch gets an id that is
+#recorded in stock_reconciliation in the same transaction as its UPDATEs, so a
+#batch left in Redis by a run that died after committing is never applied twice.
+#
+#Invariant: available = Product.stock_quantity - held - sold not yet reconciled
+
+HOLDS_KEY = 'inventory:holds'            # "<user_id>:<product_id>" -> quantity held
+HELD_KEY = 'inventory:held'              # product_id -> total quantity held
+EXPIRY_KEY = 'inventory:expiry'          # "<user_id>:<product_id>" scored by hold expiry time
+SOLD_KEY = 'inventory:sold'              # product_id -> quantity sold, not yet reconciled
+RECONCILING_KEY = 'inventory:sold:reconciling'
+RECONCILING_BATCH_KEY = 'inventory:sold:reconciling:batch'   # id of the batch in RECONCILING_KEY
+
+
+def stock_key(product_id):
+    return f'inventory:stock:{product_id}'
+
+
+def hold_member(user_id, product_id):
+    return f'{user_id}:{product_id}'
+
+
+def checkout_lock_key(user_id):
+    return f'inventory:checkout:{user_id}'
+
+
+# Sets the available stock from the database quantity. With ARGV[3] == 'nx' an existing value is kept.
+_SET_STOCK = """
+if ARGV[3] == 'nx' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return tonumber(redis.call('GET', KEYS[1]))
+end
+local available = tonumber(ARGV[2])
+    - tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+    - tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+    - tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or '0')
+if available < 0 then
+    available = 0
+end
+redis.call('SET', KEYS[1], available)
+return available
+"""
+
+# Returns 1 when the stock was held, 0 when there is not enough, -1 when the product is not loaded yet.
+# Quantities that are not positive integers are never held, so no caller can add stock this way.
+_RESERVE = """
+local quantity = tonumber(ARGV[3])
+if not quantity or quantity <= 0 or quantity ~= math.floor(quantity) then
+    return 0
+end
+local stock = redis.call('GET', KEYS[1])
+if not stock then
+    return -1
+end
+if tonumber(stock) < quantity then
+    return 0
+end
+redis.call('DECRBY', KEYS[1], quantity)
+redis.call('HINCRBY', KEYS[2], ARGV[2], quantity)
+redis.call('HINCRBY', KEYS[3], ARGV[1], quantity)
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[2])
+return 1
+"""
+
+# Hands back some (ARGV[3]) or all (ARGV[3] == '') of a hold; returns the quantity released
+_RELEASE = """
+local held = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or '0')
+local quantity = held
+if ARGV[3] ~= '' then
+    local requested = tonumber(ARGV[3])
+    if not requested or requested <= 0 or requested ~= math.floor(requested) then
+        return 0
+    end
+    quantity = math.min(held, requested)
+end
+if quantity <= 0 then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], quantity)
+end
+if quantity == held then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    redis.call('ZREM', KEYS[4], ARGV[2])
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[2], -quantity)
+end
+redis.call('HINCRBY', KEYS[3], ARGV[1], -quantity)
+return quantity
+"""
+
+# Releases up to ARGV[2] holds that expired before ARGV[1]; returns how many were released.
+# Stock keys are derived from the hold member, so this expects a single Redis node.
+_RELEASE_EXPIRED = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(members) do
+    local product_id = string.match(member, ':(%d+)$')
+    local quantity = tonumber(redis.call('HGET', KEYS[1], member) or '0')
+    local stock = 'inventory:stock:' .. product_id
+    if quantity > 0 and redis.call('EXISTS', stock) == 1 then
+        redis.call('INCRBY', stock, quantity)
+    end
+    redis.call('HDEL', KEYS[1], member)
+    redis.call('HINCRBY', KEYS[2], product_id, -quantity)
+    redis.call('ZREM', KEYS[3], member)
+end
+return #members
+"""
+
+# Converts a user's holds into sales for every (product_id, quantity) pair in ARGV[2..], taking
+# any quantity not already held from the available stock. All or nothing: returns 0 on success,
+# otherwise the id of the first product that is short (or not loaded, as a negative id).
+_CHECKOUT = """
+local needs = {}
+for n = 1, (#ARGV - 1) / 2 do
+    local product_id = ARGV[2 * n]
+    local held = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':' .. product_id) or '0')
+    local stock = redis.call('GET', KEYS[4 + n])
+    if not stock then
+        return -tonumber(product_id)
+    end
+    needs[n] = tonumber(ARGV[2 * n + 1]) - held
+    if needs[n] > tonumber(stock) then
+        return tonumber(product_id)
+    end
+end
+for n = 1, (#ARGV - 1) / 2 do
+    local product_id = ARGV[2 * n]
+    local member = ARGV[1] .. ':' .. product_id
+    local held = tonumber(redis.call('HGET', KEYS[1], member) or '0')
+    redis.call('DECRBY', KEYS[4 + n], needs[n])
+    redis.call('HDEL', KEYS[1], member)
+    redis.call('ZREM', KEYS[3], member)
+    redis.call('HINCRBY', KEYS[2], product_id, -held)
+    redis.call('HINCRBY', KEYS[4], product_id, ARGV[2 * n + 1])
+end
+return 0
+"""
+
+# Holds every (product_id, quantity) pair in ARGV[3..] for user ARGV[1] until ARGV[2], all or nothing.
+# Returns 0 on success, otherwise the id of the first product that is short (negative if not loaded).
+# A quantity that is not a positive integer counts as short.
+_RESERVE_MANY = """
+for n = 1, (#ARGV - 2) / 2 do
+    local quantity = tonumber(ARGV[2 * n + 2])
+    if not quantity or quantity <= 0 or quantity ~= math.floor(quantity) then
+        return tonumber(ARGV[2 * n + 1])
+    end
+    local stock = redis.call('GET', KEYS[3 + n])
+    if not stock then
+        return -tonumber(ARGV[2 * n + 1])
+    end
+    if tonumber(ARGV[2 * n + 2]) > tonumber(stock) then
+        return tonumber(ARGV[2 * n + 1])
+    end
+end
+for n = 1, (#ARGV - 2) / 2 do
+    local product_id, quantity = ARGV[2 * n + 1], ARGV[2 * n + 2]
+    local member = ARGV[1] .. ':' .. product_id
+    redis.call('DECRBY', KEYS[3 + n], quantity)
+    redis.call('HINCRBY', KEYS[1], member, quantity)
+    redis.call('HINCRBY', KEYS[2], product_id, quantity)
+    redis.call('ZADD', KEYS[3], ARGV[2], member)
+end
+return 0
+"""
+
+# Deletes a checkout lock only if we still own it
+_UNLOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Moves the sold counters aside for reconciliation, unless a previous batch is still unfinished
+_TAKE_SOLD = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return {'', {}}
+end
+redis.call('SET', KEYS[3], ARGV[1], 'NX')
+return {redis.call('GET', KEYS[3]), redis.call('HGETALL', KEYS[2])}
+"""
+
+
+class Inventory:
+    def __init__(self, redis_conn, hold_ttl=900):
+        self.redis_conn = redis_conn
+        self.hold_ttl = hold_ttl
+        self._set_stock = redis_conn.register_script(_SET_STOCK)
+        self._reserve = redis_conn.register_script(_RESERVE)
+        self._reserve_many = redis_conn.register_script(_RESERVE_MANY)
+        self._release = redis_conn.register_script(_RELEASE)
+        self._release_expired = redis_conn.register_script(_RELEASE_EXPIRED)
+        self._checkout = redis_conn.register_script(_CHECKOUT)
+        self._take_sold = redis_conn.register_script(_TAKE_SOLD)
+        self._unlock = redis_conn.register_script(_UNLOCK)
+
+    def available(self, product_id):
+        self.load([product_id])
+        stock = self.redis_conn.get(stock_key(product_id))
+        return int(stock) if stock is not None else None
+
+    def load(self, product_ids):
+        # Loads the available stock of products Redis does not know about yet, in one query
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipe.exists(stock_key(product_id))
+        missing = [product_id for product_id, exists in zip(product_ids, pipe.execute()) if not exists]
+        if not missing:
+            return
+        rows = db.session.query(Product.product_id, Product.stock_quantity).filter(Product.product_id.in_(missing))
+        for product_id, stock_quantity in rows:
+            self._apply_stock(product_id, stock_quantity, nx=True)
+
+    def restock(self, product_id, stock_quantity):
+        # The database quantity was set outright (e.g. by an admin): recompute what is available
+        self._apply_stock(product_id, stock_quantity, nx=False)
+
+    def forget(self, product_id):
+        self.redis_conn.delete(stock_key(product_id))
+
+    def reserve(self, user_id, product_id, quantity):
+        # Holds quantity for the user; False when there is not enough stock (or no such product)
+        keys = [stock_key(product_id), HOLDS_KEY, HELD_KEY, EXPIRY_KEY]
+        args = [product_id, hold_member(user_id, product_id), quantity, time.time() + self.hold_ttl]
+        result = self._reserve(keys=keys, args=args)
+        if result == -1:
+            self.load([product_id])
+            result = self._reserve(keys=keys, args=args)
+        return result == 1
+
+    def release(self, user_id, product_id, quantity=None):
+        keys = [stock_key(product_id), HOLDS_KEY, HELD_KEY, EXPIRY_KEY]
+        args = [product_id, hold_member(user_id, product_id), '' if quantity is None else quantity]
+        return self._release(keys=keys, args=args)
+
+    def reserve_many(self, user_id, items):
+        # items: {product_id: quantity}, held all or nothing. Returns None on success,
+        # else the id of a product that is short (or does not exist)
+        product_ids = sorted(items)
+        if not product_ids:
+            return None
+        self.load(product_ids)
+        keys = [HOLDS_KEY, HELD_KEY, EXPIRY_KEY] + [stock_key(product_id) for product_id in product_ids]
+        args = [user_id, time.time() + self.hold_ttl]
+        for product_id in product_ids:
+            args += [product_id, items[product_id]]
+        result = self._reserve_many(keys=keys, args=args)
+        return abs(result) if result else None
+
+    def release_many(self, user_id, items):
+        # items: {product_id: quantity}, released in one round trip
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for product_id, quantity in items.items():
+            keys = [stock_key(product_id), HOLDS_KEY, HELD_KEY, EXPIRY_KEY]
+            self._release(keys=keys, args=[product_id, hold_member(user_id, product_id), quantity], client=pipe)
+        pipe.execute()
+
+    def release_expired(self, limit=500):
+        # Hands expired holds back to the available stock; returns how many holds were released
+        released = 0
+        while True:
+            count = self._release_expired(keys=[HOLDS_KEY, HELD_KEY, EXPIRY_KEY], args=[time.time(), limit])
+            released += count
+            if count < limit:
+                return released
+
+    def lock_checkout(self, user_id, timeout=30):
+        # One checkout per user at a time, so a double submit cannot sell the same cart twice.
+        # Returns the lock token, or None while another checkout for the user is running.
+        token = uuid.uuid4().hex
+        return token if self.redis_conn.set(checkout_lock_key(user_id), token, nx=True, ex=timeout) else None
+
+    def unlock_checkout(self, user_id, token):
+        self._unlock(keys=[checkout_lock_key(user_id)], args=[token])
+
+    def checkout(self, user_id, items):
+        # items: {product_id: quantity}. Returns None on success, else the id of a product that is short
+        product_ids = sorted(items)
+        self.load(product_ids)
+        keys = [HOLDS_KEY, HELD_KEY, EXPIRY_KEY, SOLD_KEY] + [stock_key(product_id) for product_id in product_ids]
+        args = [user_id]
+        for product_id in product_ids:
+            args += [product_id, items[product_id]]
+        result = self._checkout(keys=keys, args=args)
+        return abs(result) if result else None
+
+    def reconcile(self):
+        # Writes the sales collected since the last run back to the database in one transaction.
+        # Returns {product_id: quantity} for the batch that was taken.
+        batch_id, fields = self._take_sold(keys=[SOLD_KEY, RECONCILING_KEY, RECONCILING_BATCH_KEY],
+                                           args=[uuid.uuid4().hex])
+        batch_id = batch_id.decode()
+        sold = {int(product_id): int(quantity) for product_id, quantity in zip(fields[::2], fields[1::2])
+                if int(quantity)}
+        # A batch already recorded was committed by a run that died before clearing Redis.
+        # Two runs racing on the same batch both insert its id, so only one can commit.
+        if sold and db.session.get(StockReconciliation, batch_id) is None:
+            db.session.add(StockReconciliation(batch_id=batch_id))
+            db.session.flush()
+            # One executemany UPDATE for the whole batch
+            product = Product.__table__
+            db.session.connection().execute(
+                product.update()
+                .where(product.c.product_id == db.bindparam('pid'))
+                .values(stock_quantity=product.c.stock_quantity - db.bindparam('quantity')),
+                [{'pid': product_id, 'quantity': quantity} for product_id, quantity in sold.items()]
+            )
+            db.session.commit()
+        self.redis_conn.delete(RECONCILING_KEY, RECONCILING_BATCH_KEY)
+        return sold
+
+    def _apply_stock(self, product_id, stock_quantity, nx):
+        keys = [stock_key(product_id), HELD_KEY, SOLD_KEY, RECONCILING_KEY]
+        self._set_stock(keys=keys, args=[product_id, stock_quantity or 0, 'nx' if nx else ''])
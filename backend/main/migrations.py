@@ -0,0 +1,94 @@
+from model import db
+
+#Schema migrations
+#create_all() only creates missing tables; it never adds columns or indexes to
+#tables that already exist. Migrations cover that gap: each one runs once, in
+#its own transaction, and is recorded in the schema_migrations table. They are
+#written to be safe on a fresh database where create_all() already built
+#everything, so upgrade() can always run create_all() first.
+
+MIGRATIONS = []
+
+schema_migrations = db.Table(
+    'schema_migrations', db.metadata,
+    db.Column('version', db.String(100), primary_key=True),
+    db.Column('applied_at', db.DateTime, default=db.func.now()),
+)
+
+
+def migration(version):
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+
+def create_missing_indexes(connection, *table_names):
+    # Creates the indexes declared in model.py that the database does not have yet
+    for table_name in table_names:
+        for index in db.metadata.tables[table_name].indexes:
+            index.create(connection, checkfirst=True)
+
+
+@migration('0001_product_slug')
+def add_product_slug(connection):
+    columns = [column['name'] for column in db.inspect(connection).get_columns('product')]
+    if 'slug' not in columns:
+        connection.execute(db.text('ALTER TABLE product ADD COLUMN slug VARCHAR(120)'))
+    create_missing_indexes(connection, 'product')
+
+
+@migration('0002_hot_lookup_indexes')
+def add_hot_lookup_indexes(connection):
+    # The unique (cart_id, product_id) index needs duplicate cart lines merged first
+    duplicates = connection.execute(db.text(
+        'SELECT cart_id, product_id, MIN(cart_item_id), SUM(quantity) FROM cart_item '
+        'GROUP BY cart_id, product_id HAVING COUNT(*) > 1'
+    )).all()
+    for cart_id, product_id, keep_id, quantity in duplicates:
+        connection.execute(db.text(
+            'DELETE FROM cart_item WHERE cart_id = :cart_id AND product_id = :product_id AND cart_item_id <> :keep_id'
+        ), {'cart_id': cart_id, 'product_id': product_id, 'keep_id': keep_id})
+        connection.execute(db.text(
+            'UPDATE cart_item SET quantity = :quantity WHERE cart_item_id = :keep_id'
+        ), {'quantity': quantity, 'keep_id': keep_id})
+    create_missing_indexes(connection, 'product', 'subscription', 'chat_message', 'cart_item',
+                           'best_seller', 'recommendation')
+
+
+@migration('0003_recommendation_score')
+def add_recommendation_score(connection):
+    columns = [column['name'] for column in db.inspect(connection).get_columns('recommendation')]
+    if 'score' not in columns:
+        connection.execute(db.text('ALTER TABLE recommendation ADD COLUMN score FLOAT'))
+
+
+@migration('0004_user_profile_version')
+def add_user_profile_version(connection):
+    columns = [column['name'] for column in db.inspect(connection).get_columns('user')]
+    if 'profile_version' not in columns:
+        connection.execute(db.text('ALTER TABLE "user" ADD COLUMN profile_version INTEGER NOT NULL DEFAULT 0'))
+
+
+def applied_versions(connection):
+    return set(connection.execute(db.select(schema_migrations.c.version)).scalars())
+
+
+def pending_migrations():
+    with db.engine.connect() as connection:
+        applied = applied_versions(connection) if db.inspect(connection).has_table('schema_migrations') else set()
+    return [version for version, _ in MIGRATIONS if version not in applied]
+
+
+def upgrade(echo=print):
+    db.create_all()
+    for version, fn in MIGRATIONS:
+        with db.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                # Several pods may start at once: serialize them, then re-check under the lock
+                connection.execute(db.text('SELECT pg_advisory_xact_lock(hashtext(:name))'), {'name': 'schema_migrations'})
+            if version in applied_versions(connection):
+                continue
+            fn(connection)
+            connection.execute(schema_migrations.insert().values(version=version))
+        echo(f'Applied migration {version}')
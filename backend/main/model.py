@@ -1,4 +1,7 @@
+import re
 from flask_sqlalchemy import SQLAlchemy
+# Registers the Postgres full-text search functions (to_tsvector, to_tsquery, ts_rank)
+import sqlalchemy.dialects.postgresql
 
 db = SQLAlchemy()
 
@@ -10,6 +13,8 @@ class User(db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     phone_number = db.Column(db.String(15))
     shipping_address = db.Column(db.String(200))
+    # Bumped by every profile change; cached profiles are only replaced by newer versions, see profiles.py
+    profile_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
 
@@ -17,24 +22,71 @@ class User(db.Model):
         return f'<User {self.name}>'
 
 
+#Full-text search document for a product: name ranks above category, which ranks above description.
+#The search query must build exactly this expression for Postgres to use the GIN index on it.
+def product_search_vector(name, category, description):
+    def weighted(column, weight):
+        return db.func.setweight(
+            db.func.to_tsvector(db.literal_column("'english'"), db.func.coalesce(column, db.literal_column("''"))),
+            db.literal_column(f"'{weight}'"))
+    return weighted(name, 'A').op('||')(weighted(category, 'B')).op('||')(weighted(description, 'C'))
+
+
 class Product(db.Model):
     product_id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(500))
     price = db.Column(db.Float, nullable=False)
-    category = db.Column(db.String(100))
+    category = db.Column(db.String(100), index=True)
     image_url = db.Column(db.String(200))
     stock_quantity = db.Column(db.Integer, default=0)
+    # URL name used by /collection/<name>, generated from the name on create/update
+    slug = db.Column(db.String(120), unique=True, index=True)
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (
+        # tsvector GIN index for /search; other databases use the in-memory index in search.py
+        db.Index('ix_product_search', product_search_vector(name, category, description),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
     def __repr__(self):
         return f'<Product {self.name}>'
 
+
+#Product slugs: "Masala Chai (Loose)" -> "masala-chai-loose", matching how the frontend builds product URLs
+def slugify(text):
+    return '-'.join(re.findall(r'[^\W_]+', (text or '').lower()))[:110] or 'product'
+
+
+def unique_slug(connection, name, product_id=None):
+    base = slugify(name)
+    taken = set(connection.execute(
+        db.select(Product.slug).where(Product.slug.like(f'{base}%'), Product.product_id != product_id)
+    ).scalars())
+    slug, suffix = base, 2
+    while slug in taken:
+        slug, suffix = f'{base}-{suffix}', suffix + 1
+    return slug
+
+
+@db.event.listens_for(Product, 'before_insert')
+def assign_slug_on_insert(mapper, connection, product):
+    product.slug = unique_slug(connection, product.name)
+
+
+@db.event.listens_for(Product, 'before_update')
+def assign_slug_on_update(mapper, connection, product):
+    if product.slug is None or db.inspect(product).attrs.name.history.has_changes():
+        product.slug = unique_slug(connection, product.name, product.product_id)
+
 class Recommendation(db.Model):
     recommendation_id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'))
+    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), index=True)
     recommended_product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'))
+    # Cosine similarity of the two products, see recommend.py
+    score = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
 
@@ -51,12 +103,17 @@ class Subscription(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (
+        # Also serves lookups by user_id alone
+        db.Index('ix_subscription_user_product', 'user_id', 'product_id'),
+    )
+
     def __repr__(self):
         return f'<Subscription {self.subscription_id}>'
 
 class ChatMessage(db.Model):
     chat_message_id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), index=True)
     message = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
@@ -86,6 +143,11 @@ class CartItem(db.Model):
     cart = db.relationship('Cart', backref=db.backref('items', lazy=True))
     product = db.relationship('Product')
 
+    __table_args__ = (
+        # One row per product in a cart; also serves lookups by cart_id alone
+        db.Index('uq_cart_item_cart_product', 'cart_id', 'product_id', unique=True),
+    )
+
     def __repr__(self):
         return f'<CartItem {self.cart_item_id}>'
 
@@ -94,7 +156,7 @@ class CartItem(db.Model):
 class BestSeller(db.Model):
     best_seller_id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), nullable=False)
-    quantity_sold = db.Column(db.Integer, default=0)
+    quantity_sold = db.Column(db.Integer, default=0, index=True)
     created_at = db.Column(db.DateTime, default=db.func.now())
     updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
 
@@ -103,3 +165,11 @@ class BestSeller(db.Model):
     def __repr__(self):
         return f'<BestSeller {self.best_seller_id}>'
 
+
+#Sales batches already written back to Product.stock_quantity, see inventory.py
+class StockReconciliation(db.Model):
+    batch_id = db.Column(db.String(32), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=db.func.now())
+
+    def __repr__(self):
+        return f'<StockReconciliation {self.batch_id}>'
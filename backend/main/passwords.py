@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+#Password hashing
+#Hashing and checking passwords is deliberately slow, so it runs in a pool of
+#worker processes instead of on the request thread, where a burst of logins
+#would hold the GIL and starve every other request in the worker. At most
+#max_pending operations may be queued or running per web worker; beyond that
+#callers get HasherBusy straight away (the app answers 503) rather than queueing
+#behind the burst. The hashing method and its cost parameters are werkzeug's,
+#e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'; hashes made with anything
+#else are upgraded on the next successful login. If a pool process dies (e.g.
+#OOM-killed) the pool is replaced and the operation retried once; an operation
+#that takes longer than timeout seconds is reported as HasherBusy as well, but
+#keeps its slot until it is cancelled or finishes in the pool. Pool processes
+#are started by a forkserver: forking the threaded web worker itself (cache
+#listener, connection pools) can leave a child deadlocked on a copied lock.
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=None, max_pending=None, timeout=10.0):
+        self.method = method
+        self.timeout = timeout
+        # workers=0 hashes on the calling thread (tests, one-off scripts)
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or 4 * max(self.workers, 1)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # True if the hash was made with another method or other cost parameters
+        if self._prefix is None:
+            # werkzeug fills in default parameters, so learn the full prefix from a real hash once
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            self._acquire()
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+        for attempt in range(2):
+            self._acquire()
+            executor = self._pool()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._slots.release()
+                self._discard(executor)
+                continue
+            # The slot is held until the operation itself ends, not just until we stop waiting for it
+            future.add_done_callback(self._release)
+            try:
+                return future.result(timeout=self.timeout)
+            except BrokenProcessPool:
+                self._discard(executor)
+            except TimeoutError:
+                # Drops it if it is still queued; one already running keeps its slot until it finishes
+                future.cancel()
+                break
+        raise HasherBusy()
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+
+    def _release(self, future):
+        self._slots.release()
+
+    def _discard(self, executor):
+        # Only the first caller to notice replaces the broken pool
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _pool(self):
+        # Created on first use, and again in a process forked after that (e.g. a preloading server)
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+                self._executor_pid = os.getpid()
+            return self._executor
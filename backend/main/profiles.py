@@ -0,0 +1,59 @@
+import json
+from model import User, db
+
+#Profile cache
+#GET /profile is served from user_profile:v2:<email>, a hash holding the
+#serialized JSON body and the profile_version it was built from. PUT /profile
+#writes through: after its commit it stores the new body itself. Every write,
+#from a PUT or from a read filling a miss, goes through a compare-and-set on
+#the version, so an older profile can never replace a newer one and entries can
+#live for a long time.
+
+PROFILE_FIELDS = ('name', 'email', 'phone_number', 'shipping_address')
+
+# Stores body ARGV[2] of version ARGV[1] in KEYS[1] for ARGV[3] seconds unless it already holds
+# that version or a newer one. Returns 1 if stored.
+_STORE = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version') or '-1')
+if current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'body', ARGV[2], 'version', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+def profile_key(email):
+    # v2: the old user_profile:<email> entries were plain strings and simply expire
+    return f'user_profile:v2:{email}'
+
+
+class ProfileCache:
+    def __init__(self, redis_conn, ttl=86400):
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self._store = redis_conn.register_script(_STORE)
+
+    def get(self, email):
+        # The cached JSON body, or None
+        return self.redis_conn.hget(profile_key(email), 'body')
+
+    def store(self, email, version, profile):
+        # Serializes the profile once; returns the body whether or not a newer one was already cached
+        body = json.dumps(profile, separators=(',', ':'))
+        self._store(keys=[profile_key(email)], args=[version or 0, body, self.ttl])
+        return body.encode()
+
+    def load(self, email):
+        # Cache miss: one narrow query, then cache the result. None if there is no such user.
+        columns = [getattr(User, field) for field in PROFILE_FIELDS]
+        row = db.session.query(User.profile_version, *columns).filter_by(email=email).first()
+        if row is None:
+            return None
+        return self.store(email, row.profile_version, {field: getattr(row, field) for field in PROFILE_FIELDS})
+
+    def updated(self, user):
+        # Write-through after a committed change (reads the user's fresh row, version included)
+        return self.store(user.email, user.profile_version,
+                          {field: getattr(user, field) for field in PROFILE_FIELDS})
@@ -0,0 +1,411 @@
+import json
+import math
+import threading
+import time
+import uuid
+from model import Cart, CartItem, Product, Recommendation, db
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+#Item-to-item recommendations
+#A periodic job (flask recommend build) turns co-views (the
+#user:<id>:recent_views histories) and co-carting (CartItem) into a sparse
+#user x product matrix X and scores every pair of products by cosine
+#similarity, i.e. X^T X normalised by the product norms. The top-K neighbours
+#of each product are written to the Recommendation table, which is the durable
+#copy, and to one Redis sorted set per product, which is what requests read.
+#Serving a user is then a single script call that unions the neighbour sets of
+#what they viewed, recent views weighing more. SciPy does the heavy lifting when installed; a pure Python
+#version of the same computation covers small catalogs without it.
+
+VIEWS_PATTERN = 'user:*:recent_views'
+ITEMS_KEY = 'recommend:items'            # products that have a neighbour set
+BUILT_KEY = 'recommend:built'
+# A product in a cart says more about intent than a view
+VIEW_WEIGHT = 1.0
+CART_WEIGHT = 2.0
+
+
+def neighbours_key(product_id):
+    return f'recommend:item:{product_id}'
+
+
+def views_key(user_id):
+    return f'user:{user_id}:recent_views'
+
+
+# Unions the neighbour sets of everything in the view history KEYS[1] into the temporary KEYS[2],
+# each weighted by 0.5 ^ (age / half-life ARGV[3]) as of ARGV[2], and returns the best ARGV[1]
+# products not viewed yet. Returns nil when nothing has been built yet.
+# Neighbour keys are derived from the viewed ids, so this expects a single Redis node.
+_RECOMMEND = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return nil
+end
+local viewed = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+if #viewed == 0 then
+    return {}
+end
+local now = tonumber(ARGV[2])
+local half_life = tonumber(ARGV[3])
+local sources = {}
+local weights = {'WEIGHTS'}
+local seen = {}
+local count = 0
+for i = 1, #viewed, 2 do
+    local age = math.max(now - tonumber(viewed[i + 1]), 0)
+    table.insert(sources, 'recommend:item:' .. viewed[i])
+    table.insert(weights, 0.5 ^ (age / half_life))
+    seen[viewed[i]] = true
+    count = count + 1
+end
+for _, weight in ipairs(weights) do
+    table.insert(sources, weight)
+end
+redis.call('ZUNIONSTORE', KEYS[2], count, (unpack or table.unpack)(sources))
+local candidates = redis.call('ZREVRANGE', KEYS[2], 0, tonumber(ARGV[1]) + count - 1)
+redis.call('DEL', KEYS[2])
+local result = {}
+for _, product_id in ipairs(candidates) do
+    if not seen[product_id] and #result < tonumber(ARGV[1]) then
+        table.insert(result, product_id)
+    end
+end
+return result
+"""
+
+
+def collect_interactions(redis_conn, batch_size=500):
+    # {user_id: {product_id: weight}} from view histories and cart lines
+    interactions = {}
+    keys = []
+
+    def read_views():
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrange(key, 0, -1)
+        for key, members in zip(keys, pipe.execute()):
+            user_id = int(key.split(b':')[1])
+            items = interactions.setdefault(user_id, {})
+            for product_id in members:
+                items[int(product_id)] = max(items.get(int(product_id), 0), VIEW_WEIGHT)
+        keys.clear()
+
+    for key in redis_conn.scan_iter(match=VIEWS_PATTERN, count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            read_views()
+    read_views()
+
+    rows = db.session.query(Cart.user_id, CartItem.product_id) \
+        .join(CartItem, CartItem.cart_id == Cart.cart_id).yield_per(5000)
+    for user_id, product_id in rows:
+        items = interactions.setdefault(user_id, {})
+        items[product_id] = max(items.get(product_id, 0), CART_WEIGHT)
+    return interactions
+
+
+def similar_items(interactions, top_k=20):
+    # {product_id: [(neighbour_id, score), ...]} best first, by cosine similarity
+    if sparse is not None:
+        return _similar_items_sparse(interactions, top_k)
+    return _similar_items_python(interactions, top_k)
+
+
+def _similar_items_sparse(interactions, top_k):
+    product_ids = sorted({product_id for items in interactions.values() for product_id in items})
+    if not product_ids:
+        return {}
+    column = {product_id: i for i, product_id in enumerate(product_ids)}
+    rows, cols, weights = [], [], []
+    for row, items in enumerate(interactions.values()):
+        for product_id, weight in items.items():
+            rows.append(row)
+            cols.append(column[product_id])
+            weights.append(weight)
+    X = sparse.csr_matrix((weights, (rows, cols)), shape=(len(interactions), len(product_ids)))
+    co = (X.T @ X).tocsr()
+    norms = np.sqrt(co.diagonal())
+
+    neighbours = {}
+    for i in range(co.shape[0]):
+        start, end = co.indptr[i], co.indptr[i + 1]
+        indices, scores = co.indices[start:end], co.data[start:end] / (norms[i] * norms[co.indices[start:end]])
+        keep = indices != i
+        indices, scores = indices[keep], scores[keep]
+        if not len(indices):
+            continue
+        if len(indices) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            indices, scores = indices[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        neighbours[product_ids[i]] = [(product_ids[j], float(score)) for j, score in zip(indices[order], scores[order])]
+    return neighbours
+
+
+def _similar_items_python(interactions, top_k):
+    dot, norm = {}, {}
+    for items in interactions.values():
+        for product_id, weight in items.items():
+            norm[product_id] = norm.get(product_id, 0.0) + weight * weight
+            row = dot.setdefault(product_id, {})
+            for other_id, other_weight in items.items():
+                if other_id != product_id:
+                    row[other_id] = row.get(other_id, 0.0) + weight * other_weight
+
+    neighbours = {}
+    for product_id, row in dot.items():
+        scored = [(other_id, value / math.sqrt(norm[product_id] * norm[other_id])) for other_id, value in row.items()]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        if scored:
+            neighbours[product_id] = scored[:top_k]
+    return neighbours
+
+
+class Recommender:
+    def __init__(self, redis_conn, half_life=7 * 86400):
+        self.redis_conn = redis_conn
+        self.half_life = half_life
+        self._recommend = redis_conn.register_script(_RECOMMEND)
+
+    def build(self, top_k=20):
+        # The periodic job: recompute every product's neighbours and publish them. Returns how many products have some.
+        neighbours = similar_items(collect_interactions(self.redis_conn), top_k)
+        table = Recommendation.__table__
+        db.session.execute(table.delete())
+        rows = [{'product_id': product_id, 'recommended_product_id': other_id, 'score': score}
+                for product_id, scored in neighbours.items() for other_id, score in scored]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+        self.publish(neighbours)
+        return len(neighbours)
+
+    def publish(self, neighbours):
+        # Swaps in the new neighbour sets in one transaction
+        old_items = self.redis_conn.smembers(ITEMS_KEY)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.delete(ITEMS_KEY, *[neighbours_key(product_id.decode()) for product_id in old_items])
+        for product_id, scored in neighbours.items():
+            pipe.zadd(neighbours_key(product_id), {other_id: score for other_id, score in scored})
+            pipe.sadd(ITEMS_KEY, product_id)
+        pipe.set(BUILT_KEY, 1)
+        pipe.execute()
+
+    def load(self):
+        # Redis lost the neighbour sets (restart, flush): republish the last build from the table
+        neighbours = {}
+        rows = db.session.query(Recommendation.product_id, Recommendation.recommended_product_id, Recommendation.score) \
+            .order_by(Recommendation.product_id, Recommendation.score.desc())
+        for product_id, other_id, score in rows:
+            neighbours.setdefault(product_id, []).append((other_id, score or 0.0))
+        self.publish(neighbours)
+
+    def for_user(self, user_id, limit=5):
+        # Recommended product ids for a user, best first
+        return self.for_users([user_id], limit)[user_id]
+
+    def for_users(self, user_ids, limit=5):
+        # {user_id: [product_id, ...]} for a batch of users, one pipelined round trip
+        def run():
+            now = time.time()
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for user_id in user_ids:
+                keys = [views_key(user_id), f'recommend:tmp:{uuid.uuid4().hex}', BUILT_KEY]
+                self._recommend(keys=keys, args=[limit, now, self.half_life], client=pipe)
+            return pipe.execute()
+
+        results = run()
+        if user_ids and any(result is None for result in results):
+            self.load()
+            results = run()
+        return {user_id: [int(product_id) for product_id in result or []]
+                for user_id, result in zip(user_ids, results)}
+
+
+    def same_category(self, user_ids, limit=5):
+        # {user_id: [product_id, ...]} from the categories of what each user viewed, most recent view first.
+        # Tops up short lists: before the first build, or for products nobody viewed together with others.
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zrevrange(views_key(user_id), 0, -1)
+        viewed = {user_id: [int(product_id) for product_id in members]
+                  for user_id, members in zip(user_ids, pipe.execute())}
+        all_viewed = {product_id for products in viewed.values() for product_id in products}
+        if not all_viewed:
+            return {user_id: [] for user_id in user_ids}
+
+        categories = dict(db.session.query(Product.product_id, Product.category)
+                          .filter(Product.product_id.in_(all_viewed)))
+        wanted = {category for category in categories.values() if category}
+        # Enough products per category for any user, in one query
+        per_category = limit + max(len(products) for products in viewed.values())
+        rank = db.func.row_number().over(partition_by=Product.category, order_by=Product.product_id).label('rank')
+        ranked = db.session.query(Product.product_id, Product.category, rank) \
+            .filter(Product.category.in_(wanted)).subquery()
+        by_category = {}
+        for product_id, category in db.session.query(ranked.c.product_id, ranked.c.category) \
+                .filter(ranked.c.rank <= per_category).order_by(ranked.c.product_id):
+            by_category.setdefault(category, []).append(product_id)
+
+        result = {}
+        for user_id, products in viewed.items():
+            seen, found = set(products), []
+            for product_id in products:
+                for other_id in by_category.get(categories.get(product_id), []):
+                    if len(found) < limit and other_id not in seen:
+                        seen.add(other_id)
+                        found.append(other_id)
+            result[user_id] = found
+        return result
+
+
+#Per-user recommendation cache
+#/recommendations reads a user's list as ready-made JSON from
+#recommend:user:<id>. A view of a product that is not in the user's history
+#drops the entry and queues the user as stale; a worker (flask recommend worker)
+#recomputes stale users in batches and all recently active users after every
+#build, so the endpoint normally finds its answer in the cache. On a miss the
+#request computes and stores the entry itself (read-through).
+
+ACTIVE_KEY = 'recommend:active'    # zset of user ids scored by their last view
+STALE_KEY = 'recommend:stale'      # users whose cached list misses a new view
+
+
+def user_key(user_id):
+    return f'recommend:user:{user_id}'
+
+
+# Records a view of ARGV[1] at time ARGV[2] in the history KEYS[1], keeping only the latest ARGV[3]
+# views for ARGV[4] seconds, and marks the user ARGV[5] active in KEYS[2]. A product not in the
+# history yet also drops the cached list KEYS[3] and queues the user in KEYS[4]. Returns 1 if new.
+# Times only move forward (GT), so replaying a view that was already recorded changes nothing.
+_RECORD_VIEW = """
+local new = redis.call('ZADD', KEYS[1], 'GT', ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[2], ARGV[5])
+if new == 1 then
+    redis.call('DEL', KEYS[3])
+    redis.call('SADD', KEYS[4], ARGV[5])
+end
+return new
+"""
+
+
+#View history
+#Each user's views live in user:<id>:recent_views, a sorted set of product ids
+#scored by when they were last viewed. It is trimmed to the latest `limit`
+#views and expires `ttl` seconds after the last one, so both Redis memory and
+#the cost of serving a user's recommendations stay bounded.
+class ViewHistory:
+    def __init__(self, redis_conn, limit=50, ttl=30 * 86400):
+        self.redis_conn = redis_conn
+        self.limit = limit
+        self.ttl = ttl
+        self._record = redis_conn.register_script(_RECORD_VIEW)
+
+    def record(self, user_id, product_id, viewed_at=None):
+        # One round trip; returns True if the product was not in the history yet
+        return self.record_many([(user_id, product_id, viewed_at)])[0]
+
+    def record_many(self, views):
+        # [(user_id, product_id, viewed_at or None for now)] in one pipelined round trip
+        now = time.time()
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for user_id, product_id, viewed_at in views:
+            keys = [views_key(user_id), ACTIVE_KEY, user_key(user_id), STALE_KEY]
+            self._record(keys=keys, args=[product_id, viewed_at or now, self.limit, self.ttl, user_id], client=pipe)
+        return [result == 1 for result in pipe.execute()]
+
+    def exists(self, user_id):
+        return bool(self.redis_conn.exists(views_key(user_id)))
+
+    def migrate_sets(self, batch_size=500):
+        # One-off: converts the old unbounded user:<id>:viewed_products sets into capped histories.
+        # They carry no view times, so the members are kept as if viewed now.
+        migrated = 0
+        keys = list(self.redis_conn.scan_iter(match='user:*:viewed_products', count=batch_size))
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            read = self.redis_conn.pipeline(transaction=False)
+            for key in batch:
+                read.smembers(key)
+            now = time.time()
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for key, members in zip(batch, read.execute()):
+                history = views_key(key.split(b':')[1].decode())
+                if members:
+                    pipe.zadd(history, {product_id: now for product_id in members}, nx=True)
+                    pipe.zremrangebyrank(history, 0, -self.limit - 1)
+                    pipe.expire(history, self.ttl)
+                pipe.delete(key)
+            pipe.execute()
+            migrated += len(batch)
+        return migrated
+
+
+class RecommendationCache:
+    def __init__(self, redis_conn, ttl=3600, active_window=86400):
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.active_window = active_window
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        # The cached JSON body, or None
+        body = self.redis_conn.get(user_key(user_id))
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+    def store(self, recommendations):
+        # Serializes and caches {user_id: recommendations}, the shape loader(user_ids) returns
+        # in the refresh methods; returns {user_id: JSON body}
+        bodies = {user_id: json.dumps(data, separators=(',', ':')).encode()
+                  for user_id, data in recommendations.items()}
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for user_id, body in bodies.items():
+            pipe.set(user_key(user_id), body, ex=self.ttl)
+        pipe.execute()
+        return bodies
+
+    def refresh_stale(self, loader, batch_size=200):
+        # Recomputes users invalidated by new views; returns how many were refreshed
+        refreshed = 0
+        while True:
+            user_ids = [int(user_id) for user_id in self.redis_conn.spop(STALE_KEY, batch_size) or []]
+            if not user_ids:
+                return refreshed
+            self.store(loader(user_ids))
+            refreshed += len(user_ids)
+
+    def refresh_active(self, loader, batch_size=200):
+        # Recomputes everyone who viewed something within active_window, e.g. after a build
+        self.redis_conn.zremrangebyscore(ACTIVE_KEY, '-inf', time.time() - self.active_window)
+        refreshed, start = 0, 0
+        while True:
+            user_ids = [int(user_id) for user_id in self.redis_conn.zrange(ACTIVE_KEY, start, start + batch_size - 1)]
+            if not user_ids:
+                return refreshed
+            self.store(loader(user_ids))
+            refreshed += len(user_ids)
+            start += batch_size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
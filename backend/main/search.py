@@ -0,0 +1,118 @@
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from model import Product, db, product_search_vector
+from catalog import products_by_ids, stream_products_by_ids
+
+#Product search
+#On Postgres, /search runs a prefix tsquery against the GIN-indexed tsvector on
+#product name, category and description, ranked with ts_rank. Other databases
+#(SQLite in tests) use an in-memory inverted index built once per catalog
+#version. Both return product ids best match first, so results can be cached,
+#paginated and streamed the same way.
+
+_TOKEN = re.compile(r'[^\W_]+')
+
+# How much a term counts depending on which field it appears in (mirrors the tsvector weights)
+FIELD_WEIGHTS = (('name', 3), ('category', 2), ('description', 1))
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return _TOKEN.findall(text)
+
+
+def normalize_query(query):
+    # "Chai", "chai " and "CHAI" all become "chai", so they share a cache entry
+    return ' '.join(tokenize(query))
+
+
+#Inverted index: term -> {product_id: weight}, with the terms kept sorted so
+#a prefix lookup is a binary search followed by a scan of the matching terms.
+class InvertedIndex:
+    def __init__(self, rows):
+        self.postings = {}
+        for row in rows:
+            for field, weight in FIELD_WEIGHTS:
+                for term in tokenize(getattr(row, field)):
+                    postings = self.postings.setdefault(term, {})
+                    postings[row.product_id] = postings.get(row.product_id, 0) + weight
+        self.terms = sorted(self.postings)
+
+    def search(self, tokens):
+        # Every token must prefix-match a term; score is the summed field weights
+        scores = None
+        for token in tokens:
+            token_scores = {}
+            i = bisect_left(self.terms, token)
+            while i < len(self.terms) and self.terms[i].startswith(token):
+                for product_id, weight in self.postings[self.terms[i]].items():
+                    token_scores[product_id] = token_scores.get(product_id, 0) + weight
+                i += 1
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {product_id: score + token_scores[product_id]
+                          for product_id, score in scores.items() if product_id in token_scores}
+            if not scores:
+                return []
+        return sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+
+
+_memory_index = None
+_memory_index_lock = threading.Lock()
+
+
+def memory_index(version):
+    global _memory_index
+    with _memory_index_lock:
+        if _memory_index is None or _memory_index[0] != version:
+            rows = db.session.query(Product.product_id, Product.name, Product.category, Product.description)
+            _memory_index = (version, InvertedIndex(rows))
+        return _memory_index[1]
+
+
+def clear_memory_index():
+    global _memory_index
+    with _memory_index_lock:
+        _memory_index = None
+
+
+def ranked_product_ids(query, version):
+    tokens = query.split()
+    if not tokens:
+        return []
+    if db.engine.dialect.name != 'postgresql':
+        return memory_index(version).search(tokens)
+
+    vector = product_search_vector(Product.name, Product.category, Product.description)
+    # Tokens are alphanumeric only, so they are safe to join into tsquery syntax
+    tsquery = db.func.to_tsquery(db.literal_column("'english'"), ' & '.join(f'{token}:*' for token in tokens))
+    rows = db.session.query(Product.product_id).filter(vector.op('@@')(tsquery)) \
+        .order_by(db.func.ts_rank(vector, tsquery).desc(), Product.product_id)
+    return [row.product_id for row in rows]
+
+
+def search_products(query, version, columns):
+    return products_by_ids(ranked_product_ids(query, version), columns)
+
+
+def search_products_page(query, version, columns, after=0, limit=50):
+    # Results are in rank order, so the cursor is the id of the last result seen
+    ids = ranked_product_ids(query, version)
+    if not after:
+        start = 0
+    elif after in ids:
+        start = ids.index(after) + 1
+    else:
+        # The cursor's product left the results (deleted or no longer matching): end the listing
+        # rather than start over, so clients never loop over the same pages
+        return {'items': [], 'next_after': None}
+    page = ids[start:start + limit]
+    next_after = page[-1] if start + limit < len(ids) else None
+    return {'items': products_by_ids(page, columns), 'next_after': next_after}
+
+
+def stream_search_results(query, version, columns):
+    return stream_products_by_ids(ranked_product_ids(query, version), columns)
@@ -0,0 +1,221 @@
+import json
+from model import Product, BestSeller, db
+from search import tokenize
+
+#Search suggestions
+#A Redis sorted set where every member has score 0, so ZRANGEBYLEX returns the
+#members starting with a prefix straight from the skiplist. Each product is
+#indexed under its full name and under every word-start suffix ("masala chai",
+#"chai"), each category under its name. Members look like
+#  "<normalized phrase>\x1f<ref>\x1f<label>"
+#where ref is p:<product_id> or c:<category>. Popularity (BestSeller
+#quantity_sold) is kept per ref in a sorted set and decides the order of
+#suggestions.
+#
+#Candidates are the first `candidates` members in lexical order plus the
+#`popular` most popular refs whose phrases match the prefix, so best sellers
+#are suggested for short prefixes however far into the alphabet they sit. A
+#ref that is neither can still be missed when a prefix matches more than
+#`candidates` members.
+
+SUGGEST_KEY = 'catalog:suggest'
+POPULARITY_KEY = 'catalog:suggest:popular'
+# ref -> JSON list of its members, so an update can remove the old entries
+REFS_KEY = 'catalog:suggest:refs'
+# Category refs are counted: product ref -> its category, and c:<category> -> number of products
+PRODUCT_CATEGORY_KEY = 'catalog:suggest:product_category'
+CATEGORY_COUNT_KEY = 'catalog:suggest:category_count'
+# v3: popularity is a sorted set and categories are counted, so indexes built before need a rebuild
+BUILT_KEY = 'catalog:suggest:built:v3'
+LEGACY_KEYS = ('catalog:suggest:popularity', 'catalog:suggest:built', 'catalog:suggest:built:v2')
+BUILD_LOCK_KEY = 'catalog:suggest:lock'
+# Sorts before any printable character, so "chai" entries come before "chai mug"
+SEPARATOR = '\x1f'
+
+# Candidates matching the prefix ARGV[1] (the first ARGV[2] in lexical order, then the matching
+# members of the ARGV[3] most popular refs), each followed by the popularity of its ref, in one
+# round trip. Returns nil when the index has not been built yet.
+_SUGGEST = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return nil
+end
+local members = redis.call('ZRANGEBYLEX', KEYS[1], '[' .. ARGV[1], '[' .. ARGV[1] .. '\\255', 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, member in ipairs(members) do
+    local ref = string.match(member, '\\031([^\\031]*)\\031')
+    table.insert(result, member)
+    table.insert(result, redis.call('ZSCORE', KEYS[2], ref) or '0')
+end
+local popular = redis.call('ZREVRANGE', KEYS[2], 0, tonumber(ARGV[3]) - 1, 'WITHSCORES')
+for i = 1, #popular, 2 do
+    local ref_members = redis.call('HGET', KEYS[4], popular[i])
+    if ref_members then
+        for _, member in ipairs(cjson.decode(ref_members)) do
+            if string.sub(member, 1, #ARGV[1]) == ARGV[1] then
+                table.insert(result, member)
+                table.insert(result, popular[i + 1])
+                break
+            end
+        end
+    end
+end
+return result
+"""
+
+
+# Files product ref ARGV[1] under category ARGV[2] ('' for none), whose members are the JSON list ARGV[3].
+# When the product leaves a category its popularity moves along, and the last product to leave a
+# category takes the category's suggestions with it.
+_SET_CATEGORY = """
+local old = redis.call('HGET', KEYS[4], ARGV[1]) or ''
+if old == ARGV[2] then
+    return 0
+end
+local popularity = tonumber(redis.call('ZSCORE', KEYS[3], ARGV[1]) or '0')
+if old ~= '' then
+    local ref = 'c:' .. old
+    redis.call('ZINCRBY', KEYS[3], -popularity, ref)
+    if redis.call('HINCRBY', KEYS[5], ref, -1) <= 0 then
+        local members = redis.call('HGET', KEYS[2], ref)
+        if members then
+            for _, member in ipairs(cjson.decode(members)) do
+                redis.call('ZREM', KEYS[1], member)
+            end
+        end
+        redis.call('HDEL', KEYS[2], ref)
+        redis.call('HDEL', KEYS[5], ref)
+        redis.call('ZREM', KEYS[3], ref)
+    end
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    return 1
+end
+local ref = 'c:' .. ARGV[2]
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+if redis.call('HINCRBY', KEYS[5], ref, 1) == 1 then
+    for _, member in ipairs(cjson.decode(ARGV[3])) do
+        redis.call('ZADD', KEYS[1], 0, member)
+    end
+    redis.call('HSET', KEYS[2], ref, ARGV[3])
+end
+redis.call('ZINCRBY', KEYS[3], popularity, ref)
+return 1
+"""
+
+
+def phrases(text):
+    words = tokenize(text)
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def entries(ref, label):
+    return [f'{phrase}{SEPARATOR}{ref}{SEPARATOR}{label}' for phrase in phrases(label)]
+
+
+class SuggestIndex:
+    def __init__(self, redis_conn, candidates=50, popular=200):
+        self.redis_conn = redis_conn
+        self.candidates = candidates
+        self.popular = popular
+        self._suggest = redis_conn.register_script(_SUGGEST)
+        self._set_category = redis_conn.register_script(_SET_CATEGORY)
+
+    def suggest(self, prefix, limit=10):
+        prefix = ' '.join(tokenize(prefix))
+        if not prefix:
+            return []
+        keys = [SUGGEST_KEY, POPULARITY_KEY, BUILT_KEY, REFS_KEY]
+        args = [prefix, self.candidates, self.popular]
+        result = self._suggest(keys=keys, args=args)
+        if result is None:
+            self.rebuild()
+            result = self._suggest(keys=keys, args=args) or []
+
+        suggestions = {}
+        for member, popularity in zip(result[::2], result[1::2]):
+            _, ref, label = member.decode().split(SEPARATOR, 2)
+            suggestions[ref] = (int(float(popularity)), label)
+        ranked = sorted(suggestions.items(), key=lambda item: (-item[1][0], item[1][1]))
+        return [self._suggestion(ref, label) for ref, (_, label) in ranked[:limit]]
+
+    def _suggestion(self, ref, label):
+        kind, value = ref.split(':', 1)
+        if kind == 'p':
+            return {'type': 'product', 'product_id': int(value), 'name': label}
+        return {'type': 'category', 'name': label}
+
+    def rebuild(self):
+        # Full rebuild from the database, applied atomically. Only one worker builds at a time.
+        if not self.redis_conn.set(BUILD_LOCK_KEY, 1, nx=True, ex=60):
+            return
+        try:
+            popularity = {}
+            for product_id, quantity_sold in db.session.query(BestSeller.product_id, BestSeller.quantity_sold):
+                popularity[f'p:{product_id}'] = popularity.get(f'p:{product_id}', 0) + (quantity_sold or 0)
+
+            refs, product_categories, category_counts = {}, {}, {}
+            for product_id, name, category in db.session.query(Product.product_id, Product.name, Product.category):
+                refs[f'p:{product_id}'] = entries(f'p:{product_id}', name)
+                if category:
+                    refs.setdefault(f'c:{category}', entries(f'c:{category}', category))
+                    popularity[f'c:{category}'] = popularity.get(f'c:{category}', 0) + popularity.get(f'p:{product_id}', 0)
+                    product_categories[f'p:{product_id}'] = category
+                    category_counts[f'c:{category}'] = category_counts.get(f'c:{category}', 0) + 1
+
+            pipe = self.redis_conn.pipeline(transaction=True)
+            pipe.delete(SUGGEST_KEY, POPULARITY_KEY, REFS_KEY, PRODUCT_CATEGORY_KEY, CATEGORY_COUNT_KEY, *LEGACY_KEYS)
+            members = {member: 0 for ref_members in refs.values() for member in ref_members}
+            if members:
+                pipe.zadd(SUGGEST_KEY, members)
+                pipe.hset(REFS_KEY, mapping={ref: json.dumps(ref_members) for ref, ref_members in refs.items()})
+            if product_categories:
+                pipe.hset(PRODUCT_CATEGORY_KEY, mapping=product_categories)
+                pipe.hset(CATEGORY_COUNT_KEY, mapping=category_counts)
+            if popularity:
+                pipe.zadd(POPULARITY_KEY, popularity)
+            pipe.set(BUILT_KEY, 1)
+            pipe.execute()
+        finally:
+            self.redis_conn.delete(BUILD_LOCK_KEY)
+
+    def index_product(self, product_id, name, category):
+        # Incremental update after a product is added or changed
+        ref = f'p:{product_id}'
+        old_members = self._members(ref)
+        new_members = entries(ref, name)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        if old_members:
+            pipe.zrem(SUGGEST_KEY, *old_members)
+        pipe.zadd(SUGGEST_KEY, {member: 0 for member in new_members})
+        pipe.hset(REFS_KEY, ref, json.dumps(new_members))
+        self._file_category(pipe, ref, category)
+        pipe.execute()
+
+    def remove_product(self, product_id):
+        ref = f'p:{product_id}'
+        old_members = self._members(ref)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        if old_members:
+            pipe.zrem(SUGGEST_KEY, *old_members)
+        # Before its popularity goes, so the category's share is taken off too
+        self._file_category(pipe, ref, None)
+        pipe.hdel(REFS_KEY, ref)
+        pipe.zrem(POPULARITY_KEY, ref)
+        pipe.execute()
+
+    def add_popularity(self, product_id, category, quantity_sold):
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.zincrby(POPULARITY_KEY, quantity_sold, f'p:{product_id}')
+        if category:
+            pipe.zincrby(POPULARITY_KEY, quantity_sold, f'c:{category}')
+        pipe.execute()
+
+    def _file_category(self, pipe, ref, category):
+        members = json.dumps(entries(f'c:{category}', category)) if category else '[]'
+        self._set_category(keys=[SUGGEST_KEY, REFS_KEY, POPULARITY_KEY, PRODUCT_CATEGORY_KEY, CATEGORY_COUNT_KEY],
+                           args=[ref, category or '', members], client=pipe)
+
+    def _members(self, ref):
+        members = self.redis_conn.hget(REFS_KEY, ref)
+        return json.loads(members) if members else []
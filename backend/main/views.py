@@ -0,0 +1,72 @@
+import redis
+
+#View event ingestion
+#With VIEW_INGESTION=stream, /view-product/<id> only appends a compact event
+#(email, product id, time) to the views:events stream and returns. A
+#consumer-group worker (flask views worker) reads events in batches, resolves
+#all their users with one query and records the views in one pipeline, then
+#acknowledges and deletes them. Events are acknowledged only after they have
+#been recorded, and ones left pending by a crashed worker are claimed by
+#another after a while, so every view is recorded at least once; recording a
+#view twice is harmless. Acknowledged events are deleted, so the stream length
+#is the backlog, and appends are refused once it reaches max_pending.
+
+STREAM_KEY = 'views:events'
+GROUP = 'view-workers'
+
+# Appends an event to KEYS[1] unless ARGV[1] events are already waiting. Returns the id or nil.
+_APPEND = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return nil
+end
+return redis.call('XADD', KEYS[1], '*', 'e', ARGV[2], 'p', ARGV[3], 't', ARGV[4])
+"""
+
+
+class ViewStream:
+    def __init__(self, redis_conn, max_pending=100000):
+        self.redis_conn = redis_conn
+        self.max_pending = max_pending
+        self._append = redis_conn.register_script(_APPEND)
+
+    def append(self, email, product_id, viewed_at):
+        # False when the backlog is full and the caller should back off
+        return self._append(keys=[STREAM_KEY], args=[self.max_pending, email, product_id, viewed_at]) is not None
+
+    def backlog(self):
+        return self.redis_conn.xlen(STREAM_KEY)
+
+    def create_group(self):
+        try:
+            self.redis_conn.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, consumer, count=500, block_ms=1000, min_idle_ms=60000):
+        # Returns (event ids, [(email, product_id, viewed_at)]): events abandoned by another consumer
+        # first, then new ones. Ids of events deleted while pending come back without an event.
+        messages = self.redis_conn.xautoclaim(STREAM_KEY, GROUP, consumer, min_idle_time=min_idle_ms,
+                                              start_id='0-0', count=count)[1]
+        if not messages:
+            streams = self.redis_conn.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=count, block=block_ms)
+            messages = streams[0][1] if streams else []
+        events = [(fields[b'e'].decode(), int(fields[b'p']), float(fields[b't'])) for _, fields in messages if fields]
+        return [event_id for event_id, _ in messages], events
+
+    def ack(self, event_ids):
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.xack(STREAM_KEY, GROUP, *event_ids)
+        pipe.xdel(STREAM_KEY, *event_ids)
+        pipe.execute()
+
+    def consume(self, consumer, handler, count=500, block_ms=1000, min_idle_ms=60000):
+        # Reads one batch, hands its events to handler and acknowledges them once handler returns.
+        # Returns how many events were read.
+        event_ids, events = self.read(consumer, count, block_ms, min_idle_ms)
+        if not event_ids:
+            return 0
+        if events:
+            handler(events)
+        self.ack(event_ids)
+        return len(event_ids)
@@ -0,0 +1,96 @@
+import unittest
+import threading
+import time
+from backend.main.app import redis_conn
+from backend.main.cache import LocalCache, CatalogCache
+
+
+class LocalCacheTest(unittest.TestCase):
+
+    def test_get_counts_hits_and_misses(self):
+        cache = LocalCache(max_entries=10, max_bytes=1024, ttl=60)
+        self.assertIsNone(cache.get('products'))
+        cache.set('products', b'[]', 2)
+
+        self.assertEqual(cache.get('products'), b'[]')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LocalCache(max_entries=2, max_bytes=1024, ttl=60)
+        cache.set('a', b'1', 1)
+        cache.set('b', b'2', 1)
+        cache.get('a')
+        cache.set('c', b'3', 1)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('c'), b'3')
+
+    def test_byte_cap(self):
+        cache = LocalCache(max_entries=10, max_bytes=10, ttl=60)
+        cache.set('a', b'x' * 6, 6)
+        cache.set('b', b'y' * 6, 6)
+        cache.set('huge', b'z' * 20, 20)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('huge'))
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+    def test_entries_expire(self):
+        cache = LocalCache(max_entries=10, max_bytes=1024, ttl=0)
+        cache.set('products', b'[]', 2)
+        time.sleep(0.01)
+
+        self.assertIsNone(cache.get('products'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+
+class CatalogCacheFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CatalogCache(redis_conn, ttl=60, stale_ttl=60, lock_timeout=5)
+        self.calls = 0
+
+    def tearDown(self):
+        redis_conn.flushdb()
+
+    def slow_loader(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return [{'product_id': 1, 'name': 'Green Tea'}]
+
+    def test_concurrent_misses_load_once(self):
+        entries = []
+        threads = [threading.Thread(target=lambda: entries.append(self.cache.fetch('products', self.slow_loader)))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # One worker computed the entry, everyone else waited for it
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(entries), 20)
+        self.assertEqual(len(set(entry.etag for entry in entries)), 1)
+
+    def test_stale_entry_served_while_refreshing(self):
+        version = self.cache.version()
+        stale = self.cache.set('products', [{'product_id': 1}], version)
+        redis_conn.hset(self.cache.key('products', version), 'expires_at', time.time() - 1)
+
+        # Another worker holds the refresh lock, so the stale entry is served as-is
+        redis_conn.set(self.cache.key('products', version) + ':lock', 'other-worker')
+        entry = self.cache.fetch('products', self.slow_loader)
+        self.assertEqual(entry.etag, stale.etag)
+        self.assertEqual(self.calls, 0)
+
+    def test_missing_data_is_not_cached(self):
+        self.assertIsNone(self.cache.fetch('product:99', lambda: None))
+        self.assertIsNone(self.cache.get('product:99')[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
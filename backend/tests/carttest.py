@@ -1,7 +1,13 @@
 import unittest
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.exc import OperationalError
 from unittest.mock import patch
-from backend.main.app import app, db
-from backend.main.model import User, Product, Cart, CartItem
+from backend.main.app import app, db, redis_conn, inventory
+from backend.main.model import User, Product, Cart, CartItem, BestSeller
+from backend.main.carts import add_item, cart_items, RedisCartStore, FLUSHING_KEY
+from backend.tests.querycount import count_queries, assert_max_queries
 
 class CartApiTest(unittest.TestCase):
 
@@ -17,16 +23,9 @@ class CartApiTest(unittest.TestCase):
     def tearDown(self):
         self.patcher.stop()
 
-    @patch('backend.main.app.Cart.query')
-    @patch('backend.main.app.CartItem.query')
-    def test_add_to_cart(self, mock_cart_item_query, mock_cart_query):
-        # Mock cart and cart item
-        mock_cart = Cart(cart_id=1, user_id=1)
-        mock_cart_query.filter_by.return_value.first.return_value = mock_cart
-
-        mock_cart_item = CartItem(cart_item_id=1, cart_id=1, product_id=1, quantity=1)
-        mock_cart_item_query.filter_by.return_value.first.return_value = None
-
+    @patch('backend.main.app.inventory.reserve', return_value=True)
+    @patch('backend.main.app.cart_store.add')
+    def test_add_to_cart(self, mock_add, mock_reserve):
         # Test data
         response = self.app.post('/cart/add', json={
             'user_id': 1,
@@ -37,26 +36,11 @@ class CartApiTest(unittest.TestCase):
         # Verify response
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.json['message'], 'Item added to cart successfully')
+        mock_add.assert_called_once_with(1, 1, 2)
         
-    @patch('backend.main.app.Cart.query')
-    def test_view_cart(self, mock_cart_query):
-        # Mock cart and items
-        mock_cart_item = CartItem(cart_item_id=1, product_id=1, quantity=2)
-        mock_cart_item.product = Product(product_id=1, name="Green Tea", price=10.0)
-        mock_cart = Cart(cart_id=1, user_id=1, items=[mock_cart_item])
-        mock_cart_query.filter_by.return_value.first.return_value = mock_cart
-
-        # Test data
-        response = self.app.get('/cart/1')
-
-        # Verify response
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json['cart_id'], 1)
-        self.assertEqual(len(response.json['items']), 1)
-        self.assertEqual(response.json['items'][0]['product_name'], "Green Tea")
-
+    @patch('backend.main.app.cart_store.remove', return_value=1)
     @patch('backend.main.app.CartItem.query')
-    def test_remove_from_cart(self, mock_cart_item_query):
+    def test_remove_from_cart(self, mock_cart_item_query, mock_remove):
         # Mock cart item
         mock_cart_item = CartItem(cart_item_id=1, cart_id=1, product_id=1, quantity=1)
         mock_cart_item_query.get.return_value = mock_cart_item
@@ -70,5 +54,276 @@ class CartApiTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['message'], 'Item removed from cart successfully')
         
+
+
+class CartUpsertTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(user_id=1, name="Test User", email="test@example.com", password_hash="hashed_password"))
+            db.session.add(Product(product_id=1, name="Masala Chai", price=5.0, category="Tea", stock_quantity=1000))
+            db.session.add(Product(product_id=2, name="Chai Mug", price=8.0, category="Teaware", stock_quantity=1000))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_add_to_cart_upserts(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 3})
+        with app.app_context():
+            self.assertEqual(Cart.query.count(), 1)
+            self.assertEqual([(item.product_id, item.quantity) for item in CartItem.query.all()], [(1, 5)])
+
+    def test_concurrent_adds_keep_every_update(self):
+        # Needs real concurrent connections, so this runs against a SQLite file instead of the shared in-memory database
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/cart.db', connect_args={'timeout': 30})
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(User.__table__.insert().values(user_id=1, name="Test User", email="test@example.com",
+                                                                  password_hash="hashed_password"))
+                connection.execute(Product.__table__.insert(), [{'product_id': 1, 'name': "Masala Chai", 'price': 5.0},
+                                                                {'product_id': 2, 'name': "Chai Mug", 'price': 8.0}])
+
+            def add(i):
+                with engine.begin() as connection:
+                    add_item(connection, 1, i % 2 + 1, 1)
+
+            with ThreadPoolExecutor(max_workers=10) as pool:
+                list(pool.map(add, range(100)))
+
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute(select(func.count()).select_from(Cart.__table__)).scalar(), 1)
+                quantities = dict(connection.execute(select(CartItem.__table__.c.product_id, CartItem.__table__.c.quantity)).all())
+            engine.dispose()
+        self.assertEqual(quantities, {1: 50, 2: 50})
+
+
+class BulkCartTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(user_id=1, name="Test User", email="test@example.com", password_hash="hashed_password"))
+            for i in range(1, 21):
+                db.session.add(Product(product_id=i, name=f"Tea {i}", price=float(i), category="Tea", stock_quantity=10))
+            db.session.commit()
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 2, 'quantity': 2})
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_bulk_operations(self):
+        response = self.client.post('/cart/bulk', json={'user_id': 1, 'operations': [
+            {'op': 'add', 'product_id': 1, 'quantity': 3},
+            {'op': 'set', 'product_id': 3, 'quantity': 4},
+            {'op': 'remove', 'product_id': 2}
+        ]})
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertEqual(cart_items(1), {1: 5, 3: 4})
+        # Stock holds follow the cart
+        self.assertEqual(inventory.available(1), 5)
+        self.assertEqual(inventory.available(2), 10)
+        self.assertEqual(inventory.available(3), 6)
+
+    def test_bulk_is_all_or_nothing(self):
+        response = self.client.post('/cart/bulk', json={'user_id': 1, 'operations': [
+            {'op': 'add', 'product_id': 4, 'quantity': 1},
+            {'op': 'set', 'product_id': 5, 'quantity': 11}
+        ]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['product_id'], 5)
+        with app.app_context():
+            self.assertEqual(cart_items(1), {1: 2, 2: 2})
+        self.assertEqual(inventory.available(4), 10)
+
+        response = self.client.post('/cart/bulk', json={'user_id': 1, 'operations': [{'op': 'swap', 'product_id': 1}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_set_overwrites_a_racing_add(self):
+        # Another request adds to the cart after this one read it
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 3})
+        with patch('backend.main.app.cart_store.items', return_value={1: 2, 2: 2}):
+            response = self.client.post('/cart/bulk', json={'user_id': 1, 'operations': [
+                {'op': 'set', 'product_id': 1, 'quantity': 4},
+                {'op': 'remove', 'product_id': 2}
+            ]})
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertEqual(cart_items(1), {1: 4})
+
+    def test_merge_guest_cart_in_one_commit(self):
+        items = [{'product_id': i, 'quantity': 1} for i in range(1, 21)]
+        with app.app_context():
+            with count_queries(db.engine) as counter:
+                response = self.client.post('/cart/merge', json={'user_id': 1, 'items': items})
+            self.assertEqual(response.status_code, 200)
+            # Read the cart, load stock for products new to Redis, upsert the cart row, upsert every line at once
+            assert_max_queries(self, counter, 4)
+            self.assertEqual(cart_items(1), {i: 3 if i <= 2 else 1 for i in range(1, 21)})
+
+
+class RedisCartTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.store = RedisCartStore(redis_conn)
+        self.patcher = patch('backend.main.app.cart_store', self.store)
+        self.patcher.start()
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(user_id=1, name="Test User", email="test@example.com", password_hash="hashed_password"))
+            db.session.add(Cart(cart_id=1, user_id=1))
+            for i in (1, 2, 3):
+                db.session.add(Product(product_id=i, name=f"Tea {i}", price=float(i), category="Tea", stock_quantity=100))
+            db.session.add(CartItem(cart_id=1, product_id=3, quantity=1))
+            db.session.commit()
+
+    def tearDown(self):
+        self.patcher.stop()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_cart_lives_in_redis_until_flushed(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 1})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 2, 'quantity': 4})
+        self.client.delete('/cart/remove', json={'user_id': 1, 'product_id': 2})
+
+        # The existing database cart was loaded on first touch
+        response = self.client.get('/cart/1')
+        self.assertEqual([(item['product_id'], item['quantity']) for item in response.json['items']], [(1, 3), (3, 1)])
+        with app.app_context():
+            self.assertEqual(cart_items(1), {3: 1})
+            self.assertEqual(self.store.flush(), 1)
+            self.assertEqual(cart_items(1), {1: 3, 3: 1})
+            self.assertEqual(self.store.flush(), 0)
+
+    def test_bulk_set_overwrites_a_racing_add(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 3})
+        with patch.object(self.store, 'items', return_value={1: 2, 3: 1}):
+            response = self.client.post('/cart/bulk', json={'user_id': 1, 'operations': [
+                {'op': 'set', 'product_id': 1, 'quantity': 4},
+                {'op': 'add', 'product_id': 1, 'quantity': 1},
+                {'op': 'add', 'product_id': 2, 'quantity': 2}
+            ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.store.items(1), {1: 5, 2: 2, 3: 1})
+
+    def test_flush_batches_many_carts(self):
+        with app.app_context():
+            for user_id in range(2, 12):
+                db.session.add(User(user_id=user_id, name=f"User {user_id}", email=f"user{user_id}@example.com",
+                                    password_hash="hashed_password"))
+            db.session.commit()
+            for user_id in range(2, 12):
+                self.store.add(user_id, 1, user_id)
+            with count_queries(db.engine) as counter:
+                self.assertEqual(self.store.flush(batch_size=5), 10)
+            # Per batch: upsert carts, delete stale lines, upsert lines
+            assert_max_queries(self, counter, 6)
+            self.assertEqual(cart_items(11), {1: 11})
+
+    def test_unfinished_flush_is_retried(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        with app.app_context():
+            with patch.object(self.store, '_write', side_effect=OperationalError('UPDATE', {}, 'database went away')):
+                with self.assertRaises(OperationalError):
+                    self.store.flush()
+            self.assertEqual(cart_items(1), {3: 1})
+            # The batch is still marked as in flight, and goes first on the next run
+            self.assertEqual(redis_conn.smembers(FLUSHING_KEY), {b'1'})
+            self.client.post('/cart/add', json={'user_id': 1, 'product_id': 2, 'quantity': 1})
+            self.assertEqual(self.store.flush(), 2)
+            self.assertEqual(cart_items(1), {1: 2, 2: 1, 3: 1})
+
+    def test_checkout_clears_redis_cart(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        response = self.client.post('/checkout', json={'user_id': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/cart/1').json['message'], 'Cart is empty')
+        with app.app_context():
+            self.store.flush()
+            self.assertEqual(cart_items(1), {})
+
+
+class QueryCountTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+
+            # A user with a 30-item cart, and every product a best seller
+            db.session.add(User(user_id=1, name="Test User", email="test@example.com", password_hash="hashed_password"))
+            db.session.add(Cart(cart_id=1, user_id=1))
+            for i in range(1, 31):
+                db.session.add(Product(product_id=i, name=f"Tea {i}", price=float(i), category="Tea"))
+                db.session.add(CartItem(cart_id=1, product_id=i, quantity=2))
+                db.session.add(BestSeller(product_id=i, quantity_sold=i))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_view_cart(self):
+        with app.app_context():
+            with count_queries(db.engine) as counter:
+                response = self.client.get('/cart/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['cart_id'], 1)
+        self.assertEqual(len(response.json['items']), 30)
+        self.assertEqual(response.json['items'][0]['product_name'], "Tea 1")
+        self.assertEqual(response.json['items'][0]['total_price'], 2.0)
+        assert_max_queries(self, counter, 1)
+
+    def test_view_empty_cart(self):
+        response = self.client.get('/cart/2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['message'], 'Cart is empty')
+
+    def test_best_sellers_query_count(self):
+        with app.app_context():
+            with count_queries(db.engine) as counter:
+                response = self.client.get('/best-sellers')
+                top_response = self.client.get('/best-sellers/top')
+
+        self.assertEqual(len(response.json), 30)
+        self.assertEqual(top_response.json[0]['name'], "Tea 30")
+        assert_max_queries(self, counter, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+import unittest
+from backend.main.app import app, db
+from backend.main.model import User, Product, Subscription, ChatMessage, Recommendation, Cart, CartItem, BestSeller
+from backend.main.migrations import upgrade, pending_migrations
+
+
+class IndexUsageTest(unittest.TestCase):
+    # Every hot lookup must be answered from an index: EXPLAIN QUERY PLAN may
+    # only report SEARCH steps or SCANs that walk an index, never a plain table scan.
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.ctx = app.app_context()
+        self.ctx.push()
+        upgrade(echo=lambda message: None)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def query_plan(self, query):
+        statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+        rows = db.session.execute(db.text(f'EXPLAIN QUERY PLAN {statement}')).all()
+        return [row[-1] for row in rows]
+
+    def assertUsesIndex(self, query):
+        plan = self.query_plan(query)
+        for step in plan:
+            if step.startswith('SCAN'):
+                self.assertIn('USING', step, f'Full table scan in plan: {plan}')
+        self.assertTrue(any('INDEX' in step or 'PRIMARY KEY' in step for step in plan), plan)
+
+    def test_user_by_email(self):
+        self.assertUsesIndex(User.query.filter_by(email='test@example.com'))
+
+    def test_subscriptions_by_user(self):
+        self.assertUsesIndex(Subscription.query.filter_by(user_id=1))
+        self.assertUsesIndex(Subscription.query.filter_by(user_id=1, product_id=1))
+        # The composite index covers user_id alone, so there is no separate one
+        indexes = db.inspect(db.engine).get_indexes('subscription')
+        self.assertEqual([index['column_names'] for index in indexes], [['user_id', 'product_id']])
+
+    def test_messages_by_user(self):
+        self.assertUsesIndex(ChatMessage.query.filter_by(user_id=1))
+
+    def test_cart_items(self):
+        self.assertUsesIndex(Cart.query.filter_by(user_id=1))
+        self.assertUsesIndex(CartItem.query.filter_by(cart_id=1))
+        self.assertUsesIndex(CartItem.query.filter_by(cart_id=1, product_id=1))
+
+    def test_view_cart_join(self):
+        self.assertUsesIndex(db.session.query(CartItem.cart_item_id, Product.name)
+                             .join(Product, Product.product_id == CartItem.product_id)
+                             .join(Cart, Cart.cart_id == CartItem.cart_id)
+                             .filter(Cart.user_id == 1))
+
+    def test_products_by_category_and_slug(self):
+        self.assertUsesIndex(Product.query.filter_by(category='Tea'))
+        self.assertUsesIndex(Product.query.filter_by(slug='green-tea'))
+
+    def test_top_best_sellers(self):
+        self.assertUsesIndex(BestSeller.query.order_by(BestSeller.quantity_sold.desc()).limit(4))
+
+    def test_recommendations_by_product(self):
+        self.assertUsesIndex(Recommendation.query.filter_by(product_id=1))
+
+    def test_no_pending_migrations(self):
+        self.assertEqual(pending_migrations(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
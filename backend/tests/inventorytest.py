@@ -0,0 +1,154 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from backend.main.app import app, db, redis_conn, inventory, reconcile_inventory, cart_store
+from backend.main.model import User, Product, CartItem
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            for user_id in (1, 2):
+                db.session.add(User(user_id=user_id, name=f"User {user_id}", email=f"user{user_id}@example.com",
+                                    password_hash="hashed_password"))
+            db.session.add(Product(product_id=1, name="Masala Chai", price=5.0, category="Tea", stock_quantity=3))
+            db.session.add(Product(product_id=2, name="Chai Mug", price=8.0, category="Teaware", stock_quantity=10))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_add_to_cart_holds_stock(self):
+        response = self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(inventory.available(1), 1)
+
+        response = self.client.post('/cart/add', json={'user_id': 2, 'product_id': 1, 'quantity': 2})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(inventory.available(1), 1)
+
+    def test_invalid_quantities_never_change_stock(self):
+        for quantity in (-5, 0, '2', 1.5, True):
+            response = self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': quantity})
+            self.assertEqual(response.status_code, 400)
+        # The scripts refuse them too, whoever calls them
+        with app.app_context():
+            self.assertFalse(inventory.reserve(1, 1, -5))
+            self.assertEqual(inventory.reserve_many(1, {1: -5}), 1)
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 1})
+        self.assertEqual(inventory.release(1, 1, -5), 0)
+        self.assertEqual(inventory.available(1), 2)
+
+    def test_remove_from_cart_releases_stock(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        with app.app_context():
+            cart_item_id = CartItem.query.first().cart_item_id
+        self.client.delete('/cart/remove', json={'cart_item_id': cart_item_id})
+        self.assertEqual(inventory.available(1), 3)
+
+    def test_concurrent_buyers_never_oversell(self):
+        with app.app_context():
+            inventory.load([1])
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(lambda user_id: inventory.reserve(user_id, 1, 1), range(100)))
+        self.assertEqual(results.count(True), 3)
+        self.assertEqual(inventory.available(1), 0)
+
+    def test_expired_holds_are_released(self):
+        inventory.hold_ttl = -1
+        try:
+            self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 3})
+        finally:
+            inventory.hold_ttl = app.config['STOCK_HOLD_TTL']
+        self.assertEqual(inventory.available(1), 0)
+        self.assertEqual(inventory.release_expired(), 1)
+        self.assertEqual(inventory.available(1), 3)
+
+    def test_checkout_and_reconcile(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 2, 'quantity': 4})
+
+        response = self.client.post('/checkout', json={'user_id': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['items']), 2)
+        self.assertEqual(self.client.get('/cart/1').json['message'], 'Cart is empty')
+
+        # Sales only reach the database when reconciled, in one batch
+        with app.app_context():
+            self.assertEqual(db.session.get(Product, 1).stock_quantity, 3)
+            self.assertEqual(reconcile_inventory(), {1: 2, 2: 4})
+            db.session.expire_all()
+            self.assertEqual(db.session.get(Product, 1).stock_quantity, 1)
+            self.assertEqual(db.session.get(Product, 2).stock_quantity, 6)
+            self.assertEqual(reconcile_inventory(), {})
+        self.assertEqual(inventory.available(1), 1)
+
+    def test_product_page_shows_live_stock(self):
+        self.assertEqual(self.client.get('/products/1').json['stock_quantity'], 3)
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/checkout', json={'user_id': 1})
+        # The cached page is reused, with the stock read when it is served
+        self.assertEqual(self.client.get('/products/1').json['stock_quantity'], 1)
+        with app.app_context():
+            reconcile_inventory()
+        response = self.client.get('/products/1')
+        self.assertEqual((response.json['name'], response.json['stock_quantity']), ("Masala Chai", 1))
+
+    def test_double_checkout_sells_the_cart_once(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 2, 'quantity': 3})
+        clear, repeats = cart_store.clear, []
+
+        def clear_after_a_second_submit(user_id):
+            # The same checkout arrives again while the first one is still running
+            repeats.append(self.client.post('/checkout', json={'user_id': 1}))
+            clear(user_id)
+
+        with patch.object(cart_store, 'clear', side_effect=clear_after_a_second_submit):
+            self.assertEqual(self.client.post('/checkout', json={'user_id': 1}).status_code, 200)
+        self.assertEqual(repeats[0].status_code, 409)
+        self.assertEqual(self.client.post('/checkout', json={'user_id': 1}).status_code, 400)
+        self.assertEqual(int(redis_conn.hget('inventory:sold', 2)), 3)
+        self.assertEqual(inventory.available(2), 7)
+
+    def test_reconcile_never_applies_a_batch_twice(self):
+        self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 2})
+        self.client.post('/checkout', json={'user_id': 1})
+
+        with app.app_context():
+            # The run dies after committing, before the batch is cleared from Redis
+            with patch.object(redis_conn, 'delete', side_effect=ConnectionError):
+                with self.assertRaises(ConnectionError):
+                    reconcile_inventory()
+            self.assertEqual(reconcile_inventory(), {1: 2})
+            db.session.expire_all()
+            self.assertEqual(db.session.get(Product, 1).stock_quantity, 1)
+            self.assertEqual(reconcile_inventory(), {})
+        self.assertEqual(inventory.available(1), 1)
+
+    def test_checkout_fails_when_expired_stock_was_taken(self):
+        inventory.hold_ttl = -1
+        try:
+            self.client.post('/cart/add', json={'user_id': 1, 'product_id': 1, 'quantity': 3})
+        finally:
+            inventory.hold_ttl = app.config['STOCK_HOLD_TTL']
+        inventory.release_expired()
+        self.client.post('/cart/add', json={'user_id': 2, 'product_id': 1, 'quantity': 2})
+
+        response = self.client.post('/checkout', json={'user_id': 1})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['product_id'], 1)
+        # Nothing was sold and the cart is kept
+        self.assertEqual(inventory.available(1), 1)
+        self.assertEqual(len(self.client.get('/cart/1').json['items']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
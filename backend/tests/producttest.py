@@ -1,7 +1,11 @@
 import unittest
-from backend.main.app import app, db, redis_conn
+from backend.main.app import app, db, redis_conn, catalog_cache, local_cache, facet_index, suggest_index, \
+    category_engine
 from backend.main.model import Product, User
+from backend.main.search import clear_memory_index
+from backend.tests.querycount import count_queries
 import json
+import gzip
 import warnings
 from sqlalchemy.exc import LegacyAPIWarning
 
@@ -46,6 +50,10 @@ class TestProductManagement(unittest.TestCase):
             db.session.remove()
             db.drop_all()
             redis_conn.flushdb()  # Clear Redis cache
+        if local_cache:
+            local_cache.clear()  # Clear the in-process L1 cache
+        category_engine.clear()  # Catalog versions restart from 0 after the flush
+        clear_memory_index()  # Drop the in-memory search index
 
     def test_get_products_success(self):
         # Send GET request to /products
@@ -66,7 +74,8 @@ class TestProductManagement(unittest.TestCase):
             "category": "Cached Category",
             "image_url": "http://example.com/cached.png"
         }]
-        redis_conn.setex("products", 3600, json.dumps(products_data))
+        version = catalog_cache.version()
+        catalog_cache.set("products", products_data, version)
 
         # Send GET request to /products
         response = self.client.get('/products')
@@ -76,6 +85,339 @@ class TestProductManagement(unittest.TestCase):
         response_data = response.get_json()
         self.assertEqual(response_data[0]['name'], "Cached Product")
 
+    def test_get_products_not_modified(self):
+        # The first response carries an ETag for the cached body
+        response = self.client.get('/products')
+        etag = response.headers['ETag']
+
+        # Revalidating with that ETag returns 304 without a body
+        response = self.client.get('/products', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_get_products_precompressed(self):
+        # Grow the catalog past the compression threshold
+        with app.app_context():
+            for i in range(30):
+                db.session.add(Product(name=f"Product {i}", price=1.0, category="Test Category"))
+            db.session.commit()
+        etag = self.client.get('/products').headers['ETag']
+
+        response = self.client.get('/products', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 31)
+        # Each encoding is its own representation with its own strong ETag
+        self.assertEqual(response.headers['ETag'], etag[:-1] + '-gzip"')
+        response = self.client.get('/products', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_products_cache_invalidated_on_write(self):
+        # Warm the cache, then change the product
+        self.client.get('/products')
+        self.client.put('/products/1', json={
+            "name": "Renamed Product",
+            "price": 9.99,
+            "category": "Test Category",
+            "stock_quantity": 100
+        })
+
+        # The cached list must not be served after the write
+        response = self.client.get('/products')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()[0]['name'], "Renamed Product")
+
+    def test_listing_selects_only_listing_columns(self):
+        with app.app_context():
+            with count_queries(db.engine) as counter:
+                products_response = self.client.get('/products')
+                teas_response = self.client.get('/collection/teas')
+
+        self.assertEqual(products_response.get_json()[0]['name'], "Test Product")
+        self.assertEqual(teas_response.get_json(), [])
+        # The listing queries never pull the description column
+        self.assertTrue(counter.statements)
+        for statement in counter.statements:
+            self.assertNotIn('description', statement)
+
+    def test_get_products_paginated(self):
+        with app.app_context():
+            for i in range(4):
+                db.session.add(Product(name=f"Product {i}", price=1.0, category="Test Category"))
+            db.session.commit()
+
+        # Walk the catalog two products at a time using the returned cursor
+        first_page = self.client.get('/products?limit=2').get_json()
+        self.assertEqual([p['product_id'] for p in first_page['items']], [1, 2])
+        self.assertEqual(first_page['next_after'], 2)
+
+        last_page = self.client.get('/products?limit=2&after=4').get_json()
+        self.assertEqual([p['product_id'] for p in last_page['items']], [5])
+        self.assertIsNone(last_page['next_after'])
+
+    def test_get_products_streamed(self):
+        with app.app_context():
+            for i in range(4):
+                db.session.add(Product(name=f"Product {i}", price=1.0, category="Test Category"))
+            db.session.commit()
+
+        response = self.client.get('/products?stream=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 5)
+
+        response = self.client.get('/search?q=Product 3&stream=true')
+        self.assertEqual([p['name'] for p in json.loads(response.data)], ["Product 3"])
+
+    def test_search_ranks_name_matches_first(self):
+        with app.app_context():
+            db.session.add(Product(name="Masala Chai", description="Spiced black tea", price=5.0, category="Tea"))
+            db.session.add(Product(name="Chai Mug", description="Ceramic mug", price=8.0, category="Teaware"))
+            db.session.add(Product(name="Green Tea", description="Not chai at all", price=4.0, category="Tea"))
+            db.session.commit()
+        catalog_cache.invalidate()
+
+        # Prefix match on whole words, ranked by where the term appears
+        response = self.client.get('/search?q=cha')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['name'] for p in response.get_json()], ["Masala Chai", "Chai Mug", "Green Tea"])
+
+        response = self.client.get('/search?q=chai mug')
+        self.assertEqual([p['name'] for p in response.get_json()], ["Chai Mug"])
+
+    def test_search_pages_end_on_a_stale_cursor(self):
+        for name in ("Masala Chai", "Chai Mug", "Green Chai"):
+            self.client.post('/products', json={"name": name, "price": 5.0, "category": "Tea"})
+
+        first = self.client.get('/search?q=chai&limit=1').get_json()
+        self.assertEqual(len(first['items']), 1)
+        # The cursor's product is deleted before the next page is asked for
+        self.client.delete(f"/products/{first['next_after']}")
+        stale = self.client.get(f"/search?q=chai&limit=1&after={first['next_after']}").get_json()
+        self.assertEqual(stale, {'items': [], 'next_after': None})
+
+    def test_search_query_normalized_for_cache(self):
+        first = self.client.get('/search?q=Test')
+        second = self.client.get('/search?q=  TEST ')
+
+        self.assertEqual(first.get_json()[0]['name'], "Test Product")
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        version = catalog_cache.version()
+        self.assertTrue(redis_conn.exists(catalog_cache.key("search_results:test", version)))
+
+    def test_suggest_by_prefix_and_popularity(self):
+        self.client.post('/products', json={"name": "Masala Chai", "price": 5.0, "category": "Tea"})
+        self.client.post('/products', json={"name": "Chai Mug", "price": 8.0, "category": "Teaware"})
+        self.client.post('/best-sellers', json={"product_id": 3, "quantity_sold": 50})
+
+        # Word prefixes match anywhere in the name; best sellers come first
+        response = self.client.get('/search/suggest?prefix=CHA')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s['name'] for s in response.get_json()], ["Chai Mug", "Masala Chai"])
+
+        # Renames and deletes update the index incrementally
+        self.client.put('/products/2', json={"name": "Kashmiri Chai", "price": 5.0, "category": "Tea"})
+        self.client.delete('/products/3')
+        response = self.client.get('/search/suggest?prefix=chai')
+        self.assertEqual([s['name'] for s in response.get_json()], ["Kashmiri Chai"])
+
+        response = self.client.get('/search/suggest?prefix=te')
+        self.assertIn({"type": "category", "name": "Test Category"}, response.get_json())
+
+    def test_best_seller_suggested_past_the_lexical_candidates(self):
+        for i in range(suggest_index.candidates + 10):
+            self.client.post('/products', json={"name": f"Assam {i:03d}", "price": 5.0, "category": "Tea"})
+        # Sorts after every "assam ..." entry
+        self.client.post('/products', json={"name": "Azure Oolong", "price": 5.0, "category": "Tea"})
+        product_id = suggest_index.candidates + 12
+        self.client.post('/best-sellers', json={"product_id": product_id, "quantity_sold": 50})
+
+        response = self.client.get('/search/suggest?prefix=a&limit=3')
+        self.assertEqual(response.get_json()[0], {"type": "product", "product_id": product_id, "name": "Azure Oolong"})
+
+    def test_category_suggestions_follow_their_products(self):
+        self.client.post('/products', json={"name": "Masala Chai", "price": 5.0, "category": "Chai"})
+        self.client.post('/products', json={"name": "Ginger Chai", "price": 5.0, "category": "Chai"})
+        self.client.post('/best-sellers', json={"product_id": 2, "quantity_sold": 30})
+        categories = lambda: [s['name'] for s in self.client.get('/search/suggest?prefix=ch').get_json()
+                              if s['type'] == 'category']
+        self.assertEqual(categories(), ["Chai"])
+
+        # Moving one product keeps the category, moving the last one removes it
+        self.client.put('/products/2', json={"name": "Masala Chai", "price": 5.0, "category": "Spiced Tea"})
+        self.assertEqual(categories(), ["Chai"])
+        self.assertEqual(redis_conn.zscore('catalog:suggest:popular', 'c:Spiced Tea'), 30)
+        self.assertEqual(redis_conn.zscore('catalog:suggest:popular', 'c:Chai'), 0)
+        self.client.delete('/products/3')
+        self.assertEqual(categories(), [])
+
+    def test_filter_products_with_facet_counts(self):
+        self.client.post('/products', json={"name": "Masala Chai", "price": 5.0, "category": "Tea", "stock_quantity": 10})
+        self.client.post('/products', json={"name": "Green Tea", "price": 15.0, "category": "Tea", "stock_quantity": 0})
+        self.client.post('/products', json={"name": "Chai Mug", "price": 25.0, "category": "Teaware", "stock_quantity": 3})
+
+        response = self.client.get('/products/filter?category=tea&in_stock=true')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual([p['name'] for p in data['items']], ["Masala Chai"])
+        # Each facet's counts ignore that facet's own filter
+        self.assertEqual({c['slug']: c['count'] for c in data['facets']['category']},
+                         {"test-category": 1, "tea": 1, "teaware": 1})
+        self.assertEqual({b['bucket']: b['count'] for b in data['facets']['price']},
+                         {"0-10": 1, "10-20": 0, "20-50": 0, "50-100": 0, "100+": 0})
+        self.assertEqual(data['facets']['in_stock'], 1)
+
+        # Writes move products between facet sets incrementally
+        self.client.put('/products/3', json={"name": "Green Tea", "price": 15.0, "category": "Tea", "stock_quantity": 5})
+        self.client.delete('/products/2')
+        data = self.client.get('/products/filter?category=tea&price=10-20,20-50').get_json()
+        self.assertEqual([p['name'] for p in data['items']], ["Green Tea"])
+        self.assertEqual(data['total'], 1)
+
+        data = self.client.get('/products/filter?limit=2').get_json()
+        self.assertEqual([p['product_id'] for p in data['items']], [1, 3])
+        self.assertEqual(data['next_after'], 3)
+        self.assertEqual(self.client.get('/products/filter?price=cheap').status_code, 400)
+
+    def test_filter_never_caches_an_unbuilt_index(self):
+        redis_conn.delete('catalog:facet:built')
+        # Another worker is building the index
+        redis_conn.set('catalog:facet:lock', 1)
+        build_wait, facet_index.build_wait = facet_index.build_wait, 0.1
+        try:
+            response = self.client.get('/products/filter')
+        finally:
+            facet_index.build_wait = build_wait
+        self.assertEqual(response.status_code, 503)
+
+        redis_conn.delete('catalog:facet:lock')
+        data = self.client.get('/products/filter').get_json()
+        self.assertEqual(data['total'], 1)
+
+    def test_filter_cached_during_a_write_is_dropped(self):
+        self.assertEqual(len(self.client.get('/products/filter?price=0-10').get_json()['items']), 1)
+        index_product = facet_index.index_product
+
+        def index_after_a_filter_request(*args):
+            # A filter request lands after the database write but before the index catches up
+            self.client.get('/products/filter?price=0-10')
+            index_product(*args)
+
+        facet_index.index_product = index_after_a_filter_request
+        try:
+            self.client.put('/products/1', json={"name": "Test Product", "price": 60.0, "category": "Test Category",
+                                                 "stock_quantity": 100})
+        finally:
+            facet_index.index_product = index_product
+        self.assertEqual(self.client.get('/products/filter?price=0-10').get_json()['items'], [])
+
+    def test_bulk_import_and_export(self):
+        csv_body = (
+            "name,description,price,category,image_url,stock_quantity\n"
+            "Masala Chai,Spiced,5.5,Tea,,20\n"
+            "Test Product,Same name as the seeded product,3,Tea,,\n"
+            ",Missing name,1,Tea,,1\n"
+            "Chai Mug,,not a price,Teaware,,1\n"
+            "Tea Pot,,nan,Teaware,,1\n"
+            "Tea Cosy,,inf,Teaware,,1\n"
+        )
+        self.client.get('/products')  # warm the cache
+        response = self.client.post('/admin/products/import?format=csv&chunk_size=1', data=csv_body)
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual((report['read'], report['imported'], report['rejected']), (6, 2, 4))
+        self.assertEqual([error['line'] for error in report['errors']], [4, 5, 6, 7])
+
+        # Slugs are assigned without the ORM events, and the cache was invalidated once
+        products = self.client.get('/products').get_json()
+        self.assertEqual([p['name'] for p in products], ["Test Product", "Masala Chai", "Test Product"])
+        self.assertEqual(self.client.get('/collection/test-product-2').get_json()['product_id'], 3)
+        self.assertEqual(self.client.get('/search/suggest?prefix=masala').get_json()[0]['name'], "Masala Chai")
+
+        response = self.client.post('/admin/products/import?format=jsonl',
+                                    data='{"name": "Green Tea", "price": 4, "category": "Tea"}\nnot json\n')
+        self.assertEqual((response.get_json()['imported'], response.get_json()['rejected']), (1, 1))
+
+        response = self.client.get('/admin/products/export?format=jsonl')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['slug'] for line in lines], ["test-product", "masala-chai", "test-product-2", "green-tea"])
+        response = self.client.get('/admin/products/export?format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 5)
+
+    def test_get_product_by_slug(self):
+        with app.app_context():
+            self.assertEqual(Product.query.get(1).slug, "test-product")
+            # Duplicate names get a numbered slug
+            db.session.add(Product(name="Test Product", price=1.0, category="Test Category"))
+            db.session.commit()
+            self.assertEqual(Product.query.get(2).slug, "test-product-2")
+
+        response = self.client.get('/collection/test-product-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['product_id'], 2)
+
+        # Renaming a product moves its slug
+        self.client.put('/products/1', json={"name": "Earl Grey", "price": 9.99, "category": "Test Category"})
+        self.assertEqual(self.client.get('/collection/earl-grey').get_json()['product_id'], 1)
+
+    def test_get_product_fuzzy_fallback(self):
+        # Unknown slugs still find products by partial name
+        response = self.client.get('/collection/test')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['name'], "Test Product")
+
+        response = self.client.get('/collection/no-such-tea')
+        self.assertEqual(response.status_code, 404)
+
+    def test_category_listing(self):
+        for name, price, category in [("Green Tea", 4.0, "Tea"), ("Black Tea", 6.0, "Tea"),
+                                      ("Oolong", 12.0, "Tea"), ("Sencha", 9.0, "Tea Leaves")]:
+            self.client.post('/products', json={"name": name, "price": price, "category": category})
+
+        # Old routes are aliases of the category engine
+        response = self.client.get('/collection/teas')
+        self.assertEqual([p['name'] for p in response.get_json()], ["Green Tea", "Black Tea", "Oolong"])
+        self.assertEqual(self.client.get('/collection/tealeaves').get_json()[0]['name'], "Sencha")
+        self.assertEqual(self.client.get('/collection/snacks').get_json(), [])
+
+        # Sort, price range and pagination
+        response = self.client.get('/collection/category/tea?sort=price_desc&max_price=10&limit=1')
+        self.assertEqual(response.get_json(), {
+            "items": [{"product_id": 3, "name": "Black Tea", "price": 6.0, "category": "Tea", "image_url": None}],
+            "next_after": 3
+        })
+        response = self.client.get('/collection/category/tea?sort=price_desc&max_price=10&limit=1&after=3')
+        self.assertEqual([p['name'] for p in response.get_json()['items']], ["Green Tea"])
+        self.assertIsNone(response.get_json()['next_after'])
+
+        self.assertEqual(self.client.get('/collection/category/tea?sort=cheapest').status_code, 400)
+
+    def test_category_pages_end_on_a_stale_cursor(self):
+        for name in ("Green Tea", "Black Tea", "Oolong"):
+            self.client.post('/products', json={"name": name, "price": 5.0, "category": "Tea"})
+
+        first = self.client.get('/collection/category/tea?limit=2').get_json()
+        self.assertEqual(first['next_after'], 3)
+        # The cursor's product is deleted before the next page is asked for
+        self.client.delete('/products/3')
+        stale = self.client.get('/collection/category/tea?limit=2&after=3').get_json()
+        self.assertEqual(stale, {'items': [], 'next_after': None})
+
+    def test_category_listing_single_query_per_version(self):
+        self.client.get('/collection/teas')
+        with app.app_context():
+            with count_queries(db.engine) as counter:
+                self.client.get('/collection/snacks')
+                self.client.get('/collection/category/test-category?sort=name')
+        self.assertEqual(counter.count, 0)
+
+    def test_category_partitions_stored_per_category(self):
+        self.client.post('/products', json={"name": "Sencha", "price": 9.0, "category": "Tea Leaves"})
+        self.client.get('/collection/tealeaves')
+        key = catalog_cache.key('category_partitions:by_slug', catalog_cache.version())
+        self.assertEqual(sorted(redis_conn.hkeys(key)), [b'_', b'tea-leaves', b'test-category'])
+        self.assertEqual([p['name'] for p in json.loads(redis_conn.hget(key, 'tea-leaves'))], ["Sencha"])
+
     def test_get_product_success(self):
         # Send POST request to /view-product/<product_id>
         response = self.client.post('/view-product/1', json={"email": "test@example.com"})
@@ -1,5 +1,5 @@
 import unittest
-from backend.main.app import app, db, redis_conn
+from backend.main.app import app, db, redis_conn, profile_cache
 from backend.main.model import User
 from werkzeug.security import generate_password_hash
 import json
@@ -53,15 +53,15 @@ class TestUserProfile(unittest.TestCase):
 
     def test_get_profile_cached(self):
         # Manually cache the user profile in Redis
-        redis_conn.setex(
-            f"user_profile:john@example.com", 3600,
-            json.dumps({
-                "name": "John Doe",
-                "email": "john@example.com",
-                "phone_number": "1234567890",
-                "shipping_address": "123 Main St"
-            })
-        )
+        profile_cache.store("john@example.com", 0, {
+            "name": "John Doe",
+            "email": "john@example.com",
+            "phone_number": "1234567890",
+            "shipping_address": "123 Main St"
+        })
+        with app.app_context():
+            db.session.query(User).delete()
+            db.session.commit()
 
         # Send GET request to /profile
         response = self.client.get('/profile', json={"email": "john@example.com"})
@@ -95,6 +95,37 @@ class TestUserProfile(unittest.TestCase):
             self.assertEqual(user.phone_number, "0987654321")
             self.assertEqual(user.shipping_address, "456 Updated St")
 
+    def test_update_profile_writes_through(self):
+        self.client.get('/profile', json={"email": "john@example.com"})
+        self.client.put('/profile', json={"email": "john@example.com", "name": "John Updated",
+                                          "phone_number": "1234567890", "shipping_address": "456 Updated St"})
+
+        cached = json.loads(profile_cache.get("john@example.com"))
+        self.assertEqual(cached['shipping_address'], "456 Updated St")
+        self.assertEqual(self.client.get('/profile', json={"email": "john@example.com"}).get_json()['name'],
+                         "John Updated")
+        with app.app_context():
+            self.assertEqual(User.query.filter_by(email="john@example.com").first().profile_version, 1)
+
+    def test_unchanged_profile_is_not_written(self):
+        unchanged = {"email": "john@example.com", "name": "John Doe",
+                     "phone_number": "1234567890", "shipping_address": "123 Main St"}
+        response = self.client.put('/profile', json=unchanged)
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertEqual(User.query.filter_by(email="john@example.com").first().profile_version, 0)
+
+    def test_older_profile_never_replaces_newer(self):
+        profile_cache.store("john@example.com", 2, {"name": "New"})
+        profile_cache.store("john@example.com", 1, {"name": "Old"})
+        self.assertEqual(json.loads(profile_cache.get("john@example.com"))['name'], "New")
+
+    def test_profiles_cached_before_upgrade_are_ignored(self):
+        redis_conn.setex("user_profile:john@example.com", 3600, json.dumps({"name": "Stale"}))
+        self.assertEqual(self.client.get('/profile', json={"email": "john@example.com"}).get_json()['name'], "John Doe")
+        response = self.client.put('/profile', json={"email": "john@example.com", "name": "John Updated"})
+        self.assertEqual(response.status_code, 200)
+
     def test_update_profile_user_not_found(self):
         # Send PUT request to /profile with a non-existent email
         updated_data = {
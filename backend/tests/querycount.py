@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+#Query count harness
+#Counts the SQL statements an engine executes inside the block, so tests can
+#assert a route runs a bounded number of queries and N+1 regressions fail CI.
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+def assert_max_queries(testcase, counter, limit):
+    testcase.assertLessEqual(
+        counter.count, limit,
+        f"Expected at most {limit} queries, got {counter.count}:\n" + "\n".join(counter.statements))
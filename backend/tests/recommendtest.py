@@ -1,53 +1,150 @@
+import json
+import time
 import unittest
-from unittest.mock import patch
-from backend.main.app import app, db, redis_conn
-from backend.main.model import User, Product
+from backend.main.app import app, db, redis_conn, recommender, recommendation_cache, recommendations_for, view_history
+from backend.main.model import User, Product, Cart, CartItem, Recommendation
+from backend.main.recommend import similar_items, _similar_items_python
 
 class RecommendRouteTest(unittest.TestCase):
     def setUp(self):
-        # Set up the Flask test client and initialize the database for testing
-        self.app = app.test_client()
-        self.app.testing = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        self.client = app.test_client()
 
-        # Mock database session
-        self.patcher = patch('backend.main.app.db.session')
-        self.mock_db_session = self.patcher.start()
+        with app.app_context():
+            db.create_all()
+            for user_id in (1, 2, 3):
+                db.session.add(User(user_id=user_id, name=f"User {user_id}", email=f"user{user_id}@example.com",
+                                    password_hash="hashed_password"))
+            for product_id, name in enumerate(["Green Tea", "Black Tea", "Herbal Tea", "Tea Pot", "Chai Mug"], 1):
+                db.session.add(Product(product_id=product_id, name=name, category="Tea", price=10.0))
+            # User 3 carted green tea together with a tea pot
+            db.session.add(Cart(cart_id=1, user_id=3))
+            db.session.add(CartItem(cart_id=1, product_id=1, quantity=1))
+            db.session.add(CartItem(cart_id=1, product_id=4, quantity=1))
+            db.session.commit()
+
+        # Green and black tea are often viewed together, and once with herbal tea
+        now = time.time()
+        redis_conn.zadd("user:1:recent_views", {1: now, 2: now, 3: now})
+        redis_conn.zadd("user:2:recent_views", {1: now, 2: now})
 
     def tearDown(self):
-        self.patcher.stop()
-
-    @patch('backend.main.app.redis_conn')
-    @patch('backend.main.app.Product.query')
-    @patch('backend.main.app.User.query')
-    def test_get_recommendations_success(self, mock_user_query, mock_product_query, mock_redis):
-        # Mock user
-        mock_user = User(user_id=1, email="test@example.com")
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
-
-        # Mock Redis cache
-        mock_redis.get.return_value = None
-        
-        # Mock viewed products in Redis
-        mock_redis.smembers.return_value = {"1", "2"}
-
-        # Mock product query
-        mock_viewed_products = [
-            Product(product_id=1, name="Green Tea", category="Tea", price=10.0, image_url="image1.jpg"),
-            Product(product_id=2, name="Black Tea", category="Tea", price=15.0, image_url="image2.jpg")
-        ]
-        mock_recommended_products = [
-            Product(product_id=3, name="Herbal Tea", category="Tea", price=20.0, image_url="image3.jpg")
-        ]
-        
-        mock_product_query.filter.return_value.filter.return_value.limit.return_value.all.side_effect = [mock_viewed_products, mock_recommended_products]
-
-        # Test data
-        response = self.app.get('/recommendations?email=test@example.com')
-
-        # Verify response
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_get_recommendations_success(self):
+        with app.app_context():
+            self.assertEqual(recommender.build(top_k=10), 4)
+            # The table keeps the top-K neighbours with their similarity; co-carting weighs more than co-viewing
+            neighbours = Recommendation.query.filter_by(product_id=1).order_by(Recommendation.score.desc()).all()
+            self.assertEqual([n.recommended_product_id for n in neighbours], [4, 2, 3])
+
+        redis_conn.delete("user:2:recent_views")
+        redis_conn.zadd("user:2:recent_views", {1: time.time()})
+        response = self.client.get('/recommendations?email=user2@example.com')
+
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json[0]['name'], "Green Tea")
+        # Neighbours first, then the rest of the viewed category
+        self.assertEqual([p['name'] for p in response.json], ["Tea Pot", "Black Tea", "Herbal Tea", "Chai Mug"])
+
+    def test_recommendations_reloaded_from_table(self):
+        with app.app_context():
+            recommender.build()
+        for key in redis_conn.scan_iter(match='recommend:*'):
+            redis_conn.delete(key)
+
+        response = self.client.get('/recommendations?email=user2@example.com')
+        self.assertEqual([p['name'] for p in response.json], ["Herbal Tea", "Tea Pot", "Chai Mug"])
+
+    def test_same_category_before_first_build(self):
+        with app.app_context():
+            db.session.add(Product(product_id=6, name="Cookies", category="Snack", price=3.0))
+            db.session.commit()
+        response = self.client.get('/recommendations?email=user2@example.com')
+        self.assertEqual([p['name'] for p in response.json], ["Herbal Tea", "Tea Pot", "Chai Mug"])
+
+    def test_no_views_or_user(self):
+        response = self.client.get('/recommendations?email=user3@example.com')
+        self.assertEqual(response.json['message'], 'No viewed products found')
+        response = self.client.get('/recommendations?email=nobody@example.com')
+        self.assertEqual(response.status_code, 404)
+
+    def test_recommendations_cached_per_user(self):
+        with app.app_context():
+            recommender.build()
+        first = self.client.get('/recommendations?email=user2@example.com')
+        self.assertEqual(redis_conn.get('recommend:user:2'), first.data)
+
+        # Served from the cache even once the precomputed neighbours are gone
+        hits = recommendation_cache.stats()['hits']
+        for key in redis_conn.scan_iter(match='recommend:item:*'):
+            redis_conn.delete(key)
+        second = self.client.get('/recommendations?email=user2@example.com')
+        self.assertEqual(second.json, first.json)
+        self.assertEqual(recommendation_cache.stats()['hits'], hits + 1)
+        self.assertIn('hit_ratio', self.client.get('/metrics').json['recommendations'])
+
+    def test_new_view_invalidates_and_worker_refreshes(self):
+        with app.app_context():
+            recommender.build()
+        self.assertEqual([p['name'] for p in self.client.get('/recommendations?email=user2@example.com').json],
+                         ["Herbal Tea", "Tea Pot", "Chai Mug"])
+
+        # Viewing an already viewed product keeps the cached list
+        self.client.post('/view-product/1', json={'email': 'user2@example.com'})
+        self.assertTrue(redis_conn.exists('recommend:user:2'))
+
+        self.client.post('/view-product/3', json={'email': 'user2@example.com'})
+        self.assertFalse(redis_conn.exists('recommend:user:2'))
+        with app.app_context():
+            self.assertEqual(recommendation_cache.refresh_stale(recommendations_for), 1)
+        self.assertEqual([p['name'] for p in json.loads(redis_conn.get('recommend:user:2'))], ["Tea Pot", "Chai Mug"])
+
+        # Both users were active, so a rebuild precomputes both
+        self.client.post('/view-product/2', json={'email': 'user1@example.com'})
+        with app.app_context():
+            self.assertEqual(recommendation_cache.refresh_active(recommendations_for), 2)
+        self.assertTrue(redis_conn.exists('recommend:user:1'))
+
+    def test_view_history_is_capped_and_expires(self):
+        limit = view_history.limit
+        view_history.limit = 3
+        try:
+            for product_id in (1, 2, 3, 4, 2):
+                self.client.post(f'/view-product/{product_id}', json={'email': 'user3@example.com'})
+        finally:
+            view_history.limit = limit
+        # Oldest first; the repeat view of 2 moved it to the end
+        self.assertEqual(redis_conn.zrange('user:3:recent_views', 0, -1), [b'3', b'4', b'2'])
+        self.assertGreater(redis_conn.ttl('user:3:recent_views'), 0)
+
+    def test_recent_views_weigh_more(self):
+        recommender.publish({10: [(20, 1.0)], 11: [(21, 0.9)]})
+        now, day = time.time(), 86400
+        redis_conn.zadd("user:3:recent_views", {10: now - 60 * day, 11: now})
+        self.assertEqual(recommender.for_user(3, limit=2), [21, 20])
+        redis_conn.zadd("user:3:recent_views", {10: now, 11: now - 60 * day})
+        self.assertEqual(recommender.for_user(3, limit=2), [20, 21])
+
+    def test_migrate_viewed_sets(self):
+        redis_conn.sadd("user:3:viewed_products", 4, 5)
+        self.assertEqual(view_history.migrate_sets(), 1)
+        self.assertFalse(redis_conn.exists("user:3:viewed_products"))
+        self.assertEqual(sorted(redis_conn.zrange("user:3:recent_views", 0, -1)), [b'4', b'5'])
+
+    def test_similarity_matches_fallback(self):
+        interactions = {1: {1: 1.0, 2: 1.0, 3: 1.0}, 2: {1: 1.0, 2: 1.0}, 3: {1: 2.0, 4: 2.0}}
+        expected = _similar_items_python(interactions, 2)
+        actual = similar_items(interactions, 2)
+        self.assertEqual(actual.keys(), expected.keys())
+        for product_id, scored in expected.items():
+            self.assertEqual([other for other, _ in actual[product_id]], [other for other, _ in scored])
+            for (_, a), (_, b) in zip(actual[product_id], scored):
+                self.assertAlmostEqual(a, b)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -20,14 +20,14 @@ class SubscribeRouteTest(unittest.TestCase):
     def tearDown(self):
         self.patcher.stop()
 
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Product.query')
-    def test_subscribe_success(self, mock_product_query, mock_user_query):
+    def test_subscribe_success(self, mock_product_query, mock_identity_get):
         # Mock user and product
         mock_user = User(user_id=1, email="test@example.com")
         mock_product = Product(product_id=1, name="Green Tea")
 
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
         mock_product_query.get.return_value = mock_product
 
         # Test data
@@ -47,12 +47,12 @@ class SubscribeRouteTest(unittest.TestCase):
         self.assertTrue(self.mock_db_session.commit.called)
 
 
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Subscription.query')
-    def test_get_subscriptions_success(self, mock_subscription_query, mock_user_query):
+    def test_get_subscriptions_success(self, mock_subscription_query, mock_identity_get):
         # Mock user and subscriptions
         mock_user = User(user_id=1, email="test@example.com")
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
 
         mock_subscriptions = [
             Subscription(subscription_id=1, user_id=1, product_id=101),
@@ -73,14 +73,14 @@ class SubscribeRouteTest(unittest.TestCase):
         self.assertEqual(response.json[0]["subscription_id"], 1)
         self.assertEqual(response.json[0]["product_id"], 101)
     
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Subscription.query')
-    def test_unsubscribe_success(self, mock_subscription_query, mock_user_query):
+    def test_unsubscribe_success(self, mock_subscription_query, mock_identity_get):
         # Mock user and subscription
         mock_user = User(user_id=1, email="test@example.com")
         mock_subscription = Subscription(subscription_id=1, user_id=1, product_id=101, status='active')
 
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
         mock_subscription_query.filter_by.return_value.first.return_value = mock_subscription
 
         # Test data
@@ -96,14 +96,14 @@ class SubscribeRouteTest(unittest.TestCase):
         self.assertEqual(response.json["message"], "Unsubscribed successfully")
         self.assertEqual(mock_subscription.status, 'cancelled')
         
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Subscription.query')
-    def test_update_subscription_success(self, mock_subscription_query, mock_user_query):
+    def test_update_subscription_success(self, mock_subscription_query, mock_identity_get):
         # Mock user and subscription
         mock_user = User(user_id=1, email="test@example.com")
         mock_subscription = Subscription(subscription_id=1, user_id=1, product_id=101, frequency="monthly", quantity=1)
 
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
         mock_subscription_query.filter_by.return_value.first.return_value = mock_subscription
 
         # Test data
@@ -122,14 +122,14 @@ class SubscribeRouteTest(unittest.TestCase):
         self.assertEqual(mock_subscription.frequency, "weekly")
         self.assertEqual(mock_subscription.quantity, 2)
     
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Subscription.query')
-    def test_get_subscription_status_success(self, mock_subscription_query, mock_user_query):
+    def test_get_subscription_status_success(self, mock_subscription_query, mock_identity_get):
         # Mock user and subscription
         mock_user = User(user_id=1, email="test@example.com")
         mock_subscription = Subscription(subscription_id=1, user_id=1, product_id=101, status='active')
 
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
         mock_subscription_query.filter_by.return_value.first.return_value = mock_subscription
 
         # Test data
@@ -144,12 +144,12 @@ class SubscribeRouteTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json["status"], "active")
 
-    @patch('backend.main.app.User.query')
+    @patch('backend.main.app.identities.get')
     @patch('backend.main.app.Subscription.query')
-    def test_get_subscription_history_success(self, mock_subscription_query, mock_user_query):
+    def test_get_subscription_history_success(self, mock_subscription_query, mock_identity_get):
         # Mock user and subscriptions
         mock_user = User(user_id=1, email="test@example.com")
-        mock_user_query.filter_by.return_value.first.return_value = mock_user
+        mock_identity_get.return_value = mock_user
 
         mock_subscriptions = [
             Subscription(subscription_id=1, user_id=1, product_id=101, status='active'),
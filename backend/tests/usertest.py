@@ -1,8 +1,14 @@
+import os
+import signal
+import threading
 import unittest
+from unittest.mock import patch
 from flask import jsonify
 from werkzeug.security import generate_password_hash
 from itsdangerous import URLSafeTimedSerializer
-from backend.main.app import app, redis_conn, db, User, mail
+from backend.main.app import app, redis_conn, db, User, mail, identities, password_hasher
+from backend.main.passwords import PasswordHasher, HasherBusy
+from backend.tests.querycount import count_queries
 from flask_mail import Message
 
 
@@ -161,6 +167,67 @@ class TestUserManagement(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('The reset link is invalid or expired', response.get_json()['message'])
 
+    def test_identity_cached_without_queries(self):
+        with app.app_context():
+            self.assertEqual(identities.get("default@example.com").name, "Default User")
+            with count_queries(db.engine) as counter:
+                identity = identities.get("default@example.com")
+            self.assertEqual(counter.count, 0)
+            self.assertEqual(identity.user_id, self.default_user.user_id)
+
+    def test_unknown_email_cached_until_registered(self):
+        with app.app_context():
+            self.assertIsNone(identities.get("newuser@example.com"))
+            with count_queries(db.engine) as counter:
+                self.assertIsNone(identities.get("newuser@example.com"))
+            self.assertEqual(counter.count, 0)
+
+        self.client.post('/register', json={"name": "New User", "email": "newuser@example.com", "password": "pw"})
+        with app.app_context():
+            self.assertEqual(identities.get("newuser@example.com").name, "New User")
+
+        # A profile change replaces the cached name
+        self.client.put('/profile', json={"email": "newuser@example.com", "name": "Renamed"})
+        with app.app_context():
+            self.assertEqual(identities.get("newuser@example.com").name, "Renamed")
+
+    def test_login_upgrades_old_hashes(self):
+        with app.app_context():
+            user = User.query.filter_by(email="default@example.com").first()
+            user.password_hash = generate_password_hash("password123", method='pbkdf2:sha256:1000')
+            db.session.commit()
+
+        response = self.client.post('/login', json={"email": "default@example.com", "password": "password123"})
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            upgraded = User.query.filter_by(email="default@example.com").first().password_hash
+        self.assertFalse(password_hasher.needs_rehash(upgraded))
+        self.assertTrue(password_hasher.verify(upgraded, "password123"))
+
+    def test_login_rejected_when_hasher_saturated(self):
+        with patch.object(password_hasher, '_slots', threading.Semaphore(0)):
+            response = self.client.post('/login', json={"email": "default@example.com", "password": "password123"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_hasher_replaces_a_broken_pool(self):
+        hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1)
+        stored = hasher.hash("password123")
+        for process in list(hasher._executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertTrue(hasher.verify(stored, "password123"))
+        hasher._executor.shutdown()
+
+    def test_timed_out_hash_keeps_its_slot_until_it_ends(self):
+        hasher = PasswordHasher(method='pbkdf2:sha256:2000000', workers=1, max_pending=1, timeout=0.05)
+        with self.assertRaises(HasherBusy):
+            hasher.hash("password123")
+        # Still running in the pool, so nothing more may be queued behind it
+        self.assertEqual(hasher._slots._value, 0)
+        hasher._executor.shutdown(wait=True)
+        self.assertEqual(hasher._slots._value, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
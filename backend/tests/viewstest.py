@@ -0,0 +1,69 @@
+import unittest
+from backend.main.app import app, db, redis_conn, view_stream, record_view_events
+from backend.main.model import User
+from backend.main.views import STREAM_KEY, GROUP
+
+class ViewStreamTest(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # In-memory SQLite database for testing
+        app.config['TESTING'] = True
+        app.config['VIEW_INGESTION'] = 'stream'
+        self.client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(user_id=1, name="User 1", email="user1@example.com", password_hash="hashed_password"))
+            db.session.commit()
+        view_stream.create_group()
+
+    def tearDown(self):
+        app.config['VIEW_INGESTION'] = 'sync'
+        view_stream.max_pending = 100000
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            redis_conn.flushdb()
+
+    def test_views_are_queued_then_recorded_in_batches(self):
+        for product_id in (1, 2, 1):
+            response = self.client.post(f'/view-product/{product_id}', json={'email': 'user1@example.com'})
+            self.assertEqual(response.status_code, 202)
+        self.client.post('/view-product/3', json={'email': 'nobody@example.com'})
+        self.assertFalse(redis_conn.exists('user:1:recent_views'))
+
+        with app.app_context():
+            self.assertEqual(view_stream.consume('test', record_view_events, block_ms=None), 4)
+        self.assertEqual(sorted(redis_conn.zrange('user:1:recent_views', 0, -1)), [b'1', b'2'])
+        # Acknowledged events are gone
+        self.assertEqual(view_stream.backlog(), 0)
+        self.assertEqual(redis_conn.xpending(STREAM_KEY, GROUP)['pending'], 0)
+
+    def test_missing_email_rejected_before_queueing(self):
+        for payload in ({}, {'email': None}, {'email': ''}):
+            self.assertEqual(self.client.post('/view-product/1', json=payload).status_code, 404)
+        self.assertEqual(view_stream.backlog(), 0)
+
+    def test_backpressure(self):
+        view_stream.max_pending = 1
+        self.assertEqual(self.client.post('/view-product/1', json={'email': 'user1@example.com'}).status_code, 202)
+        response = self.client.post('/view-product/2', json={'email': 'user1@example.com'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_failed_batch_is_redelivered(self):
+        self.client.post('/view-product/1', json={'email': 'user1@example.com'})
+
+        def fail(events):
+            raise RuntimeError('database unavailable')
+
+        with app.app_context():
+            with self.assertRaises(RuntimeError):
+                view_stream.consume('crashed', fail, block_ms=None)
+            # Another worker takes over the unacknowledged event
+            self.assertEqual(view_stream.consume('other', record_view_events, block_ms=None, min_idle_ms=0), 1)
+        self.assertEqual(redis_conn.zrange('user:1:recent_views', 0, -1), [b'1'])
+        self.assertEqual(view_stream.backlog(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()